@@ -3,10 +3,16 @@ from django.views.generic import TemplateView, ListView, CreateView, UpdateView,
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.urls import reverse_lazy
 from django.contrib import messages
+from orders.models import Order
 from .models import Address
 
 class ProfileView(LoginRequiredMixin, TemplateView):
     template_name = 'accounts/profile.html'
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['recent_orders'] = Order.objects.filter(user=self.request.user).with_total_items()[:3]
+        return context
 
 class AddressListView(LoginRequiredMixin, ListView):
     model = Address
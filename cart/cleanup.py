@@ -0,0 +1,42 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Cart, CartItem
+
+
+def stale_guest_carts(cutoff):
+    """Guest carts with no change to the cart or any of its lines since cutoff"""
+    return Cart.objects.filter(user__isnull=True, updated_at__lt=cutoff).exclude(items__updated_at__gte=cutoff)
+
+
+def purge_guest_carts(idle=None, batch_size=1000, pause=0.0):
+    """Delete guest carts idle for longer than idle (default: the cart cookie lifetime); returns carts deleted.
+
+    Works through the carts in primary key order, one short transaction per
+    batch, so neither table is locked for long and live traffic can slip in
+    between batches. A guest whose cookie has expired can never get back to
+    their cart, which is why the cookie lifetime is the default.
+    """
+    if idle is None:
+        idle = timedelta(seconds=settings.CART_COOKIE_AGE)
+    cutoff = timezone.now() - idle
+    deleted = 0
+    last_pk = 0
+    while True:
+        batch = list(
+            stale_guest_carts(cutoff).filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not batch:
+            return deleted
+        last_pk = batch[-1]
+        with transaction.atomic():
+            # Check again: a cart may have been used since the batch was read
+            pks = list(stale_guest_carts(cutoff).filter(pk__in=batch).select_for_update().values_list('pk', flat=True))
+            CartItem.objects.filter(cart_id__in=pks).delete()
+            deleted += Cart.objects.filter(pk__in=pks).delete()[1].get(Cart._meta.label, 0)
+        if pause:
+            time.sleep(pause)
@@ -1,28 +1,29 @@
-from .models import Cart
+from django.utils.functional import SimpleLazyObject
+
+from .summary import EMPTY_SUMMARY, get_cart_summary, get_request_cart, update_cart_summary
+
 
 def cart(request):
-    """Add cart information to all templates"""
-    cart_obj = None
-    cart_items_count = 0
-    
-    try:
-        if request.user.is_authenticated:
-            cart_obj, created = Cart.objects.get_or_create(user=request.user)
-        else:
-            # Ensure session exists
-            if not request.session.session_key:
-                request.session.save()
-            if request.session.session_key:
-                cart_obj, created = Cart.objects.get_or_create(session_key=request.session.session_key)
-        
-        if cart_obj:
-            cart_items_count = cart_obj.total_items
-    except Exception:
-        # Fallback to prevent template errors
-        cart_obj = None
-        cart_items_count = 0
-    
+    """Add cart information to all templates.
+
+    The item count comes from the summary cached in the session or guest cart
+    cookie by the cart views; the cart itself is only loaded if a template
+    actually reads it.
+    """
+    def load_summary():
+        summary = get_cart_summary(request)
+        if summary is None:
+            if not request.user.is_authenticated:
+                # A guest without a valid cart cookie has no cart
+                return EMPTY_SUMMARY
+            summary = update_cart_summary(request)
+        return summary
+
+    cart_obj = SimpleLazyObject(lambda: get_request_cart(request))
+    summary = SimpleLazyObject(load_summary)
+
     return {
         'cart': cart_obj,
-        'cart_items_count': cart_items_count,
-    }
\ No newline at end of file
+        'cart_summary': summary,
+        'cart_items_count': SimpleLazyObject(lambda: summary['items_count']),
+    }
@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from cart.cleanup import purge_guest_carts
+
+
+class Command(BaseCommand):
+    help = 'Delete abandoned guest carts in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=float, default=None,
+            help='Idle time before a guest cart is purged; defaults to the cart cookie lifetime',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        idle = timedelta(days=options['days']) if options['days'] is not None else None
+        deleted = purge_guest_carts(idle, options['batch_size'], options['pause'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} abandoned guest carts'))
@@ -0,0 +1,84 @@
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+
+from cart.storage import get_cart_storage
+from products.models import Category, Product, ProductVariant
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Add the same cart lines from concurrent threads and check that no increment is lost'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--adds', type=int, default=400, help='Adds per thread')
+
+    def handle(self, *args, **options):
+        threads_count, adds = options['threads'], options['adds']
+        storage = get_cart_storage()
+
+        user, created = User.objects.get_or_create(
+            email='stress-cart@example.com', defaults={'username': 'stress-cart'},
+        )
+        category, created = Category.objects.get_or_create(name='Stress Test')
+        product = Product.objects.create(
+            name='Stress Cart SKU', slug=f'stress-cart-sku-{time.time_ns()}', description='Stress test',
+            category=category, price=1, sku=f'STRESS-CART-{time.time_ns()}',
+        )
+        variant = ProductVariant.objects.create(
+            product=product, name='Size', value='L', sku=f'STRESS-CART-{time.time_ns()}-L',
+        )
+        owner = f'user:{user.pk}'
+        storage.clear(owner)
+
+        retries = 0
+        lock = threading.Lock()
+
+        def worker():
+            nonlocal retries
+            try:
+                for i in range(adds):
+                    # Alternate between a line without and a line with a variant
+                    variant_id = variant.pk if i % 2 else None
+                    while True:
+                        try:
+                            storage.add(owner, product.pk, variant_id, 1)
+                        except OperationalError:
+                            # SQLite reports write contention instead of waiting on it
+                            with lock:
+                                retries += 1
+                            continue
+                        break
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for i in range(threads_count)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        cart = storage.load(owner, images=False)
+        quantities = {item.variant_id: item.quantity for item in cart.items.all()} if cart else {}
+        lines = len(cart.items.all()) if cart else 0
+        storage.clear(owner)
+        product.delete()
+
+        total = threads_count * adds
+        self.stdout.write(
+            f'threads={threads_count} adds={total} lines={lines} '
+            f'quantity_without_variant={quantities.get(None, 0)} quantity_with_variant={quantities.get(variant.pk, 0)} '
+            f'sqlite_retries={retries} throughput={total / elapsed:.0f} adds/s'
+        )
+        expected = {None: (adds - adds // 2) * threads_count, variant.pk: adds // 2 * threads_count}
+        expected = {key: quantity for key, quantity in expected.items() if quantity}
+        if lines != len(expected) or quantities != expected:
+            raise CommandError('Cart increments were lost or lines were duplicated')
+        self.stdout.write(self.style.SUCCESS('No lost increments'))
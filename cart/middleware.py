@@ -0,0 +1,24 @@
+from django.conf import settings
+
+from .summary import encode_cart_cookie
+
+
+class CartCookieMiddleware:
+    """Write the guest cart cookie when a view changed it (see cart.summary.write_cart_cookie)"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if getattr(request, '_cart_cookie_changed', False):
+            data = request._cart_cookie
+            if data is None:
+                response.delete_cookie(settings.CART_COOKIE_NAME, samesite='Lax')
+            else:
+                response.set_cookie(
+                    settings.CART_COOKIE_NAME, encode_cart_cookie(data),
+                    max_age=settings.CART_COOKIE_AGE, secure=settings.SESSION_COOKIE_SECURE,
+                    httponly=True, samesite='Lax',
+                )
+        return response
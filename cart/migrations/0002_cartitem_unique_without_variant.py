@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:46
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    # Racing adds could create several lines without a variant for the same product; keep one with their total
+    CartItem = apps.get_model('cart', 'CartItem')
+    duplicates = (
+        CartItem.objects.filter(variant__isnull=True).values('cart_id', 'product_id')
+        .annotate(lines=Count('id'), total=Sum('quantity')).filter(lines__gt=1)
+    )
+    for row in duplicates:
+        lines = CartItem.objects.filter(cart_id=row['cart_id'], product_id=row['product_id'], variant__isnull=True)
+        keep = lines.order_by('id').first()
+        lines.exclude(pk=keep.pk).delete()
+        CartItem.objects.filter(pk=keep.pk).update(quantity=row['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('variant__isnull', True)), fields=('cart', 'product'), name='cart_item_unique_without_variant'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0002_cartitem_unique_without_variant'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(condition=models.Q(('user__isnull', True)), fields=['session_key'], name='cart_guest_token_idx'),
+        ),
+    ]
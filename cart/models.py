@@ -1,30 +1,91 @@
+from decimal import Decimal
 from django.db import models
+from django.db.models import F, Prefetch, Sum, Value
+from django.db.models.functions import Coalesce
 from django.contrib.auth import get_user_model
-from products.models import Product, ProductVariant
+from products.models import Product, ProductVariant, main_image_prefetch
 
 User = get_user_model()
 
+PRICE_FIELD = models.DecimalField(max_digits=12, decimal_places=2)
+CENTS = Decimal('0.01')
+
+
+def line_total_expression(prefix=''):
+    """SQL expression for quantity * (product price + variant adjustment) of a cart line"""
+    unit_price = F(f'{prefix}product__price') + Coalesce(
+        F(f'{prefix}variant__price_adjustment'), Value(Decimal('0')), output_field=PRICE_FIELD
+    )
+    return F(f'{prefix}quantity') * unit_price
+
+
+class CartQuerySet(models.QuerySet):
+    def with_totals(self):
+        """Annotate each cart with its item count and subtotal computed by the database"""
+        return self.annotate(
+            total_items_sum=Coalesce(Sum('items__quantity'), 0),
+            total_price_sum=Coalesce(
+                Sum(line_total_expression('items__'), output_field=PRICE_FIELD),
+                Value(Decimal('0')),
+                output_field=PRICE_FIELD,
+            ),
+        )
+
+    def with_items(self, images=True):
+        """Prefetch cart items with everything the cart and checkout templates show"""
+        items = CartItem.objects.select_related('product', 'variant')
+        if images:
+            items = items.prefetch_related(main_image_prefetch('product__images'))
+        return self.prefetch_related(Prefetch('items', queryset=items))
+
+
 class Cart(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, null=True, blank=True)
     session_key = models.CharField(max_length=40, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CartQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Guest carts are looked up by the token in their cookie
+            models.Index(fields=['session_key'], name='cart_guest_token_idx', condition=models.Q(user__isnull=True)),
+        ]
+
     def __str__(self):
         if self.user:
             return f"Cart for {self.user.email}"
         return f"Anonymous Cart {self.session_key}"
 
+    def get_totals(self):
+        """Return (total_items, total_price) using a single aggregate query"""
+        totals = self.items.aggregate(
+            total_items_sum=Coalesce(Sum('quantity'), 0),
+            total_price_sum=Coalesce(
+                Sum(line_total_expression(), output_field=PRICE_FIELD),
+                Value(Decimal('0')),
+                output_field=PRICE_FIELD,
+            ),
+        )
+        return totals['total_items_sum'], totals['total_price_sum'].quantize(CENTS)
+
     @property
     def total_items(self):
-        return sum(item.quantity for item in self.items.all())
+        if hasattr(self, 'total_items_sum'):
+            return self.total_items_sum
+        return self.get_totals()[0]
 
     @property
     def total_price(self):
-        return sum(item.total_price for item in self.items.all())
+        if hasattr(self, 'total_price_sum'):
+            return self.total_price_sum.quantize(CENTS)
+        return self.get_totals()[1]
 
     def clear(self):
         self.items.all().delete()
+        if hasattr(self, 'total_items_sum'):
+            self.total_items_sum, self.total_price_sum = 0, Decimal('0.00')
 
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items')
@@ -36,11 +97,23 @@ class CartItem(models.Model):
 
     class Meta:
         unique_together = ['cart', 'product', 'variant']
+        constraints = [
+            # NULLs are distinct in unique_together, so lines without a variant need their own key
+            models.UniqueConstraint(
+                fields=['cart', 'product'], condition=models.Q(variant__isnull=True),
+                name='cart_item_unique_without_variant',
+            ),
+        ]
 
     def __str__(self):
         variant_info = f" ({self.variant})" if self.variant else ""
         return f"{self.product.name}{variant_info} x {self.quantity}"
 
+    @property
+    def line_id(self):
+        """Id of this line in every cart storage backend, '<product id>-<variant id or 0>'"""
+        return f'{self.product_id}-{self.variant_id or 0}'
+
     @property
     def unit_price(self):
         base_price = self.product.price
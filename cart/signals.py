@@ -0,0 +1,16 @@
+from django.contrib.auth.signals import user_logged_in
+from django.dispatch import receiver
+
+from .storage import get_cart_storage
+from .summary import get_cart_token, update_cart_summary, write_cart_cookie
+
+
+@receiver(user_logged_in)
+def merge_guest_cart(sender, request, user, **kwargs):
+    """Carry what a guest put in their cart over to the account they signed in to"""
+    token = get_cart_token(request) if request is not None else None
+    if not token:
+        return
+    write_cart_cookie(request, None)
+    get_cart_storage().merge(f'guest:{token}', f'user:{user.pk}')
+    update_cart_summary(request)
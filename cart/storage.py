@@ -0,0 +1,317 @@
+"""Where cart lines are kept.
+
+Views, the context processor and checkout only talk to the backend returned
+by get_cart_storage(), chosen with the CART_STORAGE setting:
+
+- DatabaseCartStorage keeps Cart/CartItem rows (the default).
+- RedisCartStorage keeps one hash per cart, product-variant field to
+  quantity, so adding to the cart is a single atomic HINCRBY and no table
+  is written at all.
+
+A cart belongs to an owner key, 'user:<pk>' or 'guest:<token>' (see
+cart.summary.get_cart_owner). Lines are addressed by line ids of the form
+'<product id>-<variant id or 0>', the same in every backend.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection, transaction
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+import redis
+
+from products.models import Product, ProductVariant, main_image_prefetch
+from .models import CENTS, Cart, CartItem
+
+_storage = None
+
+
+def get_cart_storage():
+    """Return the configured cart storage backend"""
+    global _storage
+    if _storage is None:
+        _storage = import_string(settings.CART_STORAGE)()
+    return _storage
+
+
+@receiver(setting_changed)
+def reset_cart_storage(setting, **kwargs):
+    global _storage
+    if setting in ('CART_STORAGE', 'CART_REDIS_URL'):
+        _storage = None
+
+
+def line_id(product_id, variant_id):
+    return f'{product_id}-{variant_id or 0}'
+
+
+def parse_line_id(value):
+    """(product id, variant id or None) of a line id, or None if it is not one"""
+    product_id, separator, variant_id = str(value).partition('-')
+    if not (separator and product_id.isdigit() and variant_id.isdigit()):
+        return None
+    return int(product_id), int(variant_id) or None
+
+
+class StoredCart:
+    """Read-only cart for templates and checkout, built from lines kept outside the database.
+
+    Offers what the templates use of Cart: items.all, total_items and total_price.
+    """
+
+    class Items(list):
+        def all(self):
+            return self
+
+        def count(self):
+            return len(self)
+
+    def __init__(self, owner, items):
+        self.owner = owner
+        self.items = self.Items(items)
+
+    @property
+    def total_items(self):
+        return sum(item.quantity for item in self.items)
+
+    @property
+    def total_price(self):
+        return sum((item.total_price for item in self.items), Decimal('0')).quantize(CENTS)
+
+
+def merge_cart(source, target):
+    """Move every line of source into target, adding up quantities of lines both have, and delete source.
+
+    Takes a fixed number of queries however many lines there are: the lines
+    are added with the same INSERT ... ON CONFLICT DO UPDATE as add_cart_item,
+    one statement for lines without and one for lines with a variant. Being
+    increments in the database, they cannot lose or collide with adds made to
+    target at the same time.
+    """
+    with transaction.atomic():
+        lines = list(source.items.values_list('product_id', 'variant_id', 'quantity'))
+        upsert_cart_items(target.pk, lines)
+        source.delete()
+
+
+def add_cart_item(cart_id, product_id, variant_id, quantity):
+    """Add quantity to a cart line, creating it if needed, in one INSERT ... ON CONFLICT DO UPDATE"""
+    upsert_cart_items(cart_id, [(product_id, variant_id, quantity)])
+
+
+def upsert_cart_items(cart_id, lines):
+    """Add (product_id, variant_id, quantity) lines to a cart, creating the lines it does not have.
+
+    The conflict branch sets quantity = quantity + n (F('quantity') + n) in
+    the database, so concurrent adds of the same line all count and none of
+    them can fail on the unique key. Lines without a variant conflict on the
+    partial cart_item_unique_without_variant index instead, since NULLs never
+    collide in (cart, product, variant), so they go in a statement of their own.
+    """
+    table = connection.ops.quote_name(CartItem._meta.db_table)
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    groups = (
+        ('(cart_id, product_id) WHERE variant_id IS NULL', [line for line in lines if line[1] is None]),
+        ('(cart_id, product_id, variant_id)', [line for line in lines if line[1] is not None]),
+    )
+    with connection.cursor() as cursor:
+        for conflict, group in groups:
+            if not group:
+                continue
+            cursor.execute(
+                f'INSERT INTO {table} (cart_id, product_id, variant_id, quantity, created_at, updated_at) '
+                f'VALUES {", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(group))} '
+                f'ON CONFLICT {conflict} DO UPDATE SET '
+                f'quantity = {table}.quantity + EXCLUDED.quantity, updated_at = EXCLUDED.updated_at',
+                [value for product_id, variant_id, quantity in group
+                 for value in (cart_id, product_id, variant_id, quantity, now, now)],
+            )
+
+
+class CartStorage:
+    """Base class for cart storage backends"""
+
+    def load(self, owner, images=True):
+        """The owner's cart with items, products, variants and (with images) main images loaded, or None"""
+        raise NotImplementedError
+
+    def totals(self, owner):
+        """(number of items, subtotal) of the owner's cart"""
+        raise NotImplementedError
+
+    def add(self, owner, product_id, variant_id, quantity):
+        """Add quantity of a product variant, creating the cart if needed"""
+        raise NotImplementedError
+
+    def set_quantity(self, owner, line, quantity):
+        """Change the quantity of an existing line, removing it at 0; False if there is no such line"""
+        raise NotImplementedError
+
+    def remove(self, owner, line):
+        """Remove a line; False if there is no such line"""
+        raise NotImplementedError
+
+    def clear(self, owner):
+        raise NotImplementedError
+
+    def merge(self, source, target):
+        """Move every line of source's cart into target's, adding up quantities, and drop source's cart"""
+        raise NotImplementedError
+
+
+class DatabaseCartStorage(CartStorage):
+    """Cart and CartItem rows"""
+
+    def lookup(self, owner):
+        kind, key = owner.split(':', 1)
+        return {'user_id': int(key)} if kind == 'user' else {'session_key': key, 'user__isnull': True}
+
+    def get_cart(self, owner):
+        return Cart.objects.filter(**self.lookup(owner)).first()
+
+    def get_or_create_cart(self, owner):
+        kind, key = owner.split(':', 1)
+        if kind == 'user':
+            return Cart.objects.get_or_create(user_id=int(key))[0]
+        return Cart.objects.get_or_create(session_key=key, user=None)[0]
+
+    def get_item(self, owner, line):
+        parsed = parse_line_id(line)
+        if parsed is None:
+            return None
+        product_id, variant_id = parsed
+        return CartItem.objects.filter(
+            cart__in=Cart.objects.filter(**self.lookup(owner)), product_id=product_id, variant_id=variant_id,
+        ).first()
+
+    def load(self, owner, images=True):
+        return Cart.objects.with_totals().with_items(images).filter(**self.lookup(owner)).first()
+
+    def totals(self, owner):
+        totals = Cart.objects.with_totals().filter(**self.lookup(owner)).values_list(
+            'total_items_sum', 'total_price_sum',
+        ).first()
+        if totals is None:
+            return 0, Decimal('0.00')
+        return totals[0], totals[1].quantize(CENTS)
+
+    def add(self, owner, product_id, variant_id, quantity):
+        add_cart_item(self.get_or_create_cart(owner).pk, product_id, variant_id, quantity)
+
+    def set_quantity(self, owner, line, quantity):
+        cart_item = self.get_item(owner, line)
+        if cart_item is None:
+            return False
+        if quantity > 0:
+            cart_item.quantity = quantity
+            cart_item.save()
+        else:
+            cart_item.delete()
+        return True
+
+    def remove(self, owner, line):
+        return self.set_quantity(owner, line, 0)
+
+    def clear(self, owner):
+        cart = self.get_cart(owner)
+        if cart:
+            cart.clear()
+
+    def merge(self, source, target):
+        source_cart = self.get_cart(source)
+        if source_cart is not None:
+            merge_cart(source_cart, self.get_or_create_cart(target))
+
+
+class RedisCartStorage(CartStorage):
+    """One Redis hash per cart, '<product id>-<variant id or 0>' to quantity.
+
+    Guest carts expire CART_COOKIE_AGE after their last change, along with
+    the cookie that leads to them; user carts are kept.
+    """
+
+    prefix = 'cart:'
+
+    def __init__(self):
+        self.redis = redis.Redis.from_url(settings.CART_REDIS_URL)
+
+    def key(self, owner):
+        return f'{self.prefix}{owner}'
+
+    def touch(self, pipe, owner):
+        if owner.startswith('guest:'):
+            pipe.expire(self.key(owner), settings.CART_COOKIE_AGE)
+
+    def lines(self, owner):
+        """{(product id, variant id or None): quantity} of the owner's cart"""
+        lines = {}
+        for field, quantity in self.redis.hgetall(self.key(owner)).items():
+            parsed = parse_line_id(field.decode())
+            if parsed is not None and int(quantity) > 0:
+                lines[parsed] = int(quantity)
+        return lines
+
+    def items(self, lines, images=False):
+        """Unsaved CartItems for lines, skipping products and variants that no longer exist"""
+        products = Product.objects.filter(pk__in={product_id for product_id, variant_id in lines})
+        if images:
+            products = products.prefetch_related(main_image_prefetch())
+        products = products.in_bulk()
+        variants = ProductVariant.objects.in_bulk({variant_id for product_id, variant_id in lines if variant_id})
+        items = []
+        for (product_id, variant_id), quantity in lines.items():
+            product = products.get(product_id)
+            variant = variants.get(variant_id) if variant_id else None
+            if product is None or (variant_id and variant is None):
+                continue
+            items.append(CartItem(product=product, variant=variant, quantity=quantity))
+        return items
+
+    def load(self, owner, images=True):
+        lines = self.lines(owner)
+        if not lines:
+            return None
+        return StoredCart(owner, self.items(lines, images))
+
+    def totals(self, owner):
+        lines = self.lines(owner)
+        if not lines:
+            return 0, Decimal('0.00')
+        cart = StoredCart(owner, self.items(lines))
+        return cart.total_items, cart.total_price
+
+    def add(self, owner, product_id, variant_id, quantity):
+        with self.redis.pipeline() as pipe:
+            pipe.hincrby(self.key(owner), line_id(product_id, variant_id), quantity)
+            self.touch(pipe, owner)
+            pipe.execute()
+
+    def set_quantity(self, owner, line, quantity):
+        if parse_line_id(line) is None or not self.redis.hexists(self.key(owner), line):
+            return False
+        with self.redis.pipeline() as pipe:
+            if quantity > 0:
+                pipe.hset(self.key(owner), line, quantity)
+            else:
+                pipe.hdel(self.key(owner), line)
+            self.touch(pipe, owner)
+            pipe.execute()
+        return True
+
+    def remove(self, owner, line):
+        return self.set_quantity(owner, line, 0)
+
+    def clear(self, owner):
+        self.redis.delete(self.key(owner))
+
+    def merge(self, source, target):
+        lines = self.redis.hgetall(self.key(source))
+        with self.redis.pipeline() as pipe:
+            for field, quantity in lines.items():
+                pipe.hincrby(self.key(target), field, int(quantity))
+            self.touch(pipe, target)
+            pipe.delete(self.key(source))
+            pipe.execute()
@@ -0,0 +1,114 @@
+"""Who owns the cart of a request, and the cached summary for the header badge.
+
+Signed-in users' carts hang off the user and their summary is cached in the
+session. Guests get no session at all: their cart is only created on the
+first add, keyed by a random token, and the token travels together with the
+summary in a signed cookie (see CartCookieMiddleware). Browsing as a guest
+therefore never writes to the database.
+
+The cart itself lives wherever the configured storage keeps it (see
+cart.storage); requests reach it through their owner key.
+"""
+import secrets
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+
+from .storage import get_cart_storage
+
+SESSION_KEY = 'cart_summary'
+COOKIE_SALT = 'cart.cookie'
+EMPTY_SUMMARY = {'items_count': 0, 'subtotal': '0.00', 'version': 0}
+
+
+def _owner_key(request):
+    """Identify who the cached summary belongs to, so it is dropped on login/logout"""
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    return f'guest:{get_cart_token(request)}'
+
+
+def read_cart_cookie(request):
+    """The guest cart cookie of a request as {'token', 'items_count', 'subtotal', 'version'}, or None"""
+    if not hasattr(request, '_cart_cookie'):
+        value = request.COOKIES.get(settings.CART_COOKIE_NAME)
+        try:
+            data = signing.loads(value, salt=COOKIE_SALT, max_age=settings.CART_COOKIE_AGE) if value else None
+        except signing.BadSignature:
+            data = None
+        if data is not None:
+            data = {'token': data['k'], 'items_count': data['n'], 'subtotal': data['s'], 'version': data['v']}
+        request._cart_cookie = data
+    return request._cart_cookie
+
+
+def write_cart_cookie(request, data):
+    """Queue the guest cart cookie for CartCookieMiddleware to set; None deletes it"""
+    request._cart_cookie = data
+    request._cart_cookie_changed = True
+
+
+def encode_cart_cookie(data):
+    return signing.dumps(
+        {'k': data['token'], 'n': data['items_count'], 's': data['subtotal'], 'v': data['version']},
+        salt=COOKIE_SALT, compress=True,
+    )
+
+
+def get_cart_token(request):
+    data = read_cart_cookie(request)
+    return data['token'] if data else None
+
+
+def get_cart_owner(request, create=False):
+    """Storage owner key of the request's cart; with create, guests without one are given a cart token"""
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    token = get_cart_token(request)
+    if token is None and create:
+        token = secrets.token_urlsafe(30)
+        write_cart_cookie(request, dict(EMPTY_SUMMARY, token=token))
+    return f'guest:{token}' if token else None
+
+
+def get_request_cart(request):
+    """Return the existing cart for this request, items loaded, without creating one"""
+    owner = get_cart_owner(request)
+    return get_cart_storage().load(owner) if owner else None
+
+
+def get_cart_summary(request):
+    """Return the cached cart summary, or None if missing or stale"""
+    if not request.user.is_authenticated:
+        return read_cart_cookie(request)
+    summary = request.session.get(SESSION_KEY)
+    if not summary or summary.get('owner') != _owner_key(request):
+        return None
+    return summary
+
+
+def update_cart_summary(request):
+    """Recompute the cart summary from the cart storage and cache it in the session or cart cookie.
+
+    Called by the cart views after every change so that rendering the header
+    badge on subsequent pages does not need to look at the cart.
+    """
+    owner = get_cart_owner(request)
+    items_count, subtotal = get_cart_storage().totals(owner) if owner else (0, Decimal('0.00'))
+    if request.user.is_authenticated:
+        previous = request.session.get(SESSION_KEY) or {}
+    else:
+        previous = read_cart_cookie(request) or {}
+    summary = {
+        'items_count': items_count,
+        'subtotal': str(subtotal),
+        'version': previous.get('version', 0) + 1,
+    }
+    if request.user.is_authenticated:
+        summary['owner'] = _owner_key(request)
+        request.session[SESSION_KEY] = summary
+    elif owner is not None:
+        summary['token'] = get_cart_token(request)
+        write_cart_cookie(request, summary)
+    return summary
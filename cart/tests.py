@@ -1,3 +1,454 @@
-from django.test import TestCase
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from allauth.account.models import EmailAddress
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+
+from django.contrib.auth import get_user_model
+
+from products.models import Category, Product, ProductImage, ProductVariant
+from .models import Cart, CartItem, Wishlist, WishlistItem
+from .cleanup import purge_guest_carts
+from . import storage
+from .storage import get_cart_storage, merge_cart
+from .summary import SESSION_KEY
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class CartSummaryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Electronics')
+        cls.product = Product.objects.create(
+            name='Headphones', description='Wireless', category=category,
+            price='10.00', sku='HP-001', stock_quantity=10,
+        )
+
+    def cart_queries(self, queries):
+        return [q['sql'] for q in queries if 'cart_cart' in q['sql']]
+
+    def test_anonymous_page_view_does_not_touch_cart(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('core:about'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.cart_queries(ctx.captured_queries), [])
+        self.assertFalse(Cart.objects.exists())
+
+    def write_queries(self, queries):
+        return [q['sql'] for q in queries if q['sql'].split()[0] in ('INSERT', 'UPDATE', 'DELETE')]
+
+    def test_guest_browsing_writes_nothing(self):
+        with CaptureQueriesContext(connection) as ctx:
+            for url in (reverse('core:home'), reverse('products:list'), reverse('cart:detail')):
+                self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.write_queries(ctx.captured_queries), [])
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+        self.assertNotIn(settings.CART_COOKIE_NAME, self.client.cookies)
+
+    def test_guest_cart_lives_in_signed_cookie(self):
+        self.client.post(reverse('cart:add'), {'product_id': self.product.id, 'quantity': 2})
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+        cart = Cart.objects.get()
+        self.assertIsNone(cart.user)
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('core:about'))
+        self.assertEqual(response.context['cart_items_count'], 2)
+        self.assertEqual(self.cart_queries(ctx.captured_queries), [])
+        self.assertEqual(self.write_queries(ctx.captured_queries), [])
+
+        item = cart.items.get()
+        response = self.client.post(reverse('cart:update'), {'item_id': item.line_id, 'quantity': 5})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.client.get(reverse('core:about')).context['cart_items_count'], 5)
+        response = self.client.get(reverse('cart:detail'))
+        self.assertEqual(response.context['cart'].total_items, 5)
+
+        self.client.post(reverse('cart:clear'))
+        self.assertEqual(self.client.get(reverse('core:about')).context['cart_items_count'], 0)
+
+    def test_tampered_cookie_is_ignored(self):
+        self.client.post(reverse('cart:add'), {'product_id': self.product.id, 'quantity': 2})
+        item = CartItem.objects.get()
+        self.client.cookies[settings.CART_COOKIE_NAME] = self.client.cookies[settings.CART_COOKIE_NAME].value + 'x'
+        self.assertEqual(self.client.get(reverse('core:about')).context['cart_items_count'], 0)
+        response = self.client.post(reverse('cart:update'), {'item_id': item.line_id, 'quantity': 9})
+        self.assertEqual(response.status_code, 404)
+        item.refresh_from_db()
+        self.assertEqual(item.quantity, 2)
+
+    def test_guest_cart_merges_into_user_cart_on_login(self):
+        user = get_user_model().objects.create_user(username='guest', email='guest@example.com', password='secret')
+        EmailAddress.objects.create(user=user, email=user.email, verified=True, primary=True)
+        other = Product.objects.create(
+            name='Speaker', description='Loud', category=self.product.category,
+            price='5.00', sku='SP-001', stock_quantity=10,
+        )
+        CartItem.objects.create(cart=Cart.objects.create(user=user), product=self.product, quantity=1)
+        self.client.post(reverse('cart:add'), {'product_id': self.product.id, 'quantity': 2})
+        self.client.post(reverse('cart:add'), {'product_id': other.id, 'quantity': 1})
+
+        self.client.post(reverse('account_login'), {'login': 'guest@example.com', 'password': 'secret'})
+        cart = Cart.objects.get()
+        self.assertEqual(cart.user, user)
+        self.assertEqual(
+            dict(cart.items.values_list('product__sku', 'quantity')), {'HP-001': 3, 'SP-001': 1}
+        )
+        self.assertEqual(self.client.cookies[settings.CART_COOKIE_NAME].value, '')
+        self.assertEqual(self.client.session[SESSION_KEY]['items_count'], 4)
+
+    def test_missing_summary_falls_back_to_database(self):
+        user = get_user_model().objects.create_user(username='member', email='member@example.com', password='secret')
+        self.client.force_login(user)
+        self.client.post(reverse('cart:add'), {'product_id': self.product.id, 'quantity': 3})
+        self.assertEqual(self.client.session[SESSION_KEY]['items_count'], 3)
+        session = self.client.session
+        del session[SESSION_KEY]
+        session.save()
+
+        response = self.client.get(reverse('core:about'))
+        self.assertEqual(response.context['cart_items_count'], 3)
+        self.assertEqual(self.client.session[SESSION_KEY]['items_count'], 3)
+
+
+class FakeRedis:
+    """In-memory stand-in for the hash commands RedisCartStorage uses"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.ttls = {}
+
+    def hincrby(self, key, field, amount):
+        field = field.decode() if isinstance(field, bytes) else field
+        fields = self.hashes.setdefault(key, {})
+        fields[field] = fields.get(field, 0) + amount
+        return fields[field]
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = int(value)
+
+    def hexists(self, key, field):
+        return field in self.hashes.get(key, {})
+
+    def hdel(self, key, field):
+        self.hashes.get(key, {}).pop(field, None)
+
+    def hgetall(self, key):
+        return {field.encode(): str(value).encode() for field, value in self.hashes.get(key, {}).items()}
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+        self.ttls.pop(key, None)
+
+    def expire(self, key, seconds):
+        self.ttls[key] = seconds
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name, args))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args) for name, args in self.commands]
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    CART_STORAGE='cart.storage.RedisCartStorage',
+)
+class RedisCartStorageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Audio')
+        cls.product = Product.objects.create(
+            name='Headphones', description='Wireless', category=category,
+            price='10.00', sku='HP-001', stock_quantity=10,
+        )
+        cls.variant = ProductVariant.objects.create(
+            product=cls.product, name='Color', value='Red', price_adjustment='2.00', sku='HP-001-R',
+        )
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        for patcher in (
+            mock.patch('cart.storage.redis.Redis.from_url', return_value=self.redis),
+            # Each test gets a backend connected to its own FakeRedis
+            mock.patch('cart.storage._storage', None),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_queries(self, queries):
+        return [q['sql'] for q in queries if q['sql'].split()[0] in ('INSERT', 'UPDATE', 'DELETE')]
+
+    def test_guest_cart_is_a_redis_hash(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post(reverse('cart:add'), {'product_id': self.product.id, 'quantity': 2})
+            self.client.post(reverse('cart:add'), {'product_id': self.product.id, 'quantity': 1})
+            self.client.post(
+                reverse('cart:add'), {'product_id': self.product.id, 'variant_id': self.variant.id, 'quantity': 1}
+            )
+        self.assertEqual(self.write_queries(ctx.captured_queries), [])
+        self.assertFalse(Cart.objects.exists())
+        key, = self.redis.hashes
+        self.assertEqual(self.redis.hashes[key], {f'{self.product.pk}-0': 3, f'{self.product.pk}-{self.variant.pk}': 1})
+        self.assertEqual(self.redis.ttls[key], settings.CART_COOKIE_AGE)
+        self.assertEqual(self.client.get(reverse('core:about')).context['cart_items_count'], 4)
+
+        cart = self.client.get(reverse('cart:detail')).context['cart']
+        self.assertEqual((cart.total_items, cart.total_price), (4, Decimal('42.00')))
+
+        self.client.post(reverse('cart:update'), {'item_id': f'{self.product.pk}-0', 'quantity': 5})
+        self.client.post(reverse('cart:remove', args=[f'{self.product.pk}-{self.variant.pk}']))
+        self.assertEqual(self.redis.hashes[key], {f'{self.product.pk}-0': 5})
+        self.assertEqual(self.client.get(reverse('core:about')).context['cart_items_count'], 5)
+
+        response = self.client.post(reverse('cart:update'), {'item_id': '999-0', 'quantity': 1})
+        self.assertEqual(response.status_code, 404)
+
+        self.client.post(reverse('cart:clear'))
+        self.assertEqual(self.redis.hashes, {})
+        self.assertEqual(self.client.get(reverse('core:about')).context['cart_items_count'], 0)
+
+    def test_guest_cart_merges_into_user_cart_on_login(self):
+        user = get_user_model().objects.create_user(username='guest', email='guest@example.com', password='secret')
+        EmailAddress.objects.create(user=user, email=user.email, verified=True, primary=True)
+        get_cart_storage().add(f'user:{user.pk}', self.product.pk, None, 1)
+        self.client.post(reverse('cart:add'), {'product_id': self.product.id, 'quantity': 2})
+
+        self.client.post(reverse('account_login'), {'login': 'guest@example.com', 'password': 'secret'})
+        self.assertEqual(self.redis.hashes, {f'cart:user:{user.pk}': {f'{self.product.pk}-0': 3}})
+        self.assertEqual(self.client.session[SESSION_KEY]['items_count'], 3)
+        self.assertFalse(Cart.objects.exists())
+
+
+class CartTotalsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Clothing')
+
+    def make_cart(self, lines):
+        cart = Cart.objects.create(session_key=f'cart-{lines}')
+        for i in range(lines):
+            product = Product.objects.create(
+                name=f'Shirt {lines}-{i}', description='Cotton', category=self.category,
+                price='10.00', sku=f'SH-{lines}-{i}',
+            )
+            variant = ProductVariant.objects.create(
+                product=product, name='Size', value='XL', price_adjustment='2.50', sku=f'SH-{lines}-{i}-XL',
+            )
+            CartItem.objects.create(cart=cart, product=product, quantity=2)
+            CartItem.objects.create(cart=cart, product=product, variant=variant, quantity=1)
+        return cart
+
+    def test_totals_match_per_item_prices(self):
+        cart = self.make_cart(3)
+        items = list(cart.items.all())
+        self.assertEqual(cart.total_items, sum(item.quantity for item in items))
+        self.assertEqual(cart.total_price, sum(item.total_price for item in items))
+        self.assertEqual(cart.total_price, Decimal('97.50'))
+
+    def test_query_count_is_independent_of_cart_size(self):
+        for lines in (1, 25):
+            cart = self.make_cart(lines)
+            with self.assertNumQueries(1):
+                annotated = Cart.objects.with_totals().get(pk=cart.pk)
+                self.assertEqual(annotated.total_items, 3 * lines)
+                self.assertEqual(annotated.total_price, Decimal('32.50') * lines)
+            with self.assertNumQueries(1):
+                self.assertEqual(cart.get_totals(), (3 * lines, Decimal('32.50') * lines))
+
+    def test_empty_cart_totals(self):
+        cart = Cart.objects.create(session_key='empty')
+        self.assertEqual(Cart.objects.with_totals().get(pk=cart.pk).total_price, Decimal('0'))
+        self.assertEqual(cart.get_totals(), (0, Decimal('0')))
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class CartQueryCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(
+            username='shopper', email='shopper@example.com', password='secret',
+            first_name='Shop', last_name='Per',
+        )
+        cls.category = Category.objects.create(name='Kitchen')
+        cls.cart = Cart.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def add_lines(self, count):
+        start = self.cart.items.count()
+        for i in range(start, start + count):
+            product = Product.objects.create(
+                name=f'Mug {i}', description='Ceramic', category=self.category, price='8.00', sku=f'MUG-{i}',
+            )
+            variant = ProductVariant.objects.create(
+                product=product, name='Color', value='Blue', price_adjustment='1.00', sku=f'MUG-{i}-B',
+            )
+            ProductImage.objects.create(product=product, image=f'products/mug-{i}.jpg', is_main=True)
+            CartItem.objects.create(cart=self.cart, product=product, variant=variant, quantity=1)
+
+    def test_cart_page(self):
+        self.add_lines(2)
+        url = reverse('cart:detail')
+        self.client.get(url)  # store the cart summary in the session
+        # session, user, cart with totals, items, main images, session save
+        with self.assertNumQueries(8):
+            response = self.client.get(url)
+        self.assertContains(response, 'mug-0.jpg')
+        self.add_lines(8)
+        with self.assertNumQueries(8):
+            self.client.get(url)
+
+    def test_wishlist_page(self):
+        wishlist = Wishlist.objects.create(user=self.user)
+        self.add_lines(2)
+        for item in self.cart.items.all():
+            WishlistItem.objects.create(wishlist=wishlist, product=item.product)
+        url = reverse('cart:wishlist')
+        self.client.get(url)
+        # session, user, wishlist, items, main images, session save
+        with self.assertNumQueries(8):
+            response = self.client.get(url)
+        self.assertContains(response, 'mug-1.jpg')
+
+
+class CartMergeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(username='merger', password='secret')
+        category = Category.objects.create(name='Garden')
+        cls.products = []
+        for i in range(30):
+            product = Product.objects.create(
+                name=f'Pot {i}', description='Clay', category=category, price='3.00', sku=f'POT-{i}',
+            )
+            variant = ProductVariant.objects.create(product=product, name='Size', value='L', sku=f'POT-{i}-L')
+            cls.products.append((product, variant))
+
+    def make_cart(self, lines, **owner):
+        cart = Cart.objects.create(**owner)
+        for product, variant, quantity in lines:
+            CartItem.objects.create(cart=cart, product=product, variant=variant, quantity=quantity)
+        return cart
+
+    def test_overlapping_lines_add_up(self):
+        (pot, large), (other, other_large) = self.products[:2]
+        target = self.make_cart([(pot, None, 1), (pot, large, 2)], user=self.user)
+        guest = self.make_cart([(pot, None, 3), (pot, large, 4), (other, other_large, 5)], session_key='guest')
+        merge_cart(guest, target)
+
+        self.assertFalse(Cart.objects.filter(pk=guest.pk).exists())
+        self.assertCountEqual(
+            target.items.values_list('product_id', 'variant_id', 'quantity'),
+            [(pot.pk, None, 4), (pot.pk, large.pk, 6), (other.pk, other_large.pk, 5)],
+        )
+
+    def test_line_added_to_target_during_merge_adds_up(self):
+        pot, large = self.products[0]
+        target = self.make_cart([], user=self.user)
+        guest = self.make_cart([(pot, None, 3), (pot, large, 1)], session_key='guest')
+        upsert = storage.upsert_cart_items
+
+        def add_concurrently(cart_id, lines):
+            # The user adds the same lines from another tab after the guest lines were read
+            upsert(target.pk, [(pot.pk, None, 2), (pot.pk, large.pk, 2)])
+            upsert(cart_id, lines)
+
+        with mock.patch('cart.storage.upsert_cart_items', side_effect=add_concurrently):
+            merge_cart(guest, target)
+        self.assertCountEqual(
+            target.items.values_list('variant_id', 'quantity'), [(None, 5), (large.pk, 3)],
+        )
+
+    def test_query_count_is_independent_of_cart_size(self):
+        for lines in (2, 30):
+            products = self.products[:lines]
+            target = self.make_cart([(product, None, 1) for product, variant in products], user=self.user)
+            guest = self.make_cart(
+                [(product, None, 1) for product, variant in products]
+                + [(product, variant, 1) for product, variant in products],
+                session_key=f'guest-{lines}',
+            )
+            # savepoint, guest lines, upsert without and with variants, delete guest lines and cart, release
+            with self.assertNumQueries(7):
+                merge_cart(guest, target)
+            self.assertEqual(target.get_totals()[0], 3 * lines)
+            target.delete()
+
+
+class AddToCartContentionTests(TransactionTestCase):
+    def test_concurrent_adds_lose_no_increments(self):
+        out = StringIO()
+        call_command('stress_cart', threads=4, adds=50, stdout=out)
+        self.assertIn('No lost increments', out.getvalue())
+
+
+class PurgeGuestCartsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Tools')
+        cls.product = Product.objects.create(
+            name='Hammer', description='Steel', category=category, price='9.00', sku='HM-1',
+        )
+
+    def make_cart(self, days_idle, item_days_idle=None, **owner):
+        cart = Cart.objects.create(**owner)
+        item = CartItem.objects.create(cart=cart, product=self.product)
+        now = timezone.now()
+        Cart.objects.filter(pk=cart.pk).update(updated_at=now - timedelta(days=days_idle))
+        CartItem.objects.filter(pk=item.pk).update(
+            updated_at=now - timedelta(days=days_idle if item_days_idle is None else item_days_idle)
+        )
+        return cart
+
+    def test_only_idle_guest_carts_are_purged(self):
+        user = get_user_model().objects.create_user(username='keeper', password='secret')
+        stale = [self.make_cart(30, session_key=f'old-{i}') for i in range(5)]
+        kept = [
+            self.make_cart(1, session_key='recent'),
+            self.make_cart(30, item_days_idle=1, session_key='recent-item'),
+            self.make_cart(30, user=user),
+        ]
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(purge_guest_carts(timedelta(days=14), batch_size=2), 5)
+        # Three batches of up to two carts, then an empty read
+        self.assertEqual(sum(1 for q in ctx.captured_queries if q['sql'].startswith('DELETE FROM "cart_cart"')), 3)
+        self.assertEqual(set(Cart.objects.values_list('pk', flat=True)), {cart.pk for cart in kept})
+        self.assertFalse(CartItem.objects.filter(cart__in=stale).exists())
+
+    def test_command(self):
+        self.make_cart(30, session_key='old')
+        out = StringIO()
+        call_command('purge_guest_carts', '--days', '14', stdout=out)
+        self.assertIn('Deleted 1 abandoned guest carts', out.getvalue())
@@ -1,12 +1,15 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.views.generic import TemplateView, View
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse
 from django.contrib import messages
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from .models import Cart, CartItem, Wishlist, WishlistItem
-from products.models import Product, ProductVariant
+from django.db.models import Prefetch, prefetch_related_objects
+from .models import Wishlist, WishlistItem
+from .storage import get_cart_storage
+from .summary import get_cart_owner, get_request_cart, update_cart_summary
+from products.models import Product, ProductVariant, main_image_prefetch
 
 class CartView(TemplateView):
     template_name = 'cart/detail.html'
@@ -18,13 +21,8 @@ class CartView(TemplateView):
         return context
     
     def get_cart(self):
-        if self.request.user.is_authenticated:
-            cart, created = Cart.objects.get_or_create(user=self.request.user)
-        else:
-            if not self.request.session.session_key:
-                self.request.session.create()
-            cart, created = Cart.objects.get_or_create(session_key=self.request.session.session_key)
-        return cart
+        # Looking at an empty cart creates nothing, not even a session for guests
+        return get_request_cart(self.request)
 
 @method_decorator(csrf_exempt, name='dispatch')
 class AddToCartView(View):
@@ -38,31 +36,17 @@ class AddToCartView(View):
         if variant_id:
             variant = get_object_or_404(ProductVariant, id=variant_id)
         
-        # Get or create cart
-        if request.user.is_authenticated:
-            cart, created = Cart.objects.get_or_create(user=request.user)
-        else:
-            if not request.session.session_key:
-                request.session.create()
-            cart, created = Cart.objects.get_or_create(session_key=request.session.session_key)
-        
-        # Add or update cart item
-        cart_item, created = CartItem.objects.get_or_create(
-            cart=cart,
-            product=product,
-            variant=variant,
-            defaults={'quantity': quantity}
-        )
+        owner = get_cart_owner(request, create=True)
+        get_cart_storage().add(owner, product.pk, variant.pk if variant else None, quantity)
         
-        if not created:
-            cart_item.quantity += quantity
-            cart_item.save()
+        summary = update_cart_summary(request)
         
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return JsonResponse({
                 'success': True,
                 'message': 'Product added to cart',
-                'cart_items_count': cart.total_items
+                'cart_items_count': summary['items_count'],
+                'cart_version': summary['version']
             })
         
         messages.success(request, 'Product added to cart successfully!')
@@ -74,59 +58,42 @@ class UpdateCartView(View):
         item_id = request.POST.get('item_id')
         quantity = int(request.POST.get('quantity', 1))
         
-        cart_item = get_object_or_404(CartItem, id=item_id)
+        # Lines are looked up in the requester's own cart only
+        owner = get_cart_owner(request)
+        if owner is None or not get_cart_storage().set_quantity(owner, item_id, quantity):
+            raise Http404('No such item in your cart')
         
-        # Verify ownership
-        if request.user.is_authenticated:
-            if cart_item.cart.user != request.user:
-                return JsonResponse({'success': False, 'message': 'Unauthorized'})
-        else:
-            if cart_item.cart.session_key != request.session.session_key:
-                return JsonResponse({'success': False, 'message': 'Unauthorized'})
-        
-        if quantity > 0:
-            cart_item.quantity = quantity
-            cart_item.save()
-        else:
-            cart_item.delete()
+        summary = update_cart_summary(request)
         
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return JsonResponse({
                 'success': True,
                 'message': 'Cart updated',
-                'cart_items_count': cart_item.cart.total_items,
-                'cart_total': str(cart_item.cart.total_price)
+                'cart_items_count': summary['items_count'],
+                'cart_total': summary['subtotal'],
+                'cart_version': summary['version']
             })
         
         return redirect('cart:detail')
 
 class RemoveFromCartView(View):
     def post(self, request, item_id):
-        cart_item = get_object_or_404(CartItem, id=item_id)
-        
-        # Verify ownership
-        if request.user.is_authenticated:
-            if cart_item.cart.user != request.user:
-                messages.error(request, 'Unauthorized action')
-                return redirect('cart:detail')
-        else:
-            if cart_item.cart.session_key != request.session.session_key:
-                messages.error(request, 'Unauthorized action')
-                return redirect('cart:detail')
+        owner = get_cart_owner(request)
+        if owner is None or not get_cart_storage().remove(owner, item_id):
+            messages.error(request, 'Item not found in your cart')
+            return redirect('cart:detail')
         
-        cart_item.delete()
+        update_cart_summary(request)
         messages.success(request, 'Item removed from cart')
         return redirect('cart:detail')
 
 class ClearCartView(View):
     def post(self, request):
-        if request.user.is_authenticated:
-            cart = Cart.objects.filter(user=request.user).first()
-        else:
-            cart = Cart.objects.filter(session_key=request.session.session_key).first()
+        owner = get_cart_owner(request)
         
-        if cart:
-            cart.clear()
+        if owner:
+            get_cart_storage().clear(owner)
+            update_cart_summary(request)
             messages.success(request, 'Cart cleared successfully')
         
         return redirect('cart:detail')
@@ -137,6 +104,12 @@ class WishlistView(LoginRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         wishlist, created = Wishlist.objects.get_or_create(user=self.request.user)
+        prefetch_related_objects([wishlist], Prefetch(
+            'items',
+            queryset=WishlistItem.objects.select_related('product').prefetch_related(
+                main_image_prefetch('product__images')
+            ),
+        ))
         context['wishlist'] = wishlist
         return context
 
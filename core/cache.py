@@ -0,0 +1,103 @@
+"""Tag-versioned caching for catalog pages and template fragments.
+
+Every cache key embeds the current version of the tags it depends on, so
+invalidating a tag only has to replace its version: entries built against
+the old version are never read again and age out on their own. This works
+the same on Redis and on the locmem fallback.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.http import urlencode
+
+from cart.context_processors import cart as cart_context
+
+TAG_PREFIX = 'cache-tag'
+
+# Catalog tags: product cards (prices, stock, images, ratings) and the category navigation
+PRODUCTS = 'products'
+CATEGORIES = 'categories'
+
+
+def _tag_key(tag):
+    return f'{TAG_PREFIX}:{tag}'
+
+
+def tag_versions(*tags):
+    """Current version of each tag, creating versions for tags never seen before"""
+    keys = [_tag_key(tag) for tag in tags]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # add() keeps whichever version another process stored first
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def cache_version(*tags):
+    """Short digest of the versions of tags, for use in cache keys and {% cache %} vary-on"""
+    return hashlib.md5(':'.join(tag_versions(*tags)).encode()).hexdigest()
+
+
+def invalidate_tags(*tags):
+    """Orphan every cached page and fragment that depends on any of tags"""
+    cache.set_many({_tag_key(tag): uuid.uuid4().hex for tag in tags}, None)
+
+
+class CachedPageMixin:
+    """Serve whole rendered pages to anonymous visitors from the cache.
+
+    Pages are keyed by path, query string, the visitor's cart badge count and
+    the versions of cache_tags, and only GET requests without pending flash
+    messages are cached. Invalidating a tag drops every page depending on it.
+    """
+
+    cache_tags = (PRODUCTS, CATEGORIES)
+
+    def get_page_cache_timeout(self):
+        return settings.CATALOG_CACHE_TIMEOUT
+
+    def page_is_cacheable(self, request):
+        return (
+            self.get_page_cache_timeout() > 0
+            and request.method in ('GET', 'HEAD')
+            and not request.user.is_authenticated
+            and not len(get_messages(request))
+        )
+
+    def get_page_cache_key(self, request):
+        query = urlencode(sorted(request.GET.lists()), doseq=True)
+        items_count = cart_context(request)['cart_summary']['items_count']
+        digest = hashlib.md5(
+            f'{query}|{items_count}|{cache_version(*self.cache_tags)}'.encode()
+        ).hexdigest()
+        return f'page:{request.path}:{digest}'
+
+    def dispatch(self, request, *args, **kwargs):
+        if not self.page_is_cacheable(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        key = self.get_page_cache_key(request)
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            response = HttpResponse(content, content_type=content_type)
+            response['X-Page-Cache'] = 'hit'
+            return response
+
+        response = super().dispatch(request, *args, **kwargs)
+        if response.status_code == 200 and not response.cookies:
+            def store(response):
+                cache.set(key, (response.content, response['Content-Type']), self.get_page_cache_timeout())
+
+            if hasattr(response, 'add_post_render_callback'):
+                response.add_post_render_callback(store)
+            else:
+                store(response)
+        response['X-Page-Cache'] = 'miss'
+        return response
@@ -0,0 +1,292 @@
+"""Deterministic synthetic data at scale, for benchmarks and load tests.
+
+Unlike create_sample_data.py, which saves a handful of hand-written rows one
+by one, everything here is inserted with bulk_create in chunks. Every row
+draws from its own random.Random seeded by (seed, kind, row number), so a
+seed always produces the same catalog, users and orders, however the rows
+are split into chunks and spread over worker processes. Workers are forked
+and open their own database connection.
+
+Generated rows are recognisable by their keys: users are gen-user-<n>,
+product SKUs GEN-<n> and order numbers GEN<n>, which real order numbers
+(SS...) never collide with. Later chunks find earlier rows by number.
+"""
+import multiprocessing
+import random
+import time
+from array import array
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from functools import partial
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import OperationalError, connections, transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from accounts.models import Address
+from orders.models import Order, OrderItem
+from products.models import Category, Product, ProductImage, ProductVariant, Review
+
+User = get_user_model()
+
+PASSWORD = 'loadtest-password'
+CATEGORIES = ['Electronics', 'Clothing', 'Home & Garden', 'Sports & Outdoors', 'Books', 'Health & Beauty']
+ADJECTIVES = [
+    'Wireless', 'Premium', 'Organic', 'Classic', 'Portable', 'Smart', 'Vintage', 'Compact', 'Deluxe',
+    'Ergonomic', 'Waterproof', 'Lightweight', 'Stainless', 'Bamboo', 'Leather', 'Cotton', 'Ceramic',
+]
+NOUNS = [
+    'Headphones', 'Speaker', 'Kettle', 'Backpack', 'Jacket', 'Lamp', 'Watch', 'Blender', 'Mug', 'Sneakers',
+    'Keyboard', 'Mouse', 'Charger', 'Tent', 'Bottle', 'Notebook', 'Pillow', 'Blanket', 'Camera', 'Drone',
+]
+FIRST_NAMES = ['Ada', 'Ben', 'Chloe', 'Dev', 'Elena', 'Farid', 'Grace', 'Hugo', 'Iris', 'Jonas', 'Kira', 'Liam']
+LAST_NAMES = ['Ahmed', 'Brown', 'Chen', 'Dubois', 'Evans', 'Fischer', 'Garcia', 'Hughes', 'Ito', 'Jensen']
+CITIES = [('Springfield', 'IL'), ('Portland', 'OR'), ('Austin', 'TX'), ('Denver', 'CO'), ('Boston', 'MA')]
+COLORS = ['Black', 'White', 'Red', 'Blue', 'Green', 'Grey', 'Navy', 'Beige']
+SIZES = ['XS', 'S', 'M', 'L', 'XL', 'XXL']
+ORDER_STATUSES = [('delivered', 'paid'), ('shipped', 'paid'), ('confirmed', 'paid'), ('pending', 'pending'),
+                  ('cancelled', 'failed')]
+
+# Filled in by generate() before workers are forked, so they inherit it instead of receiving it per chunk
+_shared = {}
+
+
+def row_rng(seed, kind, number):
+    return random.Random(f'{seed}:{kind}:{number}')
+
+
+def chunk_range(chunk, chunk_size, total):
+    return range(chunk * chunk_size, min((chunk + 1) * chunk_size, total))
+
+
+def username(number):
+    return f'gen-user-{number:09d}'
+
+
+def product_sku(number):
+    return f'GEN-{number:09d}'
+
+
+def build_users(seed, chunk, chunk_size, total):
+    """Unsaved users of a chunk, each with the shipping address to create once it has a pk"""
+    now = timezone.now()
+    users = []
+    for number in chunk_range(chunk, chunk_size, total):
+        rng = row_rng(seed, 'users', number)
+        first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        city, state = rng.choice(CITIES)
+        user = User(
+            username=username(number), email=f'{username(number)}@example.com', password=_shared['password'],
+            first_name=first_name, last_name=last_name, date_joined=now - timedelta(days=rng.randrange(730)),
+        )
+        user.generated_address = Address(
+            title='Home', first_name=first_name, last_name=last_name,
+            address_line_1=f'{rng.randint(1, 9999)} Main St', city=city, state=state,
+            postal_code=f'{rng.randint(10000, 99999)}', country='US', is_default=True,
+        )
+        users.append(user)
+    return users
+
+
+def build_products(seed, chunk, chunk_size, total, variants):
+    """Unsaved products of a chunk, each with its variants and main image to create once it has a pk"""
+    now = timezone.now()
+    products = []
+    for number in chunk_range(chunk, chunk_size, total):
+        rng = row_rng(seed, 'products', number)
+        name = f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {number}'
+        created = now - timedelta(seconds=rng.randrange(2 * 365 * 86400))
+        price = Decimal(rng.randrange(500, 40000)) / 100
+        product = Product(
+            name=name, slug=slugify(name), description=f'{name}, generated for load testing.',
+            category_id=rng.choice(_shared['category_ids']), price=price,
+            compare_price=(price * Decimal('1.2')).quantize(Decimal('0.01')) if rng.random() < 0.2 else None,
+            sku=product_sku(number), stock_quantity=rng.choice([0, 5, 20, 100, 1000]),
+            is_active=rng.random() < 0.95, is_featured=rng.random() < 0.02, created_at=created, updated_at=created,
+        )
+        colors = (variants + 1) // 2
+        attributes = [('Color', color) for color in rng.sample(COLORS, colors)]
+        attributes += [('Size', size) for size in rng.sample(SIZES, variants - colors)]
+        product.generated_variants = [
+            ProductVariant(
+                name=attribute, value=value, sku=f'{product.sku}-{attribute}-{value}',
+                price_adjustment=rng.choice([0, 0, 0, 5]), stock_quantity=rng.choice([0, 10, 100]),
+            )
+            for attribute, value in attributes
+        ]
+        product.generated_image = ProductImage(image=f'products/generated-{number % 50}.jpg', is_main=True)
+        products.append(product)
+    return products
+
+
+def build_reviews(seed, chunk, chunk_size, total, per_product):
+    """Unsaved reviews of the products in a chunk, as (product number, review without product)"""
+    user_ids = _shared['user_ids']
+    reviews = []
+    for number in chunk_range(chunk, chunk_size, total):
+        rng = row_rng(seed, 'reviews', number)
+        count = min(len(user_ids), rng.randint(0, 2 * per_product))
+        for user_index in rng.sample(range(len(user_ids)), count):
+            rating = rng.choices([1, 2, 3, 4, 5], weights=[1, 1, 2, 4, 6])[0]
+            reviews.append((number, Review(
+                user_id=user_ids[user_index], rating=rating, title=f'{rating} stars',
+                comment='Generated review.', is_verified=rng.random() < 0.5,
+            )))
+    return reviews
+
+
+def build_orders(seed, chunk, chunk_size, total, items):
+    """Unsaved orders of a chunk, as (order, [(product number, quantity)])"""
+    user_ids = _shared['user_ids']
+    now = timezone.now()
+    orders = []
+    for number in chunk_range(chunk, chunk_size, total):
+        rng = row_rng(seed, 'orders', number)
+        user_number = rng.randrange(len(user_ids))
+        status, payment_status = rng.choice(ORDER_STATUSES)
+        created = now - timedelta(seconds=rng.randrange(365 * 86400))
+        order = Order(
+            user_id=user_ids[user_number], order_number=f'GEN{number:012d}',
+            status=status, payment_status=payment_status, billing_email=f'{username(user_number)}@example.com',
+            billing_first_name=rng.choice(FIRST_NAMES), billing_last_name=rng.choice(LAST_NAMES),
+            created_at=created, updated_at=created,
+        )
+        lines = [
+            (rng.randrange(_shared['products']), rng.randint(1, 3)) for i in range(rng.randint(1, items))
+        ]
+        orders.append((order, lines))
+    return orders
+
+
+@contextmanager
+def generated_timestamps(*models):
+    """Let bulk_create keep the created_at/updated_at values set on the objects instead of stamping now"""
+    fields = [model._meta.get_field(name) for model in models for name in ('created_at', 'updated_at')]
+    saved = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, saved):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def insert_users(seed, chunk, chunk_size, total, batch_size):
+    users = build_users(seed, chunk, chunk_size, total)
+    with transaction.atomic():
+        User.objects.bulk_create(users, batch_size=batch_size)
+        addresses = []
+        for user in users:
+            user.generated_address.user = user
+            addresses.append(user.generated_address)
+        Address.objects.bulk_create(addresses, batch_size=batch_size)
+    return len(users)
+
+
+def insert_products(seed, chunk, chunk_size, total, batch_size, variants):
+    products = build_products(seed, chunk, chunk_size, total, variants)
+    with transaction.atomic():
+        with generated_timestamps(Product):
+            Product.objects.bulk_create(products, batch_size=batch_size)
+        children = {ProductVariant: [], ProductImage: []}
+        for product in products:
+            for variant in product.generated_variants:
+                variant.product = product
+                children[ProductVariant].append(variant)
+            product.generated_image.product = product
+            children[ProductImage].append(product.generated_image)
+        for model, objects in children.items():
+            model.objects.bulk_create(objects, batch_size=batch_size)
+    return len(products)
+
+
+def insert_reviews(seed, chunk, chunk_size, total, batch_size, per_product):
+    reviews = build_reviews(seed, chunk, chunk_size, total, per_product)
+    product_ids = dict(Product.objects.filter(
+        sku__in={product_sku(number) for number, review in reviews}
+    ).values_list('sku', 'id'))
+    for number, review in reviews:
+        review.product_id = product_ids[product_sku(number)]
+    with transaction.atomic():
+        Review.objects.bulk_create([review for number, review in reviews], batch_size=batch_size)
+    return len(reviews)
+
+
+def insert_orders(seed, chunk, chunk_size, total, batch_size, items):
+    orders = build_orders(seed, chunk, chunk_size, total, items)
+    products = {
+        product['sku']: product
+        for product in Product.objects.filter(
+            sku__in={product_sku(number) for order, lines in orders for number, quantity in lines}
+        ).values('id', 'name', 'sku', 'price')
+    }
+    order_items = []
+    for order, lines in orders:
+        order.subtotal = order.total_amount = Decimal('0')
+        for number, quantity in lines:
+            product = products[product_sku(number)]
+            order_items.append(OrderItem(
+                order=order, product_id=product['id'], product_name=product['name'], product_sku=product['sku'],
+                quantity=quantity, unit_price=product['price'], total_price=product['price'] * quantity,
+            ))
+            order.subtotal += product['price'] * quantity
+        order.total_amount = order.subtotal
+    with transaction.atomic():
+        with generated_timestamps(Order):
+            Order.objects.bulk_create([order for order, lines in orders], batch_size=batch_size)
+        OrderItem.objects.bulk_create(order_items, batch_size=batch_size)
+    return len(orders)
+
+
+def run_chunks(insert, total, chunk_size, workers, **kwargs):
+    """Run insert over every chunk of total rows, in forked worker processes if workers > 1"""
+    chunks = range((total + chunk_size - 1) // chunk_size)
+    insert = partial(insert, chunk_size=chunk_size, total=total, **kwargs)
+    if workers <= 1:
+        return sum(insert(chunk=chunk) for chunk in chunks)
+    # Children must not share the parent's connection
+    connections.close_all()
+    with multiprocessing.get_context('fork').Pool(workers, initializer=connections.close_all) as pool:
+        return sum(pool.imap_unordered(_call_with_chunk, [(insert, chunk) for chunk in chunks]))
+
+
+def _call_with_chunk(args):
+    insert, chunk = args
+    while True:
+        try:
+            return insert(chunk=chunk)
+        except OperationalError:
+            # SQLite refuses a second writer instead of waiting; a chunk is one transaction, so run it again
+            time.sleep(0.05)
+
+
+def generate(users, products, variants=3, reviews=2, orders=0, items=3, seed=42, workers=1,
+             chunk_size=10_000, batch_size=2000, log=None):
+    """Generate the whole data set; returns {kind: rows created}"""
+    log = log or (lambda message: None)
+    created = {}
+    options = {'seed': seed, 'workers': workers, 'chunk_size': chunk_size, 'batch_size': batch_size}
+
+    _shared['password'] = make_password(PASSWORD)
+    _shared['category_ids'] = [Category.objects.get_or_create(name=name)[0].pk for name in CATEGORIES]
+    created['users'] = run_chunks(insert_users, users, **options)
+    log(f"users={created['users']}")
+    _shared['user_ids'] = array('q', User.objects.filter(
+        username__startswith='gen-user-',
+    ).order_by('username').values_list('id', flat=True))
+
+    created['products'] = run_chunks(insert_products, products, variants=variants, **options)
+    _shared['products'] = products
+    log(f"products={created['products']} variants={created['products'] * variants}")
+
+    created['reviews'] = run_chunks(insert_reviews, products, per_product=reviews, **options)
+    log(f"reviews={created['reviews']}")
+
+    if orders:
+        created['orders'] = run_chunks(insert_orders, orders, items=items, **options)
+        log(f"orders={created['orders']}")
+    return created
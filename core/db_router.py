@@ -0,0 +1,134 @@
+"""Send catalog and account reads of web requests to read replicas.
+
+Replicas are the aliases in DATABASE_REPLICAS; reads of models in
+READ_REPLICA_APPS are spread over the healthy ones in turn. Everything else
+stays on the primary ('default'):
+
+- writes and select_for_update (Django routes both through db_for_write)
+- reads of other apps (carts, orders, sessions), which are read to be written
+- reads inside a transaction on the primary, which must see its writes
+- requests other than GET/HEAD/OPTIONS, and the rest of a request once it
+  has written
+- requests within READ_REPLICA_PIN_SECONDS of the same browser's last write,
+  so replication lag never hides a user's own cart, order or review; the
+  ReplicaPinningMiddleware keeps this window in a cookie
+- anything outside a request (commands, Celery tasks), which mostly reads
+  rows it has just written
+
+A replica is checked at most every READ_REPLICA_HEALTH_INTERVAL seconds
+and skipped while it cannot be reached or, on PostgreSQL, while it replays
+more than READ_REPLICA_MAX_LAG seconds behind. Queries already sent to a
+replica that fails are not retried on the primary.
+"""
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+# Writes that do not make a user's next reads need the primary
+PIN_EXEMPT_APPS = {'sessions'}
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_request = ContextVar('replica_routing', default=None)
+_health = {}
+_turn = itertools.count()
+
+
+class RequestRouting:
+    """Routing state of the current request"""
+
+    def __init__(self, pinned):
+        self.pinned = pinned
+        self.wrote = False
+
+
+@contextmanager
+def request_routing(pinned=False):
+    """Let the reads inside the block use replicas unless pinned; yields the RequestRouting"""
+    state = RequestRouting(pinned)
+    token = _request.set(state)
+    try:
+        yield state
+    finally:
+        _request.reset(token)
+
+
+def check_replica(alias):
+    """Whether the replica answers and, on PostgreSQL, is not lagging too far behind"""
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # Lag counts only while there is WAL left to replay; an idle primary makes replay look old
+                cursor.execute(
+                    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                    'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+                )
+                lag = cursor.fetchone()[0]
+                if lag is not None and lag > settings.READ_REPLICA_MAX_LAG:
+                    logger.warning('Replica %s is %.1fs behind; reading from the primary', alias, lag)
+                    return False
+            else:
+                cursor.execute('SELECT 1')
+    except DatabaseError:
+        logger.warning('Replica %s is unreachable; reading from the primary', alias, exc_info=True)
+        connection.close()
+        return False
+    return True
+
+
+def healthy_replicas():
+    now = time.monotonic()
+    replicas = []
+    for alias in settings.DATABASE_REPLICAS:
+        healthy, checked_at = _health.get(alias, (False, None))
+        if checked_at is None or now - checked_at >= settings.READ_REPLICA_HEALTH_INTERVAL:
+            healthy = check_replica(alias)
+            _health[alias] = (healthy, now)
+        if healthy:
+            replicas.append(alias)
+    return replicas
+
+
+@receiver(setting_changed)
+def reset_replica_health(setting, **kwargs):
+    if setting in ('DATABASE_REPLICAS', 'READ_REPLICA_HEALTH_INTERVAL'):
+        _health.clear()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _request.get()
+        if (
+            state is None or state.pinned or state.wrote
+            or model._meta.app_label not in settings.READ_REPLICA_APPS
+            or connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            # Explicitly, or Django would follow the database a related instance was read from
+            return DEFAULT_DB_ALIAS
+        replicas = healthy_replicas()
+        if not replicas:
+            return DEFAULT_DB_ALIAS
+        return replicas[next(_turn) % len(replicas)]
+
+    def db_for_write(self, model, **hints):
+        state = _request.get()
+        if state is not None and model._meta.app_label not in PIN_EXEMPT_APPS:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        # Replicas get their schema by replication
+        return db not in settings.DATABASE_REPLICAS
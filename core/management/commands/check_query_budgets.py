@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import (
+    override_settings, setup_databases, setup_test_environment, teardown_databases, teardown_test_environment,
+)
+
+from core import query_budget
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the queries and time of every storefront route on a fresh test database and compare them '
+        'with the baseline in core/query_budgets.json'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=10, help='Measured requests per route')
+        parser.add_argument('--update', action='store_true', help='Write this run as the new baseline')
+
+    def handle(self, *args, **options):
+        # Like the test runner: never touch the real database or cache
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with override_settings(**query_budget.SETTINGS):
+                results = query_budget.measure_routes(query_budget.BASELINE_ROWS, options['repeat'])
+                growth = query_budget.measure_routes(query_budget.GROWTH_ROWS, options['repeat'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        baseline = query_budget.load_baseline()
+        for name, result in results.items():
+            budget = baseline.get(name, {'queries': '-', 'ms': 0})
+            self.stdout.write(
+                f"{name:<15} queries={result['queries']:<3} baseline={budget['queries']:<3} "
+                f"with {query_budget.GROWTH_ROWS} rows={growth[name]['queries']:<3} "
+                f"ms={result['ms']:.1f} baseline={budget['ms']:.1f}"
+            )
+
+        if options['update']:
+            query_budget.write_baseline(results)
+            self.stdout.write(self.style.SUCCESS(f'Wrote {query_budget.BASELINE_FILE}'))
+            return
+        problems = query_budget.check(baseline, results, growth)
+        for name, found in problems.items():
+            self.stdout.write(self.style.ERROR(name))
+            for problem in found:
+                self.stdout.write(f'  {problem}')
+        if problems:
+            raise CommandError(f'{len(problems)} routes over budget')
+        self.stdout.write(self.style.SUCCESS('Every route is within budget'))
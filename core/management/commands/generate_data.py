@@ -0,0 +1,54 @@
+import os
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core.datagen import generate
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Generate a large deterministic data set of users, products, variants, reviews and orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10_000)
+        parser.add_argument('--products', type=int, default=100_000)
+        parser.add_argument('--variants', type=int, default=3, help='Variants per product')
+        parser.add_argument('--reviews', type=int, default=2, help='Average reviews per product')
+        parser.add_argument('--orders', type=int, default=50_000)
+        parser.add_argument('--items', type=int, default=3, help='Most lines per order')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Processes inserting chunks; defaults to 1 on SQLite, which allows only one writer, else the CPU count',
+        )
+        parser.add_argument('--chunk-size', type=int, default=10_000, help='Rows per chunk and transaction')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Rows per INSERT')
+        parser.add_argument(
+            '--skip-derived', action='store_true',
+            help='Do not rebuild ratings, facets and the search index afterwards',
+        )
+
+    def handle(self, *args, **options):
+        if Product.objects.filter(sku__startswith='GEN-').exists():
+            raise CommandError('Generated data already exists; start from an empty database')
+        workers = options['workers']
+        if workers is None:
+            workers = 1 if connection.vendor == 'sqlite' else os.cpu_count()
+
+        started = time.perf_counter()
+        created = generate(
+            users=options['users'], products=options['products'], variants=options['variants'],
+            reviews=options['reviews'], orders=options['orders'], items=options['items'], seed=options['seed'],
+            workers=workers, chunk_size=options['chunk_size'], batch_size=options['batch_size'],
+            log=lambda message: self.stdout.write(f'{message} elapsed={time.perf_counter() - started:.1f}s'),
+        )
+        if not options['skip_derived']:
+            for command in ('backfill_ratings', 'refresh_facets', 'rebuild_search_index'):
+                call_command(command, stdout=self.stdout)
+        summary = ' '.join(f'{kind}={count}' for kind, count in created.items())
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {summary} with {workers} workers in {time.perf_counter() - started:.1f}s'
+        ))
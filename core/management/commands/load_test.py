@@ -0,0 +1,150 @@
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+from accounts.models import Address
+from products.models import Product
+from products.management.commands.benchmark_autocomplete import percentile
+from products.pagination import SORT_ORDERINGS
+
+User = get_user_model()
+
+ENDPOINTS = ('products:list', 'cart:add', 'orders:create')
+
+
+def parse_mix(value):
+    """'products:list=6,cart:add=3,orders:create=1' as {endpoint: weight}"""
+    mix = {}
+    for part in value.split(','):
+        endpoint, separator, weight = part.partition('=')
+        if endpoint not in ENDPOINTS or not weight.isdigit():
+            raise CommandError(f'Bad --mix entry {part!r}; endpoints are {", ".join(ENDPOINTS)}')
+        mix[endpoint] = int(weight)
+    return mix
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive the catalog, add-to-cart and checkout routes with concurrent signed-in clients. '
+        'Pages render with the real static files storage, so run collectstatic first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=8, help='Concurrent clients, one thread each')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per client')
+        parser.add_argument(
+            '--mix', default='products:list=6,cart:add=3,orders:create=1', help='Relative weight of each endpoint',
+        )
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        # Signed-in generated users (see generate_data), each with an address to check out with
+        users = list(
+            User.objects.filter(username__startswith='gen-user-', addresses__isnull=False)
+            .distinct().order_by('username')[:options['clients']]
+        )
+        if len(users) < options['clients']:
+            raise CommandError(f"Need {options['clients']} generated users with an address; run generate_data first")
+        product_ids = list(
+            Product.objects.filter(is_active=True, stock_quantity__gt=0)
+            .order_by('-created_at').values_list('pk', flat=True)[:10_000]
+        )
+        if not product_ids:
+            raise CommandError('No products in stock; run generate_data first')
+
+        mix = parse_mix(options['mix'])
+        latencies = defaultdict(list)
+        errors = defaultdict(int)
+        refused = defaultdict(int)
+        first_errors = {}
+        lock = threading.Lock()
+
+        def worker(number, user):
+            rng = random.Random(f"{options['seed']}:{number}")
+            # The test client's exception capture is shared between threads, so take failures as 500 responses
+            # rather than have them raised in whichever thread asks next
+            client = Client(raise_request_exception=False)
+            client.force_login(user)
+            address = Address.objects.filter(user=user).values_list('pk', flat=True).first()
+            cart_lines = 0
+            try:
+                for i in range(options['requests']):
+                    endpoint = rng.choices(list(mix), weights=list(mix.values()))[0]
+                    if endpoint == 'orders:create' and not cart_lines:
+                        # Checking out needs something in the cart
+                        endpoint = 'cart:add'
+                    started = time.perf_counter()
+                    try:
+                        response = self.request(client, endpoint, rng, product_ids, address)
+                        failed = response.status_code >= 400
+                        if failed:
+                            with lock:
+                                exc_info = getattr(response, 'exc_info', None)
+                                error = f'HTTP {response.status_code}'
+                                first_errors.setdefault(endpoint, f'{error} {exc_info[1]!r}' if exc_info else error)
+                        # Refused adds and checkouts (e.g. out of stock) are answers, not errors
+                        accepted = not failed and (endpoint == 'products:list' or response.json()['success'])
+                    except Exception as e:
+                        failed, accepted = True, False
+                        with lock:
+                            first_errors.setdefault(endpoint, repr(e))
+                    elapsed = (time.perf_counter() - started) * 1000
+                    if endpoint == 'cart:add' and accepted:
+                        cart_lines += 1
+                    elif endpoint == 'orders:create' and accepted:
+                        cart_lines = 0
+                    with lock:
+                        latencies[endpoint].append(elapsed)
+                        errors[endpoint] += failed
+                        refused[endpoint] += not failed and not accepted
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(number, user)) for number, user in enumerate(users)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        total = sum(len(values) for values in latencies.values())
+        self.stdout.write(
+            f"clients={options['clients']} requests={total} elapsed={elapsed:.1f}s "
+            f"throughput={total / elapsed:.1f} req/s"
+        )
+        for endpoint in ENDPOINTS:
+            values = sorted(latencies[endpoint])
+            if not values:
+                continue
+            self.stdout.write(
+                f'{endpoint:<14} requests={len(values)} errors={errors[endpoint]} refused={refused[endpoint]} '
+                f'throughput={len(values) / elapsed:.1f} req/s latency_ms p50={percentile(values, 0.50):.1f} '
+                f'p95={percentile(values, 0.95):.1f} p99={percentile(values, 0.99):.1f} '
+                f'mean={statistics.mean(values):.1f}'
+            )
+            if endpoint in first_errors:
+                self.stdout.write(f'  first error: {first_errors[endpoint]}')
+
+    def request(self, client, endpoint, rng, product_ids, address):
+        # secure=True: production settings redirect plain HTTP to HTTPS
+        if endpoint == 'products:list':
+            return client.get(reverse(endpoint), {'sort': rng.choice(list(SORT_ORDERINGS))}, secure=True)
+        if endpoint == 'cart:add':
+            return client.post(
+                reverse(endpoint), {'product_id': rng.choice(product_ids), 'quantity': 1},
+                secure=True, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+            )
+        return client.post(
+            reverse(endpoint),
+            {'billing_address': address, 'shipping_address': address, 'payment_method': 'stripe'},
+            secure=True,
+        )
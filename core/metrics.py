@@ -0,0 +1,254 @@
+"""Per-request database metrics in the Prometheus text format.
+
+QueryMetricsMiddleware samples a share of requests (QUERY_METRICS_SAMPLE_RATE)
+and wraps their database queries with connection.execute_wrapper to count
+them, time them and fingerprint them. Fingerprints are the SQL with
+placeholders as the ORM sends it, so the same query run for every row of a
+list (an N+1) shows up as one fingerprint repeated.
+
+Samples are added to counters and histograms per view. With
+QUERY_METRICS_REDIS_URL set, every process flushes them into one Redis hash
+at most every QUERY_METRICS_FLUSH_INTERVAL seconds, so /metrics reports all
+workers together; otherwise each process keeps and reports its own.
+Payment gateway connection counts from orders.gateway are kept the same way.
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'shopstreet'
+REDIS_KEY = 'query-metrics'
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+METRICS = {
+    'requests_sampled_total': ('counter', 'Requests whose database queries were recorded'),
+    'db_queries_total': ('counter', 'Database queries run by sampled requests'),
+    'db_duration_seconds_total': ('counter', 'Time sampled requests spent in the database'),
+    'db_duplicate_queries_total': ('counter', 'Queries of sampled requests repeating an earlier query of the same request'),
+    'db_duplicate_fingerprint_total': ('counter', 'Repeats of each duplicated query fingerprint; SQL in the comments below'),
+    'db_queries_per_request': ('histogram', 'Database queries per sampled request'),
+    'request_duration_seconds': ('histogram', 'Duration of sampled requests'),
+    'payment_gateway_requests_total': ('counter', 'Requests sent to the payment gateway (orders.gateway)'),
+    'payment_gateway_new_connections_total': ('counter', 'Payment gateway requests that had to open a connection'),
+}
+
+_IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+_store = None
+
+
+def fingerprint(sql):
+    """(short hash, normalised SQL) of a query; IN lists of any length look alike"""
+    normalised = _IN_LIST.sub('IN (...)', sql)
+    return hashlib.sha1(normalised.encode()).hexdigest()[:12], normalised
+
+
+def _series(name, **labels):
+    label_text = ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return f'{PREFIX}_{name}{{{label_text}}}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+class QueryRecorder:
+    """execute_wrapper that records every query of one request"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+        self.statements = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            key, normalised = fingerprint(sql)
+            self.fingerprints[key] += 1
+            self.statements.setdefault(key, normalised)
+
+    def duplicates(self):
+        """{fingerprint: repeats beyond the first run} of the queries run more than once"""
+        return {key: count - 1 for key, count in self.fingerprints.items() if count > 1}
+
+
+@contextmanager
+def recording_queries():
+    """Record the queries run on every database connection inside the block"""
+    recorder = QueryRecorder()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        yield recorder
+
+
+class MetricsStore:
+    """Accumulates series values in this process until they are flushed to the shared store"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = defaultdict(float)
+        self.statements = {}
+
+    def add(self, deltas, statements):
+        with self.lock:
+            for series, value in deltas.items():
+                self.values[series] += value
+            for key, sql in statements.items():
+                self.statements.setdefault(key, sql)
+
+    def snapshot(self):
+        """({series: value}, {fingerprint: SQL})"""
+        with self.lock:
+            return dict(self.values), dict(self.statements)
+
+
+class RedisMetricsStore(MetricsStore):
+    """Adds up the samples of every process in one Redis hash"""
+
+    def __init__(self, url, flush_interval):
+        super().__init__()
+        self.redis = redis.Redis.from_url(url)
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+
+    def add(self, deltas, statements):
+        super().add(deltas, statements)
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            values, statements = self.values, self.statements
+            self.values, self.statements = defaultdict(float), {}
+            self.last_flush = time.monotonic()
+        if not values:
+            return
+        try:
+            with self.redis.pipeline(transaction=False) as pipe:
+                for series, value in values.items():
+                    pipe.hincrbyfloat(REDIS_KEY, series, value)
+                for key, sql in statements.items():
+                    pipe.hsetnx(REDIS_KEY, f'sql:{key}', sql)
+                pipe.execute()
+        except redis.RedisError:
+            # Metrics must never fail a request; these samples are simply lost
+            logger.warning('Could not flush query metrics to Redis', exc_info=True)
+
+    def snapshot(self):
+        self.flush()
+        values, statements = {}, {}
+        for field, value in self.redis.hgetall(REDIS_KEY).items():
+            field, value = field.decode(), value.decode()
+            if field.startswith('sql:'):
+                statements[field[4:]] = value
+            else:
+                values[field] = float(value)
+        return values, statements
+
+
+def get_metrics_store():
+    global _store
+    if _store is None:
+        if settings.QUERY_METRICS_REDIS_URL:
+            _store = RedisMetricsStore(settings.QUERY_METRICS_REDIS_URL, settings.QUERY_METRICS_FLUSH_INTERVAL)
+        else:
+            _store = MetricsStore()
+    return _store
+
+
+@receiver(setting_changed)
+def reset_metrics_store(setting, **kwargs):
+    global _store
+    if setting in ('QUERY_METRICS_REDIS_URL', 'QUERY_METRICS_FLUSH_INTERVAL'):
+        _store = None
+
+
+def increment(name, value=1):
+    """Add to one of the unlabelled counters in METRICS, e.g. from code outside requests"""
+    get_metrics_store().add({f'{PREFIX}_{name}{{}}': value}, {})
+
+
+def _observe(deltas, name, value, buckets, view):
+    for bound in buckets:
+        if value <= bound:
+            deltas[_series(f'{name}_bucket', view=view, le=bound)] += 1
+    deltas[_series(f'{name}_bucket', view=view, le='+Inf')] += 1
+    deltas[_series(f'{name}_sum', view=view)] += value
+    deltas[_series(f'{name}_count', view=view)] += 1
+
+
+def record_request(view, recorder, duration):
+    """Add one sampled request to the metrics"""
+    duplicates = recorder.duplicates()
+    deltas = defaultdict(float)
+    deltas[_series('requests_sampled_total', view=view)] += 1
+    deltas[_series('db_queries_total', view=view)] += recorder.count
+    deltas[_series('db_duration_seconds_total', view=view)] += recorder.duration
+    deltas[_series('db_duplicate_queries_total', view=view)] += sum(duplicates.values())
+    for key, repeats in duplicates.items():
+        deltas[_series('db_duplicate_fingerprint_total', view=view, fingerprint=key)] += repeats
+    _observe(deltas, 'db_queries_per_request', recorder.count, QUERY_BUCKETS, view)
+    _observe(deltas, 'request_duration_seconds', duration, DURATION_BUCKETS, view)
+    get_metrics_store().add(deltas, {key: recorder.statements[key] for key in duplicates})
+
+    worst = max(duplicates.items(), key=lambda item: item[1], default=None)
+    if worst and worst[1] + 1 >= settings.QUERY_METRICS_DUPLICATE_WARNING:
+        logger.warning(
+            '%s ran the same query %d times (%d queries, %.1f ms in the database): %s',
+            view, worst[1] + 1, recorder.count, recorder.duration * 1000, recorder.statements[worst[0]],
+        )
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    values, statements = get_metrics_store().snapshot()
+    by_metric = defaultdict(list)
+    for series, value in values.items():
+        name = series[len(PREFIX) + 1:series.index('{')]
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                name = name[:-len(suffix)]
+        by_metric[name].append((series, value))
+
+    lines = [
+        f'# HELP {PREFIX}_query_metrics_sample_rate Share of requests whose queries are recorded',
+        f'# TYPE {PREFIX}_query_metrics_sample_rate gauge',
+        f'{PREFIX}_query_metrics_sample_rate {settings.QUERY_METRICS_SAMPLE_RATE}',
+    ]
+    for name, (kind, help_text) in METRICS.items():
+        if name not in by_metric:
+            continue
+        lines.append(f'# HELP {PREFIX}_{name} {help_text}')
+        lines.append(f'# TYPE {PREFIX}_{name} {kind}')
+        lines.extend(f"{series.removesuffix('{}')} {value:g}" for series, value in sorted(by_metric[name]))
+        if name == 'db_duplicate_fingerprint_total':
+            lines.extend(f'# fingerprint {key}: {sql}' for key, sql in sorted(statements.items()))
+
+    requests = values.get(f'{PREFIX}_payment_gateway_requests_total{{}}', 0)
+    if requests:
+        new_connections = values.get(f'{PREFIX}_payment_gateway_new_connections_total{{}}', 0)
+        lines += [
+            f'# HELP {PREFIX}_payment_gateway_connection_reuse_ratio Share of gateway requests on a pooled connection',
+            f'# TYPE {PREFIX}_payment_gateway_connection_reuse_ratio gauge',
+            f'{PREFIX}_payment_gateway_connection_reuse_ratio {(requests - new_connections) / requests:g}',
+        ]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,58 @@
+import random
+import time
+
+from django.conf import settings
+
+from .db_router import SAFE_METHODS, request_routing
+from .metrics import record_request, recording_queries
+
+
+class QueryMetricsMiddleware:
+    """Record the database queries of a sample of requests (see core.metrics)"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # Unsampled requests pay for one random() call and nothing else
+        if random.random() >= settings.QUERY_METRICS_SAMPLE_RATE:
+            return self.get_response(request)
+
+        started = time.perf_counter()
+        with recording_queries() as recorder:
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        record_request(view, recorder, duration)
+        response['Server-Timing'] = (
+            f'db;dur={recorder.duration * 1000:.1f};desc="{recorder.count} queries", '
+            f'app;dur={duration * 1000:.1f}'
+        )
+        return response
+
+
+class ReplicaPinningMiddleware:
+    """Route the request's reads with core.db_router, pinning a browser to the primary after it writes"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        now = time.time()
+        try:
+            pinned_until = float(request.COOKIES.get(settings.READ_REPLICA_PIN_COOKIE, 0))
+        except ValueError:
+            pinned_until = 0
+        # A forged far-off expiry would only cost the primary some reads, but is ignored anyway
+        pinned = now < pinned_until <= now + settings.READ_REPLICA_PIN_SECONDS
+        with request_routing(pinned or request.method not in SAFE_METHODS) as routing:
+            response = self.get_response(request)
+        if routing.wrote:
+            response.set_cookie(
+                settings.READ_REPLICA_PIN_COOKIE, f'{now + settings.READ_REPLICA_PIN_SECONDS:.3f}',
+                max_age=settings.READ_REPLICA_PIN_SECONDS, secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True, samesite='Lax',
+            )
+        return response
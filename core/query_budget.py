@@ -0,0 +1,176 @@
+"""Query-count and wall-time budgets for the storefront's pages.
+
+seed() fills the database through core.datagen so that every list a page
+renders (products, reviews, cart lines, orders, order items, wishlist,
+vendors) has about `rows` entries. measure_routes() requests every route in
+ROUTES a few times and records its queries and median time.
+
+query_budgets.json holds the baseline: the queries and milliseconds each
+route took at BASELINE_ROWS. A route may not run more queries than its
+baseline, nor take longer than time_budget() of it. Since a page that runs
+a query per row only shows it once there are more rows, routes are also
+measured at GROWTH_ROWS, where they must run exactly as many queries.
+
+core.tests.QueryBudgetTests enforces the budgets; the check_query_budgets
+command compares a run with the baseline and rewrites it with --update.
+"""
+import json
+import statistics
+import time
+from io import StringIO
+from pathlib import Path
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models import Count
+from django.test import Client
+from django.urls import reverse
+
+from cart.models import Wishlist, WishlistItem
+from cart.storage import get_cart_storage
+from products.models import Category, Product
+from vendors.models import Vendor
+
+from . import datagen
+from .metrics import recording_queries
+
+User = get_user_model()
+
+BASELINE_FILE = Path(__file__).with_name('query_budgets.json')
+BASELINE_ROWS = 2
+GROWTH_ROWS = 5
+
+# Pages render with plain static files and a private cache, which is cleared before every request so cached
+# pages are measured on a miss
+SETTINGS = {
+    'SECURE_SSL_REDIRECT': False,
+    'STATICFILES_STORAGE': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'query-budget'}},
+}
+
+# (name, signed in, URL of the seeded fixture)
+ROUTES = [
+    ('home', False, lambda fixture: reverse('core:home')),
+    ('product list', False, lambda fixture: reverse('products:list')),
+    ('category', False, lambda fixture: reverse('products:category', args=[fixture['category'].slug])),
+    ('product detail', False, lambda fixture: reverse('products:detail', args=[fixture['product'].slug])),
+    ('search', False, lambda fixture: reverse('core:search') + '?q=generated'),
+    ('cart', True, lambda fixture: reverse('cart:detail')),
+    ('checkout', True, lambda fixture: reverse('orders:checkout')),
+    ('order list', True, lambda fixture: reverse('orders:list')),
+    ('order detail', True, lambda fixture: reverse('orders:detail', args=[fixture['order'].pk])),
+    ('invoice', True, lambda fixture: reverse('orders:invoice', args=[fixture['order'].pk])),
+    ('wishlist', True, lambda fixture: reverse('cart:wishlist')),
+    ('vendor list', False, lambda fixture: reverse('vendors:list')),
+]
+
+
+def time_budget(baseline_ms):
+    """Slowest a route may get: generous enough for slower machines, not for work per row"""
+    return max(baseline_ms * 5, baseline_ms + 100)
+
+
+def seed(rows):
+    """The data the routes are measured on; returns the objects their URLs point at"""
+    datagen.generate(
+        users=rows, products=2 * rows, variants=3, reviews=rows, orders=rows * rows, items=rows, seed=7,
+    )
+    # One category, so the category page and related products grow with rows too
+    Product.objects.update(is_active=True, category=Category.objects.order_by('pk')[0])
+    products = list(Product.objects.order_by('sku'))
+    Product.objects.filter(pk__in=[product.pk for product in products[:rows]]).update(is_featured=True)
+    for command in ('backfill_ratings', 'refresh_facets', 'rebuild_search_index'):
+        call_command(command, stdout=StringIO())
+
+    user = User.objects.annotate(orders_count=Count('orders')).order_by('-orders_count', 'pk')[0]
+    storage = get_cart_storage()
+    for number, product in enumerate(products[:rows]):
+        variant = product.variants.order_by('pk').first() if number % 2 else None
+        storage.add(f'user:{user.pk}', product.pk, variant and variant.pk, 1)
+    wishlist = Wishlist.objects.create(user=user)
+    WishlistItem.objects.bulk_create([WishlistItem(wishlist=wishlist, product=product) for product in products[:rows]])
+    for number in range(rows):
+        vendor_user = User.objects.create(username=f'budget-vendor-{number}', email=f'budget-vendor-{number}@example.com')
+        Vendor.objects.create(user=vendor_user, business_name=f'Vendor {number}')
+
+    return {
+        'user': user,
+        'category': products[0].category,
+        'product': Product.objects.annotate(reviews_count=Count('reviews')).order_by('-reviews_count', 'pk')[0],
+        'order': user.orders.annotate(items_count=Count('items')).order_by('-items_count', 'pk')[0],
+    }
+
+
+def measure_routes(rows, repeat=5):
+    """{route: {'queries': most queries of a request, 'ms': median time, 'repeated': {SQL: runs}}}
+
+    The data is seeded in a transaction that is rolled back afterwards.
+    """
+    results = {}
+    with transaction.atomic():
+        fixture = seed(rows)
+        anonymous, signed_in = Client(), Client()
+        signed_in.force_login(fixture['user'])
+        for name, login, url in ROUTES:
+            client = signed_in if login else anonymous
+            path = url(fixture)
+            queries, times, repeated = 0, [], {}
+            # The first request warms up templates and per-process caches
+            for i in range(repeat + 1):
+                cache.clear()
+                started = time.perf_counter()
+                with recording_queries() as recorder:
+                    response = client.get(path, secure=True)
+                elapsed = (time.perf_counter() - started) * 1000
+                if response.status_code != 200:
+                    raise AssertionError(f'{name}: {path} answered {response.status_code}')
+                if i:
+                    times.append(elapsed)
+                    queries = max(queries, recorder.count)
+                    repeated = {
+                        recorder.statements[key]: count + 1 for key, count in recorder.duplicates().items()
+                    }
+            results[name] = {'queries': queries, 'ms': statistics.median(times), 'repeated': repeated}
+        transaction.set_rollback(True)
+    return results
+
+
+def load_baseline():
+    """{route: {'queries': ..., 'ms': ...}}"""
+    if not BASELINE_FILE.exists():
+        return {}
+    return json.loads(BASELINE_FILE.read_text())['routes']
+
+
+def write_baseline(results):
+    routes = {
+        name: {'queries': result['queries'], 'ms': round(result['ms'], 1)} for name, result in results.items()
+    }
+    BASELINE_FILE.write_text(json.dumps({'rows': BASELINE_ROWS, 'routes': routes}, indent=2) + '\n')
+
+
+def check(baseline, results, growth=None):
+    """Why each route is over its budget, as {route: [problems]}; routes within budget are left out"""
+    problems = {}
+    for name, result in results.items():
+        found = []
+        budget = baseline.get(name)
+        if budget is None:
+            found.append('no baseline; run check_query_budgets --update')
+        else:
+            if result['queries'] > budget['queries']:
+                found.append(f"{result['queries']} queries, budget {budget['queries']}")
+            if result['ms'] > time_budget(budget['ms']):
+                found.append(f"{result['ms']:.1f} ms, budget {time_budget(budget['ms']):.1f} ms")
+        if growth and growth[name]['queries'] != result['queries']:
+            found.append(
+                f"{growth[name]['queries']} queries with {GROWTH_ROWS} rows instead of {result['queries']}"
+                f" with {BASELINE_ROWS}: a query per row"
+            )
+        if found:
+            repeated = (growth or results)[name]['repeated']
+            found.extend(f'ran {count} times: {sql}' for sql, count in repeated.items())
+            problems[name] = found
+    return problems
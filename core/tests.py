@@ -1,3 +1,311 @@
-from django.test import TestCase
+import time
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from orders.models import Order
+from products.models import Category, Product, ProductImage, ProductVariant, Review
+from . import datagen, query_budget
+from .db_router import request_routing
+from .metrics import QueryRecorder, fingerprint, record_request
+from .cache import PRODUCTS, cache_version, invalidate_tags
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class CatalogCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Outdoor')
+        cls.product = Product.objects.create(
+            name='Tent', description='Two person tent', category=cls.category,
+            price='120.00', sku='TNT-1', is_featured=True,
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_anonymous_pages_are_served_from_cache(self):
+        for url in (reverse('core:home'), reverse('products:list'),
+                    reverse('products:category', args=[self.category.slug])):
+            first = self.client.get(url)
+            self.assertEqual(first['X-Page-Cache'], 'miss')
+            with self.assertNumQueries(0):
+                second = self.client.get(url)
+            self.assertEqual(second['X-Page-Cache'], 'hit')
+            self.assertEqual(second.content, first.content)
+
+    def test_query_string_is_part_of_the_key(self):
+        url = reverse('products:list')
+        self.client.get(url, {'sort': 'price', 'min_price': '10'})
+        self.assertEqual(self.client.get(url, {'min_price': '10', 'sort': 'price'})['X-Page-Cache'], 'hit')
+        self.assertEqual(self.client.get(url, {'sort': '-price'})['X-Page-Cache'], 'miss')
+
+    def test_price_change_invalidates_cached_pages(self):
+        url = reverse('core:home')
+        self.assertContains(self.client.get(url), '120.00')
+        self.product.price = '99.00'
+        self.product.save()
+        response = self.client.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, '99.00')
+        self.assertNotContains(response, '120.00')
+
+    def test_image_and_category_changes_invalidate(self):
+        version = cache_version(PRODUCTS)
+        ProductImage.objects.create(product=self.product, image='products/tent.jpg', is_main=True)
+        self.assertNotEqual(cache_version(PRODUCTS), version)
+        version = cache_version(PRODUCTS)
+        self.category.name = 'Camping'
+        self.category.save()
+        self.assertNotEqual(cache_version(PRODUCTS), version)
+
+    def test_authenticated_users_get_cached_fragments_only(self):
+        user = get_user_model().objects.create_user(
+            username='camper', email='camper@example.com', password='password',
+        )
+        self.client.force_login(user)
+        url = reverse('core:home')
+        self.assertNotIn('X-Page-Cache', self.client.get(url))
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        # Only session and user queries: the catalog grids come from cached fragments
+        self.assertFalse(any('products_' in query['sql'] for query in ctx.captured_queries))
+        self.assertContains(response, 'Tent')
+        invalidate_tags(PRODUCTS)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(url)
+        self.assertTrue(any('products_product' in query['sql'] for query in ctx.captured_queries))
+
+
+class DataGeneratorTests(TestCase):
+    def test_rows_depend_on_seed_not_on_chunking(self):
+        datagen._shared['category_ids'] = [1, 2, 3]
+
+        def rows(seed, chunk_size):
+            products = []
+            for chunk in range((10 + chunk_size - 1) // chunk_size):
+                products += datagen.build_products(seed, chunk, chunk_size, 10, variants=2)
+            return [(p.sku, p.name, p.price, p.category_id, [v.sku for v in p.generated_variants]) for p in products]
+
+        self.assertEqual(rows(7, 10), rows(7, 3))
+        self.assertNotEqual(rows(7, 10), rows(8, 10))
+
+    def test_generate(self):
+        created = datagen.generate(users=5, products=20, variants=2, reviews=1, orders=6, chunk_size=7)
+        self.assertEqual(created['users'], 5)
+        self.assertEqual(Product.objects.filter(sku__startswith='GEN-').count(), 20)
+        self.assertEqual(ProductVariant.objects.count(), 40)
+        self.assertEqual(Review.objects.count(), created['reviews'])
+        self.assertEqual(get_user_model().objects.filter(addresses__isnull=False).count(), 5)
+        for order in Order.objects.prefetch_related('items'):
+            self.assertTrue(order.order_number.startswith('GEN'))
+            self.assertEqual(order.total_amount, sum(item.total_price for item in order.items.all()))
+        self.assertGreater(len(set(Product.objects.values_list('created_at', flat=True))), 1)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class LoadTestCommandTests(TransactionTestCase):
+    def test_drives_every_endpoint(self):
+        call_command('generate_data', users=3, products=30, orders=0, skip_derived=True, stdout=StringIO())
+        out = StringIO()
+        # One client: the in-memory SQLite test database fails concurrent writers instead of making them wait
+        call_command('load_test', clients=1, requests=30, mix='products:list=1,cart:add=1,orders:create=1', stdout=out)
+        report = out.getvalue()
+        for endpoint in ('products:list', 'cart:add', 'orders:create'):
+            self.assertRegex(report, rf'{endpoint} +requests=\d+ errors=0 ')
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    QUERY_METRICS_SAMPLE_RATE=1.0,
+    QUERY_METRICS_REDIS_URL='',
+    METRICS_TOKEN='scrape-token',
+)
+class QueryMetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Outdoor')
+        Product.objects.create(name='Tent', description='Tent', category=category, price='120.00', sku='TNT-1')
+
+    def setUp(self):
+        cache.clear()
+        # A fresh in-process store for each test
+        patcher = mock.patch('core.metrics._store', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def scrape(self):
+        response = self.client.get(reverse('core:metrics'), HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_sampled_request_gets_server_timing_and_metrics(self):
+        response = self.client.get(reverse('products:list'))
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", app;dur=[\d.]+$')
+        metrics = self.scrape()
+        self.assertIn('shopstreet_requests_sampled_total{view="products:list"} 1', metrics)
+        self.assertIn('# TYPE shopstreet_db_queries_per_request histogram', metrics)
+        self.assertIn('shopstreet_db_queries_per_request_count{view="products:list"} 1', metrics)
+        queries = int(response['Server-Timing'].split('desc="')[1].split(' ')[0])
+        self.assertIn(f'shopstreet_db_queries_total{{view="products:list"}} {queries}', metrics)
+
+    @override_settings(QUERY_METRICS_SAMPLE_RATE=0.0)
+    def test_unsampled_request_is_not_recorded(self):
+        response = self.client.get(reverse('products:list'))
+        self.assertNotIn('Server-Timing', response)
+        self.assertNotIn('requests_sampled_total{view="products:list"}', self.scrape())
+
+    def test_repeated_queries_are_reported_with_their_sql(self):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            for product in Product.objects.all():
+                for i in range(3):
+                    Category.objects.get(pk=product.category_id)
+            list(Product.objects.filter(pk__in=[1, 2]))
+            list(Product.objects.filter(pk__in=[1, 2, 3]))
+        self.assertEqual(recorder.count, 6)
+        self.assertEqual(sorted(recorder.duplicates().values()), [1, 2])
+        with self.assertLogs('core.metrics', 'WARNING'):
+            with self.settings(QUERY_METRICS_DUPLICATE_WARNING=3):
+                record_request('products:detail', recorder, 0.01)
+        metrics = self.scrape()
+        self.assertIn('shopstreet_db_duplicate_queries_total{view="products:detail"} 3', metrics)
+        self.assertRegex(metrics, r'# fingerprint \w{12}: SELECT .* IN \(\.\.\.\)')
+
+    def test_fingerprint_ignores_in_list_length(self):
+        self.assertEqual(fingerprint('SELECT 1 WHERE id IN (%s, %s)'), fingerprint('SELECT 1 WHERE id IN (%s)'))
+        self.assertNotEqual(fingerprint('SELECT 1 WHERE id = %s'), fingerprint('SELECT 2 WHERE id = %s'))
+
+    def test_metrics_need_the_token(self):
+        self.assertEqual(self.client.get(reverse('core:metrics')).status_code, 401)
+        response = self.client.get(reverse('core:metrics'), HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 401)
+        with self.settings(METRICS_TOKEN=''):
+            response = self.client.get(reverse('core:metrics'), HTTP_AUTHORIZATION='Bearer scrape-token')
+            self.assertEqual(response.status_code, 404)
+
+
+@override_settings(**query_budget.SETTINGS)
+class QueryBudgetTests(TestCase):
+    def test_every_route_stays_within_its_budget(self):
+        baseline = query_budget.load_baseline()
+        self.assertEqual(set(baseline), {name for name, login, url in query_budget.ROUTES})
+        results = query_budget.measure_routes(query_budget.BASELINE_ROWS, repeat=3)
+        growth = query_budget.measure_routes(query_budget.GROWTH_ROWS, repeat=1)
+        problems = query_budget.check(baseline, results, growth)
+        self.assertFalse(problems, '\n'.join(
+            f'{name}: ' + '\n  '.join(found) for name, found in problems.items()
+        ))
+
+    def test_query_per_row_is_reported(self):
+        results = {'order list': {'queries': 7, 'ms': 10.0, 'repeated': {}}}
+        growth = {'order list': {'queries': 12, 'ms': 10.0, 'repeated': {'SELECT ... WHERE order_id = %s': 5}}}
+        problems = query_budget.check({'order list': {'queries': 7, 'ms': 10.0}}, results, growth)
+        self.assertIn('a query per row', problems['order list'][0])
+        self.assertEqual(problems['order list'][1], 'ran 5 times: SELECT ... WHERE order_id = %s')
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    DATABASE_REPLICAS=['replica'],
+)
+class ReplicaRoutingTests(TransactionTestCase):
+    """A second connection to the test database stands in for a replica"""
+
+    def setUp(self):
+        connections.settings['replica'] = dict(connections['default'].settings_dict)
+        self.addCleanup(self.remove_replica)
+        cache.clear()
+        category = Category.objects.create(name='Outdoor')
+        self.product = Product.objects.create(
+            name='Tent', description='Tent', category=category, price='120.00', sku='TNT-1', stock_quantity=5,
+        )
+
+    def remove_replica(self):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+
+    def product_queries(self, queries):
+        return [query for query in queries if 'products_product' in query['sql']]
+
+    def get_list(self):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            self.assertEqual(self.client.get(reverse('products:list')).status_code, 200)
+        cache.clear()
+        return self.product_queries(primary), self.product_queries(replica)
+
+    def test_catalog_reads_go_to_the_replica_until_the_browser_writes(self):
+        primary, replica = self.get_list()
+        self.assertFalse(primary)
+        self.assertTrue(replica)
+        self.assertNotIn('primary_pin', self.client.cookies)
+
+        response = self.client.post(reverse('cart:add'), {'product_id': self.product.pk, 'quantity': 1})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('primary_pin', response.cookies)
+        primary, replica = self.get_list()
+        self.assertTrue(primary)
+        self.assertFalse(replica)
+
+        # Once the window is over (or for a forged expiry) reads go back to the replica
+        for pinned_until in (time.time() - 1, time.time() + 3600):
+            self.client.cookies['primary_pin'] = f'{pinned_until:.3f}'
+            primary, replica = self.get_list()
+            self.assertFalse(primary)
+            self.assertTrue(replica)
+
+    def test_writes_locks_transactions_and_other_apps_use_the_primary(self):
+        with request_routing() as routing:
+            self.assertEqual(Product.objects.all().db, 'replica')
+            self.assertEqual(Order.objects.all().db, 'default')
+            with transaction.atomic():
+                self.assertEqual(Product.objects.all().db, 'default')
+            self.assertFalse(routing.wrote)
+            self.product.save()
+            self.assertTrue(routing.wrote)
+            self.assertEqual(Product.objects.all().db, 'default')
+        with request_routing() as routing:
+            # Locking reads are taken as the start of a write
+            self.assertEqual(Product.objects.select_for_update().db, 'default')
+            self.assertTrue(routing.wrote)
+        with request_routing(pinned=True):
+            self.assertEqual(Product.objects.all().db, 'default')
+        # Outside a request
+        self.assertEqual(Product.objects.all().db, 'default')
+
+    @override_settings(DATABASE_REPLICAS=['replica', 'replica_2'], READ_REPLICA_HEALTH_INTERVAL=60)
+    def test_round_robin_over_healthy_replicas(self):
+        with mock.patch('core.db_router.check_replica', side_effect=lambda alias: True) as check:
+            with request_routing():
+                used = {Product.objects.all().db for i in range(4)}
+        self.assertEqual(used, {'replica', 'replica_2'})
+        self.assertEqual(check.call_count, 2)
+
+        with mock.patch('core.db_router.check_replica', side_effect=lambda alias: alias == 'replica_2'):
+            with self.settings(READ_REPLICA_HEALTH_INTERVAL=0):
+                with request_routing():
+                    self.assertEqual({Product.objects.all().db for i in range(4)}, {'replica_2'})
+
+    @override_settings(DATABASE_REPLICAS=['replica_down'])
+    def test_unreachable_replica_falls_back_to_the_primary(self):
+        connections.settings['replica_down'] = {
+            **connections['default'].settings_dict, 'NAME': '/nonexistent/replica.sqlite3',
+        }
+        self.addCleanup(connections.settings.pop, 'replica_down')
+        with self.assertLogs('core.db_router', 'WARNING'):
+            with request_routing():
+                self.assertEqual(Product.objects.all().db, 'default')
@@ -8,4 +8,6 @@ urlpatterns = [
     path('about/', views.AboutView.as_view(), name='about'),
     path('contact/', views.ContactView.as_view(), name='contact'),
     path('search/', views.SearchView.as_view(), name='search'),
+    path('search/autocomplete/', views.AutocompleteView.as_view(), name='autocomplete'),
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
 ]
\ No newline at end of file
@@ -1,16 +1,26 @@
 from django.shortcuts import render
-from django.views.generic import TemplateView
-from django.db.models import Q
+from django.views.generic import TemplateView, View
+from django.http import Http404, HttpResponse, JsonResponse
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
 from products.models import Product, Category
+from products.search import get_search_backend
+from products.search_index import get_product_index
+from .cache import CATEGORIES, PRODUCTS, CachedPageMixin, cache_version
+from .metrics import render_metrics
 
-class HomeView(TemplateView):
+class HomeView(CachedPageMixin, TemplateView):
     template_name = 'core/home.html'
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['featured_products'] = Product.objects.filter(is_featured=True, is_active=True)[:8]
+        # The querysets below stay lazy, so cached fragments skip their queries
+        context['catalog_cache_timeout'] = settings.CATALOG_CACHE_TIMEOUT
+        context['products_cache_version'] = cache_version(PRODUCTS)
+        context['categories_cache_version'] = cache_version(CATEGORIES)
+        context['featured_products'] = Product.objects.filter(is_featured=True, is_active=True).with_main_image()[:8]
         context['categories'] = Category.objects.filter(is_active=True)[:6]
-        context['latest_products'] = Product.objects.filter(is_active=True).order_by('-created_at')[:8]
+        context['latest_products'] = Product.objects.filter(is_active=True).order_by('-created_at').with_main_image()[:8]
         return context
 
 class AboutView(TemplateView):
@@ -27,16 +37,41 @@ class SearchView(TemplateView):
         query = self.request.GET.get('q', '')
         
         if query:
-            products = Product.objects.filter(
-                Q(name__icontains=query) | 
-                Q(description__icontains=query) |
-                Q(category__name__icontains=query),
-                is_active=True
-            ).distinct()
+            products = list(
+                get_search_backend().search(query).select_related('category').with_main_image()
+            )
         else:
-            products = Product.objects.none()
+            products = []
         
         context['products'] = products
         context['query'] = query
-        context['total_results'] = products.count()
-        return context
\ No newline at end of file
+        context['total_results'] = len(products)
+        return context
+
+class AutocompleteView(View):
+    """Typeahead results served from the in-memory product index"""
+    
+    def get(self, request):
+        query = request.GET.get('q', '')
+        try:
+            limit = min(int(request.GET.get('limit', 8)), 20)
+        except ValueError:
+            limit = 8
+        
+        index = get_product_index()
+        return JsonResponse({
+            'query': query,
+            'results': index.search(query, limit=limit),
+            'suggestions': index.suggest(query, limit=limit),
+        })
+
+class MetricsView(View):
+    """Query metrics for Prometheus, for scrapers sending the METRICS_TOKEN bearer token"""
+    
+    def get(self, request):
+        if not settings.METRICS_TOKEN:
+            raise Http404
+        token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not constant_time_compare(token, settings.METRICS_TOKEN):
+            return HttpResponse(status=401, headers={'WWW-Authenticate': 'Bearer'})
+        return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Order, OrderItem, Payment, Coupon
+from .models import Order, OrderItem, Payment, Coupon, StockReservation, OutboxMessage, WebhookEvent
 
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
@@ -55,4 +55,25 @@ class CouponAdmin(admin.ModelAdmin):
     list_display = ('code', 'discount_type', 'discount_value', 'usage_limit', 'used_count', 'is_active', 'valid_until')
     list_filter = ('discount_type', 'is_active', 'valid_from', 'valid_until')
     search_fields = ('code',)
-    readonly_fields = ('used_count', 'created_at')
\ No newline at end of file
+    readonly_fields = ('used_count', 'created_at')
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ('order', 'product', 'variant', 'quantity', 'status', 'expires_at')
+    list_filter = ('status', 'expires_at')
+    search_fields = ('order__order_number', 'product__name', 'product__sku')
+    readonly_fields = ('created_at',)
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('topic', 'idempotency_key', 'status', 'attempts', 'available_at', 'created_at')
+    list_filter = ('topic', 'status')
+    search_fields = ('idempotency_key',)
+    readonly_fields = ('created_at', 'processed_at')
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('event_type', 'event_id', 'status', 'received_at', 'processed_at')
+    list_filter = ('event_type', 'status')
+    search_fields = ('event_id',)
+    readonly_fields = ('received_at', 'processed_at')
@@ -0,0 +1,135 @@
+"""Shared HTTP client for calls to the payment gateway.
+
+The Stripe library opens connections through whatever HTTP client it is
+given; left to itself it creates a session per thread with default pool
+sizes and an 80 second timeout. configure() installs one pooled keep-alive
+session per process instead, so intent creation, refunds and webhook
+follow-ups all reuse warm TLS connections. Connection failures are retried
+with backoff by urllib3 before anything is sent; once a request is out,
+Stripe's own retries (STRIPE_MAX_NETWORK_RETRIES) resend it with the same
+idempotency key.
+
+pool_stats() reports how many requests found a connection waiting in the
+pool and how many had to open a new one; the same counts are exported on
+/metrics (see core.metrics).
+"""
+import os
+import threading
+
+from django.conf import settings
+
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from core import metrics
+
+_stats_lock = threading.Lock()
+_stats = {'requests': 0, 'new_connections': 0}
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+    metrics.increment(f'payment_gateway_{name}_total')
+
+
+class MeteredPoolMixin:
+    """Counts connections taken from the pool and connections opened for lack of an idle one"""
+
+    def _get_conn(self, timeout=None):
+        _count('requests')
+        return super()._get_conn(timeout)
+
+    def _new_conn(self):
+        _count('new_connections')
+        return super()._new_conn()
+
+
+class MeteredHTTPConnectionPool(MeteredPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class MeteredHTTPSConnectionPool(MeteredPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class MeteredHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': MeteredHTTPConnectionPool,
+            'https': MeteredHTTPSConnectionPool,
+        }
+
+
+def build_session():
+    retries = Retry(
+        total=settings.STRIPE_CONNECT_RETRIES,
+        connect=settings.STRIPE_CONNECT_RETRIES,
+        # Never resend a request the gateway may have received; Stripe's retries handle that
+        read=0, status=0, other=0,
+        backoff_factor=0.25,
+    )
+    adapter = MeteredHTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=settings.STRIPE_POOL_SIZE,
+        # Wait for a free connection rather than opening one the pool will throw away
+        pool_block=True,
+        max_retries=retries,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_http_client():
+    """The pooled Stripe HTTP client of this process, rebuilt after a fork"""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                # Sockets inherited from a parent (e.g. a Celery prefork master) must not be shared
+                _client = stripe.RequestsClient(
+                    timeout=(settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT),
+                    session=build_session(),
+                )
+                _client_pid = os.getpid()
+    return _client
+
+
+def configure():
+    """Point the Stripe library at the settings and the pooled client; call before each gateway call"""
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+    if settings.STRIPE_API_BASE:
+        stripe.api_base = settings.STRIPE_API_BASE
+    stripe.max_network_retries = settings.STRIPE_MAX_NETWORK_RETRIES
+    stripe.default_http_client = get_http_client()
+    return stripe
+
+
+def pool_stats():
+    """Requests sent by this process, connections it opened, and how many requests reused one"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['reused_connections'] = stats['requests'] - stats['new_connections']
+    stats['reuse_ratio'] = stats['reused_connections'] / stats['requests'] if stats['requests'] else 0.0
+    return stats
+
+
+def reset():
+    """Drop the pooled client and its counters"""
+    global _client, _client_pid
+    with _client_lock:
+        _client = _client_pid = None
+    with _stats_lock:
+        for name in _stats:
+            _stats[name] = 0
@@ -0,0 +1,134 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+
+from products.facets import refresh_stock_facets
+from products.models import Product, ProductVariant
+from .models import StockReservation
+
+
+class InsufficientStock(Exception):
+    """Raised when an order asks for more units than are left in stock"""
+
+
+def _stock_delta(quantities):
+    return Case(
+        *[When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()],
+        output_field=models.IntegerField(),
+    )
+
+
+def _stock_update(model, stock):
+    """Fields of a stock UPDATE; products also get updated_at, which the catalog indexes of every process poll"""
+    fields = {'stock_quantity': stock}
+    if model is Product:
+        fields['updated_at'] = timezone.now()
+    return fields
+
+
+def _take_stock(model, quantities):
+    """Decrement stock for all rows with one conditional UPDATE.
+
+    Each row only matches if it still has enough stock, so concurrent checkouts
+    never drive stock negative and no row locks are held beyond the UPDATE
+    itself. Returns False if any row did not have enough stock.
+    """
+    if not quantities:
+        return True
+    condition = Q()
+    for pk, quantity in quantities.items():
+        condition |= Q(pk=pk, stock_quantity__gte=quantity)
+    updated = model.objects.filter(condition).update(
+        **_stock_update(model, F('stock_quantity') - _stock_delta(quantities))
+    )
+    return updated == len(quantities)
+
+
+def _return_stock(model, quantities):
+    if quantities:
+        model.objects.filter(pk__in=quantities).update(
+            **_stock_update(model, F('stock_quantity') + _stock_delta(quantities))
+        )
+
+
+def _split_quantities(lines):
+    """Sum quantities per SKU: variant lines draw from the variant, others from the product"""
+    product_quantities = defaultdict(int)
+    variant_quantities = defaultdict(int)
+    for line in lines:
+        if line.variant_id:
+            variant_quantities[line.variant_id] += line.quantity
+        else:
+            product_quantities[line.product_id] += line.quantity
+    return product_quantities, variant_quantities
+
+
+def reserve_stock(order, items, ttl=None):
+    """Take stock for every item of an order and record reservations for it.
+
+    All decrements happen in one transaction: if any line cannot be fulfilled
+    InsufficientStock is raised and nothing is taken.
+    """
+    if ttl is None:
+        ttl = settings.STOCK_RESERVATION_TTL
+    expires_at = timezone.now() + timedelta(seconds=ttl)
+
+    lines = defaultdict(int)
+    for item in items:
+        lines[(item.product_id, item.variant_id)] += item.quantity
+    reservations = [
+        StockReservation(order=order, product_id=product_id, variant_id=variant_id,
+                         quantity=quantity, expires_at=expires_at)
+        for (product_id, variant_id), quantity in lines.items()
+    ]
+    product_quantities, variant_quantities = _split_quantities(reservations)
+
+    with transaction.atomic():
+        if not (_take_stock(ProductVariant, variant_quantities)
+                and _take_stock(Product, product_quantities)):
+            raise InsufficientStock('Some items in your cart are no longer in stock')
+        # Only product stock shows in the facets; variant stock does not
+        refresh_stock_facets(product_quantities)
+        return StockReservation.objects.bulk_create(reservations)
+
+
+def release_reservations(reservations):
+    """Return the stock held by active reservations and mark them released"""
+    with transaction.atomic():
+        reservations = list(reservations.select_for_update(of=('self',)).filter(status='reserved'))
+        if not reservations:
+            return 0
+        product_quantities, variant_quantities = _split_quantities(reservations)
+        _return_stock(ProductVariant, variant_quantities)
+        _return_stock(Product, product_quantities)
+        refresh_stock_facets(product_quantities)
+        return StockReservation.objects.filter(
+            pk__in=[reservation.pk for reservation in reservations]
+        ).update(status='released')
+
+
+def commit_reservations(reservations):
+    """Make active reservations permanent, e.g. once the order has been paid"""
+    return reservations.filter(status='reserved').update(status='committed')
+
+
+def expire_reservations(now=None):
+    """Settle reservations past their TTL: commit them for paid orders, release the rest.
+
+    Orders whose stock is released are cancelled along with their payment
+    intent, so the customer can no longer pay for stock that is gone.
+    """
+    from .payments import cancel_unpaid_orders
+
+    expired = StockReservation.objects.filter(status='reserved', expires_at__lte=now or timezone.now())
+    committed = commit_reservations(expired.filter(order__payment_status='paid'))
+    with transaction.atomic():
+        unpaid = expired.exclude(order__payment_status='paid')
+        order_ids = set(unpaid.values_list('order_id', flat=True))
+        released = release_reservations(unpaid)
+        cancel_unpaid_orders(order_ids)
+    return committed, released
@@ -0,0 +1,67 @@
+import random
+import string
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+
+from orders.models import Order
+from orders.numbering import OrderNumberAllocator
+from products.management.commands.benchmark_autocomplete import percentile
+
+User = get_user_model()
+
+MARKER = 'benchmark-order-numbers@example.com'
+
+
+class Command(BaseCommand):
+    help = 'Compare order insert throughput with random order numbers against block-allocated ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=20_000, help='Orders inserted per scheme')
+        parser.add_argument(
+            '--random-digits', type=int, default=8,
+            help='Digits of the old random scheme; fewer digits stand in for a fuller key space',
+        )
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        user, created = User.objects.get_or_create(username='benchmark-order-numbers', defaults={'email': MARKER})
+        digits = options['random_digits']
+
+        def random_number():
+            return 'SS' + ''.join(rng.choices(string.digits, k=digits))
+
+        allocator = OrderNumberAllocator()
+        try:
+            # Each order is its own transaction, as at checkout
+            for label, generate in (('random', random_number), ('block', allocator.next)):
+                self.run(label, generate, user, options['orders'])
+        finally:
+            Order.objects.filter(billing_email=MARKER).delete()
+
+    def run(self, label, generate, user, count):
+        latencies = []
+        retries = 0
+        started = time.perf_counter()
+        for i in range(count):
+            order_started = time.perf_counter()
+            while True:
+                try:
+                    with transaction.atomic():
+                        Order.objects.create(
+                            user=user, order_number=generate(), billing_email=MARKER, subtotal=1, total_amount=1,
+                        )
+                    break
+                except IntegrityError:
+                    retries += 1
+            latencies.append((time.perf_counter() - order_started) * 1000)
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        self.stdout.write(
+            f'{label:<6} orders={count} orders_per_s={count / elapsed:.0f} collision_retries={retries} '
+            f'latency_ms p50={percentile(latencies, 0.50):.3f} p99={percentile(latencies, 0.99):.3f} '
+            f'max={latencies[-1]:.3f}'
+        )
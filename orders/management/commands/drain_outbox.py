@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from orders.gateway import pool_stats
+from orders.outbox import drain
+
+
+class Command(BaseCommand):
+    help = 'Process due outbox messages, for deployments without a Celery worker and beat'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=500)
+        parser.add_argument('--loop', action='store_true', help='Keep draining until interrupted')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when idle')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = drain(options['limit'])
+            if processed or not options['loop']:
+                self.stdout.write(f'Processed {processed} outbox messages')
+                if options['verbosity'] > 1:
+                    stats = pool_stats()
+                    self.stdout.write(
+                        f"Gateway requests={stats['requests']} new_connections={stats['new_connections']} "
+                        f"reused={stats['reused_connections']} reuse_ratio={stats['reuse_ratio']:.2f}"
+                    )
+            if not options['loop']:
+                return
+            if not processed:
+                time.sleep(options['interval'])
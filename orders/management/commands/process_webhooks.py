@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from orders.webhooks import drain_events
+
+
+class Command(BaseCommand):
+    help = 'Apply queued Stripe webhook events, for deployments without a Celery worker and beat'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--loop', action='store_true', help='Keep processing until interrupted')
+        parser.add_argument('--interval', type=float, default=0.5, help='Seconds to sleep when idle')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = drain_events(options['batch_size'])
+            if processed or not options['loop']:
+                self.stdout.write(f'Processed {processed} webhook events')
+            if not options['loop']:
+                return
+            if not processed:
+                time.sleep(options['interval'])
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from orders.inventory import expire_reservations
+
+
+class Command(BaseCommand):
+    help = 'Release stock held by expired reservations of unpaid orders'
+
+    def handle(self, *args, **options):
+        committed, released = expire_reservations()
+        self.stdout.write(self.style.SUCCESS(
+            f'Committed {committed} and released {released} expired reservations'
+        ))
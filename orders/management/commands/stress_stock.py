@@ -0,0 +1,95 @@
+import queue
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from django.db.models import Sum
+from django.db.models.functions import Coalesce
+
+from orders.inventory import InsufficientStock, reserve_stock
+from orders.models import Order, OrderItem, StockReservation
+from products.models import Category, Product
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Hammer a single SKU with concurrent stock reservations and check for oversell'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--attempts', type=int, default=400, help='Total reservation attempts')
+        parser.add_argument('--stock', type=int, default=250, help='Units in stock at the start')
+
+    def handle(self, *args, **options):
+        stock = options['stock']
+        attempts = options['attempts']
+
+        user, created = User.objects.get_or_create(
+            email='stress-stock@example.com',
+            defaults={'username': 'stress-stock', 'first_name': 'Stress', 'last_name': 'Test'},
+        )
+        category, created = Category.objects.get_or_create(name='Stress Test')
+        product = Product.objects.create(
+            name='Stress Test SKU', slug=f'stress-test-sku-{time.time_ns()}', description='Stress test',
+            category=category, price=1, sku=f'STRESS-{time.time_ns()}', stock_quantity=stock,
+        )
+        orders = queue.Queue()
+        for i in range(attempts):
+            orders.put(Order.objects.create(user=user, subtotal=1, total_amount=1))
+
+        results = {'reserved': 0, 'rejected': 0, 'retries': 0}
+        lock = threading.Lock()
+
+        def worker():
+            try:
+                while True:
+                    try:
+                        order = orders.get_nowait()
+                    except queue.Empty:
+                        return
+                    line = OrderItem(product_id=product.id, quantity=1)
+                    while True:
+                        try:
+                            reserve_stock(order, [line])
+                            outcome = 'reserved'
+                        except InsufficientStock:
+                            outcome = 'rejected'
+                        except OperationalError:
+                            # SQLite reports write contention instead of waiting on it
+                            with lock:
+                                results['retries'] += 1
+                            continue
+                        break
+                    with lock:
+                        results[outcome] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for i in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        product.refresh_from_db()
+        reserved_units = StockReservation.objects.filter(product=product).aggregate(
+            total=Coalesce(Sum('quantity'), 0)
+        )['total']
+        Order.objects.filter(user=user).delete()
+        product.delete()
+
+        self.stdout.write(
+            f"threads={options['threads']} attempts={attempts} reserved={results['reserved']} "
+            f"rejected={results['rejected']} retries={results['retries']} "
+            f"remaining_stock={product.stock_quantity} "
+            f"throughput={attempts / elapsed:.0f} reservations/s"
+        )
+        expected = min(stock, attempts)
+        if results['reserved'] != expected or reserved_units != expected or product.stock_quantity != stock - expected:
+            raise CommandError('Stock was oversold or reservations were lost')
+        self.stdout.write(self.style.SUCCESS('No oversell'))
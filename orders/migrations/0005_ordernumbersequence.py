@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:34
+
+from django.db import migrations, models
+
+
+def create_sequence(apps, schema_editor):
+    # Matches orders.numbering: every nextval() starts a block of 100 numbers
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('CREATE SEQUENCE IF NOT EXISTS orders_order_number_seq START WITH 1 INCREMENT BY 100')
+    else:
+        apps.get_model('orders', 'OrderNumberSequence').objects.get_or_create(name='order_number')
+
+
+def drop_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP SEQUENCE IF EXISTS orders_order_number_seq')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0004_webhookevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderNumberSequence',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('next_value', models.BigIntegerField(default=1)),
+            ],
+        ),
+        migrations.RunPython(create_sequence, drop_sequence),
+    ]
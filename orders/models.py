@@ -1,10 +1,18 @@
 from django.db import models
+from django.db.models import Q, Sum
+from django.db.models.functions import Coalesce
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from products.models import Product, ProductVariant
 import uuid
 
 User = get_user_model()
 
+class OrderQuerySet(models.QuerySet):
+    def with_total_items(self):
+        """Annotate each order with the summed quantity of its items"""
+        return self.annotate(total_items_sum=Coalesce(Sum('items__quantity'), 0))
+
 class Order(models.Model):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
@@ -68,8 +76,14 @@ class Order(models.Model):
     notes = models.TextField(blank=True)
     tracking_number = models.CharField(max_length=100, blank=True)
 
+    objects = OrderQuerySet.as_manager()
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Order history pages: a user's orders, newest first
+            models.Index(fields=['user', '-created_at'], name='order_user_created_idx'),
+        ]
 
     def __str__(self):
         return f"Order {self.order_number}"
@@ -80,13 +94,14 @@ class Order(models.Model):
         super().save(*args, **kwargs)
 
     def generate_order_number(self):
-        import random
-        import string
-        return 'SS' + ''.join(random.choices(string.digits, k=8))
+        from .numbering import next_order_number
+        return next_order_number()
 
     @property
     def total_items(self):
-        return sum(item.quantity for item in self.items.all())
+        if hasattr(self, 'total_items_sum'):
+            return self.total_items_sum
+        return self.items.aggregate(total=Coalesce(Sum('quantity'), 0))['total']
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
@@ -106,6 +121,22 @@ class OrderItem(models.Model):
         self.total_price = self.unit_price * self.quantity
         super().save(*args, **kwargs)
 
+    @classmethod
+    def from_cart_item(cls, order, cart_item):
+        """Build an unsaved order item from a cart item, e.g. for bulk_create which skips save()"""
+        item = cls(
+            order=order,
+            product=cart_item.product,
+            variant=cart_item.variant,
+            product_name=cart_item.product.name,
+            product_sku=cart_item.product.sku,
+            variant_name=cart_item.variant.name if cart_item.variant else '',
+            quantity=cart_item.quantity,
+            unit_price=cart_item.unit_price,
+        )
+        item.total_price = item.unit_price * item.quantity
+        return item
+
 class Payment(models.Model):
     PAYMENT_METHOD_CHOICES = [
         ('stripe', 'Stripe'),
@@ -169,4 +200,97 @@ class Coupon(models.Model):
         if self.discount_type == 'percentage':
             return min(amount * (self.discount_value / 100), amount)
         else:
-            return min(self.discount_value, amount)
\ No newline at end of file
+            return min(self.discount_value, amount)
+
+class StockReservation(models.Model):
+    STATUS_CHOICES = [
+        ('reserved', 'Reserved'),
+        ('committed', 'Committed'),
+        ('released', 'Released'),
+    ]
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='stock_reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    variant = models.ForeignKey(ProductVariant, on_delete=models.CASCADE, null=True, blank=True)
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='reserved')
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.variant or self.product} for {self.order.order_number}"
+
+class OrderNumberSequence(models.Model):
+    """Counter that orders.numbering allocates order number blocks from on databases without sequences"""
+    name = models.CharField(max_length=50, primary_key=True)
+    next_value = models.BigIntegerField(default=1)
+
+    def __str__(self):
+        return f"{self.name}: {self.next_value}"
+
+class OutboxMessage(models.Model):
+    """Work to do against an external service, written in the same transaction as the change needing it.
+
+    Drained by orders.outbox outside the request; idempotency_key is sent
+    along so a message processed twice has the same effect as once.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    topic = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    idempotency_key = models.CharField(max_length=255, unique=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.topic} {self.idempotency_key} ({self.status})"
+
+
+class WebhookEvent(models.Model):
+    """A gateway webhook as received, queued for orders.webhooks to apply.
+
+    Rows are only ever appended by the endpoint, so receiving an event costs
+    a single INSERT; retried deliveries are stored again and skipped as
+    duplicates of event_id when processed.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('applied', 'Applied'),
+        ('duplicate', 'Duplicate'),
+        ('ignored', 'Ignored'),
+    ]
+
+    event_id = models.CharField(max_length=255, db_index=True)
+    event_type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Keeps finding the queue head cheap however many processed events pile up
+            models.Index(fields=['id'], condition=Q(processed_at__isnull=True), name='webhook_event_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.event_type} {self.event_id} ({self.status})"
@@ -0,0 +1,114 @@
+"""Order numbers from block-allocated counters.
+
+Each process takes numbers BLOCK_SIZE at a time and hands them out from
+memory, so most orders get their number without a query and no two orders
+can ever draw the same one: there is nothing to retry on the unique index,
+and new rows land at the right-hand end of it instead of at random places.
+Numbers rise within a block; blocks of concurrent processes interleave.
+
+On PostgreSQL blocks come from a sequence, which is never rolled back. Other
+databases bump an OrderNumberSequence row, which stays locked until the
+transaction doing so ends. Called outside a transaction, the bump commits
+on its own and the block is kept at once; this is why checkout draws its
+number before its transaction starts. Inside one, the rest of the block is
+only kept once that transaction has committed, so a rollback cannot leave
+this process holding numbers the counter no longer accounts for.
+
+Numbers are 'SS', the counter zero-padded to nine digits and a Luhn check
+digit, e.g. SS0000001016.
+"""
+import os
+import threading
+
+from django.db import connection, transaction
+from django.db.models import F
+
+from .models import OrderNumberSequence
+
+PREFIX = 'SS'
+DIGITS = 9
+BLOCK_SIZE = 100
+SEQUENCE_NAME = 'order_number'
+# Created by migration 0005 with INCREMENT BY BLOCK_SIZE; each nextval() is the start of a block
+POSTGRES_SEQUENCE = 'orders_order_number_seq'
+
+
+def luhn_digit(digits):
+    """Check digit making digits + it pass the Luhn check"""
+    total = 0
+    for position, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if position % 2 == 0:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return str(-total % 10)
+
+
+def format_order_number(value):
+    digits = str(value).zfill(DIGITS)
+    return f'{PREFIX}{digits}{luhn_digit(digits)}'
+
+
+def is_valid_order_number(order_number):
+    """Whether order_number is one this module could have issued, e.g. to catch typos before a lookup"""
+    digits = order_number[len(PREFIX):]
+    return (
+        order_number.startswith(PREFIX) and len(digits) == DIGITS + 1 and digits.isdigit()
+        and luhn_digit(digits[:-1]) == digits[-1]
+    )
+
+
+def allocate_block(size=BLOCK_SIZE):
+    """Reserve size counter values; returns the first of them"""
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT nextval(%s)', [POSTGRES_SEQUENCE])
+            return cursor.fetchone()[0]
+    with transaction.atomic():
+        counter = OrderNumberSequence.objects.filter(name=SEQUENCE_NAME)
+        if not counter.update(next_value=F('next_value') + size):
+            OrderNumberSequence.objects.get_or_create(name=SEQUENCE_NAME)
+            counter.update(next_value=F('next_value') + size)
+        return counter.values_list('next_value', flat=True).get() - size
+
+
+class OrderNumberAllocator:
+    def __init__(self, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.next_value = self.end = 0
+        self.pid = os.getpid()
+
+    def keep(self, start, end):
+        with self.lock:
+            if self.pid == os.getpid() and self.next_value >= self.end:
+                self.next_value, self.end = start, end
+
+    def next(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # A forked child must not hand out its parent's numbers
+                self.next_value = self.end = 0
+                self.pid = os.getpid()
+            if self.next_value < self.end:
+                value = self.next_value
+                self.next_value += 1
+                return format_order_number(value)
+
+        start = allocate_block(self.block_size)
+        end = start + self.block_size
+        if connection.vendor == 'postgresql' or not connection.in_atomic_block:
+            # Sequences are never rolled back; outside a transaction the block was committed by allocate_block
+            self.keep(start + 1, end)
+        else:
+            transaction.on_commit(lambda: self.keep(start + 1, end))
+        return format_order_number(start)
+
+
+allocator = OrderNumberAllocator()
+
+
+def next_order_number():
+    return allocator.next()
@@ -0,0 +1,109 @@
+"""Transactional outbox for calls to external services.
+
+A request records what it needs done as an OutboxMessage in the same
+transaction as its own writes and returns straight away; after commit the
+message is handed to Celery, and drain() picks up anything a worker never
+got (broker down, worker crash) on the next periodic run. Handlers are
+registered per topic and must be safe to run more than once for the same
+message: they get its idempotency key to pass on to the remote service.
+"""
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+MAX_ATTEMPTS = 6
+# Messages left in processing this long are assumed abandoned by a dead worker
+PROCESSING_TIMEOUT = timedelta(minutes=5)
+
+
+class RetryLater(Exception):
+    """Raised by a handler when the remote service may succeed if asked again later"""
+
+
+def handler(topic):
+    def register(function):
+        HANDLERS[topic] = function
+        return function
+    return register
+
+
+def backoff(attempts):
+    """Delay before the next attempt: 2, 4, 8... seconds, capped at five minutes"""
+    return timedelta(seconds=min(2 ** attempts, 300))
+
+
+def enqueue(topic, payload, idempotency_key):
+    """Record a message in the current transaction and dispatch it once that commits"""
+    message = OutboxMessage.objects.create(topic=topic, payload=payload, idempotency_key=idempotency_key)
+    transaction.on_commit(lambda: dispatch(message.pk))
+    return message
+
+
+def dispatch(message_id):
+    from .tasks import process_outbox_message
+    try:
+        process_outbox_message.delay(message_id)
+    except Exception:
+        # The message is safe in the table; drain() will get to it
+        logger.warning('Could not queue outbox message %s', message_id, exc_info=True)
+
+
+def claim(message_id):
+    """Move a due message to processing; False if another worker has it or it is not due"""
+    now = timezone.now()
+    return bool(OutboxMessage.objects.filter(
+        pk=message_id, status='pending', available_at__lte=now,
+    ).update(status='processing', available_at=now + PROCESSING_TIMEOUT))
+
+
+def process_message(message_id):
+    """Run the handler of one message; returns its new status, or None if it was not claimed"""
+    if not claim(message_id):
+        return None
+    message = OutboxMessage.objects.get(pk=message_id)
+    message.attempts += 1
+    try:
+        HANDLERS[message.topic](message)
+    except RetryLater as e:
+        message.last_error = str(e)
+        if message.attempts < MAX_ATTEMPTS:
+            message.status = 'pending'
+            message.available_at = timezone.now() + backoff(message.attempts)
+        else:
+            message.status = 'failed'
+            fail_message(message)
+    except Exception as e:
+        logger.exception('Outbox message %s failed', message.pk)
+        message.last_error = str(e)
+        message.status = 'failed'
+        fail_message(message)
+    else:
+        message.status = 'done'
+        message.processed_at = timezone.now()
+    message.save(update_fields=['status', 'attempts', 'available_at', 'last_error', 'processed_at'])
+    return message.status
+
+
+def fail_message(message):
+    """Let the handler of a message that will never succeed clean up after it"""
+    on_failure = getattr(HANDLERS[message.topic], 'on_failure', None)
+    if on_failure is not None:
+        on_failure(message)
+
+
+def drain(limit=100):
+    """Process due messages, including ones abandoned mid-processing; returns how many were handled"""
+    now = timezone.now()
+    OutboxMessage.objects.filter(status='processing', available_at__lte=now).update(status='pending')
+    message_ids = list(OutboxMessage.objects.filter(
+        status='pending', available_at__lte=now,
+    ).order_by('available_at').values_list('pk', flat=True)[:limit])
+    return sum(1 for message_id in message_ids if process_message(message_id) is not None)
@@ -0,0 +1,145 @@
+"""Payment gateway work run from the outbox, outside the checkout request"""
+from django.db import transaction
+from django.urls import reverse
+from django.utils import timezone
+
+import stripe
+
+from cart.storage import get_cart_storage
+from . import gateway
+from .inventory import release_reservations
+from .models import Order, OutboxMessage, Payment
+from .outbox import RetryLater, enqueue, handler
+
+CREATE_PAYMENT_INTENT = 'stripe.payment_intent.create'
+CANCEL_PAYMENT_INTENT = 'stripe.payment_intent.cancel'
+CREATE_REFUND = 'stripe.refund.create'
+
+# Errors where asking again later can succeed; anything else is final
+RETRYABLE_ERRORS = (stripe.error.APIConnectionError, stripe.error.RateLimitError, stripe.error.APIError)
+
+
+def request_payment_intent(order, payment):
+    """Queue creation of the Stripe payment intent for an order; call inside its transaction"""
+    return enqueue(
+        CREATE_PAYMENT_INTENT,
+        {'order_id': str(order.id), 'payment_id': payment.id},
+        idempotency_key=f'payment-intent-{order.id}',
+    )
+
+
+@handler(CREATE_PAYMENT_INTENT)
+def create_payment_intent(message):
+    payment = Payment.objects.select_related('order').get(pk=message.payload['payment_id'])
+    order = payment.order
+    if order.status == 'cancelled':
+        # Expired or given up on before its turn came; there is nothing left to pay for
+        return
+    gateway.configure()
+    try:
+        # Stripe replays the original response for a repeated key, so retries never double-charge
+        intent = stripe.PaymentIntent.create(
+            amount=int(order.total_amount * 100),  # Convert to cents
+            currency='usd',
+            metadata={'order_id': str(order.id)},
+            idempotency_key=message.idempotency_key,
+        )
+    except RETRYABLE_ERRORS as e:
+        raise RetryLater(str(e))
+
+    payment.transaction_id = intent.id
+    payment.gateway_response = {'client_secret': intent.client_secret}
+    payment.save(update_fields=['transaction_id', 'gateway_response', 'updated_at'])
+
+
+def cancel_unpaid_order(message):
+    """Give up on an order whose payment intent could not be created, giving its lines back to the cart"""
+    with transaction.atomic():
+        order = Order.objects.select_for_update().get(pk=message.payload['order_id'])
+        if order.status == 'cancelled':
+            return
+        release_reservations(order.stock_reservations.all())
+        Payment.objects.filter(pk=message.payload['payment_id']).update(status='failed')
+        order.status = 'cancelled'
+        order.payment_status = 'failed'
+        order.save(update_fields=['status', 'payment_status', 'updated_at'])
+        lines = list(order.items.values_list('product_id', 'variant_id', 'quantity'))
+
+    # Checkout cleared the cart; the customer is told to try again and needs it back for that
+    storage = get_cart_storage()
+    for product_id, variant_id, quantity in lines:
+        storage.add(f'user:{order.user_id}', product_id, variant_id, quantity)
+
+create_payment_intent.on_failure = cancel_unpaid_order
+
+
+def cancel_unpaid_orders(order_ids):
+    """Cancel pending orders whose stock has been released and queue cancelling their payment intents"""
+    with transaction.atomic():
+        orders = Order.objects.filter(pk__in=order_ids, status='pending').exclude(payment_status='paid')
+        payments = list(Payment.objects.filter(order__in=orders, status='pending').values_list('pk', 'order_id'))
+        orders.update(status='cancelled', payment_status='failed', updated_at=timezone.now())
+        Payment.objects.filter(pk__in=[pk for pk, order_id in payments]).update(
+            status='cancelled', updated_at=timezone.now(),
+        )
+        for payment_pk, order_id in payments:
+            enqueue(
+                CANCEL_PAYMENT_INTENT,
+                {'order_id': str(order_id), 'payment_id': payment_pk},
+                idempotency_key=f'payment-intent-cancel-{order_id}',
+            )
+    return len(payments)
+
+
+@handler(CANCEL_PAYMENT_INTENT)
+def cancel_payment_intent(message):
+    payment = Payment.objects.get(pk=message.payload['payment_id'])
+    if not payment.transaction_id:
+        creating = OutboxMessage.objects.filter(
+            idempotency_key=f"payment-intent-{message.payload['order_id']}", status__in=('pending', 'processing'),
+        )
+        if creating.exists():
+            raise RetryLater('The payment intent is still being created')
+        # Never created, so nothing can be paid
+        return
+    gateway.configure()
+    try:
+        stripe.PaymentIntent.cancel(
+            payment.transaction_id, cancellation_reason='abandoned', idempotency_key=message.idempotency_key,
+        )
+    except RETRYABLE_ERRORS as e:
+        raise RetryLater(str(e))
+
+
+def request_refund(order, payment):
+    """Queue a full refund of a payment the order cannot be fulfilled for; call inside its transaction"""
+    return enqueue(
+        CREATE_REFUND,
+        {'order_id': str(order.id), 'payment_id': payment.pk},
+        idempotency_key=f'refund-{order.id}',
+    )
+
+
+@handler(CREATE_REFUND)
+def create_refund(message):
+    payment = Payment.objects.get(pk=message.payload['payment_id'])
+    gateway.configure()
+    try:
+        # The charge.refunded webhook moves the payment and order to refunded
+        stripe.Refund.create(payment_intent=payment.transaction_id, idempotency_key=message.idempotency_key)
+    except RETRYABLE_ERRORS as e:
+        raise RetryLater(str(e))
+
+
+def payment_intent_state(payment):
+    """What the checkout page polls for: pending until the intent exists, then its client secret"""
+    if payment.status in ('failed', 'cancelled') or payment.order.payment_status == 'failed':
+        return {'status': 'failed', 'message': 'We could not start your payment. Please try again.'}
+    client_secret = (payment.gateway_response or {}).get('client_secret')
+    if not client_secret:
+        return {'status': 'pending', 'retry_after': 0.5}
+    return {
+        'status': 'ready',
+        'client_secret': client_secret,
+        'success_url': f"{reverse('orders:payment_success')}?order_id={payment.order_id}",
+    }
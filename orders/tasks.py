@@ -0,0 +1,31 @@
+from celery import shared_task
+
+from . import inventory, outbox, webhooks
+
+
+@shared_task
+def process_outbox_message(message_id):
+    status = outbox.process_message(message_id)
+    if status == 'pending':
+        # Failed in a way worth retrying: come back once its backoff has passed
+        message = outbox.OutboxMessage.objects.get(pk=message_id)
+        process_outbox_message.apply_async((message_id,), eta=message.available_at)
+    return status
+
+
+@shared_task
+def drain_outbox(limit=500):
+    """Periodic safety net for messages that never reached a worker"""
+    return outbox.drain(limit)
+
+
+@shared_task
+def process_webhook_events(batch_size=1000):
+    """Apply queued gateway webhooks; scheduled every few seconds by beat"""
+    return webhooks.drain_events(batch_size)
+
+
+@shared_task
+def release_expired_stock():
+    """Return the stock of abandoned unpaid orders; scheduled every minute by beat"""
+    return inventory.expire_reservations()
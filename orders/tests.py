@@ -1,3 +1,717 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import time
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest import mock
+from urllib.parse import parse_qs
 
-# Create your tests here.
+import stripe
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import Address
+from cart.models import Cart, CartItem
+from cart.storage import get_cart_storage
+from cart.tests import FakeRedis
+from core.metrics import render_metrics
+from products.filter_index import ProductFilterIndex
+from products.models import Category, Product, ProductFacet, ProductImage, ProductVariant
+from . import gateway, tasks
+from .inventory import InsufficientStock, expire_reservations, release_reservations, reserve_stock
+from .models import Order, OrderItem, OrderNumberSequence, OutboxMessage, Payment, StockReservation, WebhookEvent
+from .numbering import OrderNumberAllocator, format_order_number, is_valid_order_number, luhn_digit
+from .outbox import MAX_ATTEMPTS, drain, process_message
+from .payments import CANCEL_PAYMENT_INTENT, CREATE_REFUND, request_refund
+from .webhooks import drain_events, process_events
+
+User = get_user_model()
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    """Just enough of the Stripe API: payment intents and refunds, honouring idempotency keys"""
+
+    def do_POST(self):
+        server = self.server
+        body = parse_qs(self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode())
+        key = self.headers.get('Idempotency-Key')
+        server.requests.append((self.path, key, body))
+        if server.errors:
+            status, error_type = server.errors.pop(0)
+            return self.respond(status, {'error': {'type': error_type, 'message': 'Fake gateway error'}})
+        if self.path.endswith('/cancel'):
+            intent = self.path.split('/')[3]
+            return self.respond(200, {'id': intent, 'object': 'payment_intent', 'status': 'canceled'})
+        if self.path == '/v1/refunds':
+            intent = body['payment_intent'][0]
+            return self.respond(200, {
+                'id': f're_{intent}', 'object': 'refund', 'payment_intent': intent, 'status': 'succeeded',
+            })
+        if key not in server.responses:
+            number = len(server.responses) + 1
+            server.responses[key] = {
+                'id': f'pi_fake_{number}', 'object': 'payment_intent', 'amount': int(body['amount'][0]),
+                'currency': body['currency'][0], 'client_secret': f'pi_fake_{number}_secret_x',
+                'status': 'requires_payment_method',
+            }
+        self.respond(200, server.responses[key])
+
+    def respond(self, status, payload):
+        content = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeStripeServer(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeStripeHandler)
+        self.requests = []
+        self.responses = {}
+        # (HTTP status, Stripe error type) to answer the next requests with
+        self.errors = []
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class OrderCreateTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret',
+            first_name='Buyer', last_name='Example',
+        )
+        cls.address = Address.objects.create(
+            user=cls.user, title='Home', first_name='Buyer', last_name='Example',
+            address_line_1='1 Main St', city='Springfield', state='IL',
+            postal_code='62701', country='US',
+        )
+        cls.category = Category.objects.create(name='Books')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def fill_cart(self, lines):
+        cart, created = Cart.objects.get_or_create(user=self.user)
+        for i in range(lines):
+            product = Product.objects.create(
+                name=f'Book {lines}-{i}', description='Paperback', category=self.category,
+                price='8.00', sku=f'BK-{lines}-{i}', stock_quantity=100,
+            )
+            variant = ProductVariant.objects.create(
+                product=product, name='Cover', value='Hard', price_adjustment='4.00',
+                sku=f'BK-{lines}-{i}-H', stock_quantity=100,
+            )
+            ProductImage.objects.create(product=product, image=f'products/book-{lines}-{i}.jpg', is_main=True)
+            CartItem.objects.create(cart=cart, product=product, variant=variant, quantity=2)
+        return cart
+
+    def create_order(self):
+        data = {
+            'billing_address': self.address.id,
+            'shipping_address': self.address.id,
+            'payment_method': 'stripe',
+        }
+        return self.client.post(reverse('orders:create'), data)
+
+    def test_order_items_are_materialized_from_cart(self):
+        self.fill_cart(3)
+        response = self.create_order()
+        self.assertTrue(response.json()['success'])
+
+        order = Order.objects.get()
+        self.assertEqual(order.total_amount, Decimal('72.00'))
+        self.assertEqual(order.total_items, 6)
+        for item in order.items.all():
+            self.assertEqual(item.unit_price, Decimal('12.00'))
+            self.assertEqual(item.total_price, Decimal('24.00'))
+            self.assertEqual(item.variant_name, 'Cover')
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_order_number_is_drawn_before_the_checkout_transaction(self):
+        self.fill_cart(1)
+        depth = len(connection.atomic_blocks)
+        drawn = []
+
+        def draw():
+            drawn.append((len(connection.atomic_blocks), format_order_number(7)))
+            return drawn[-1][1]
+
+        with mock.patch('orders.views.next_order_number', side_effect=draw):
+            self.assertTrue(self.create_order().json()['success'])
+        self.assertEqual(drawn, [(depth, format_order_number(7))])
+        self.assertEqual(Order.objects.get().order_number, format_order_number(7))
+
+    def test_checkout_query_count_is_independent_of_cart_size(self):
+        self.fill_cart(2)
+        with CaptureQueriesContext(connection) as small:
+            self.create_order()
+        CartItem.objects.all().delete()
+        self.fill_cart(40)
+        with CaptureQueriesContext(connection) as large:
+            self.create_order()
+
+        self.assertEqual(OrderItem.objects.count(), 42)
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_checkout_page_query_count(self):
+        self.fill_cart(2)
+        url = reverse('orders:checkout')
+        self.client.get(url)
+        # session, user, cart with totals, items, main images, addresses, session save
+        with self.assertNumQueries(9):
+            response = self.client.get(url)
+        self.assertContains(response, 'book-2-0.jpg')
+        self.fill_cart(10)
+        with self.assertNumQueries(9):
+            self.client.get(url)
+
+    @override_settings(CART_STORAGE='cart.storage.RedisCartStorage')
+    def test_checkout_from_redis_cart(self):
+        cart = self.fill_cart(2)
+        with mock.patch('cart.storage.redis.Redis.from_url', return_value=FakeRedis()), \
+                mock.patch('cart.storage._storage', None):
+            owner = f'user:{self.user.pk}'
+            for item in cart.items.all():
+                get_cart_storage().add(owner, item.product_id, item.variant_id, item.quantity)
+            cart.delete()
+            response = self.create_order()
+            self.assertTrue(response.json()['success'])
+            self.assertIsNone(get_cart_storage().load(owner))
+        order = Order.objects.get()
+        self.assertEqual(order.total_amount, Decimal('48.00'))
+        self.assertEqual(order.items.count(), 2)
+
+    def test_checkout_reserves_stock(self):
+        self.fill_cart(1)
+        self.create_order()
+        variant = ProductVariant.objects.get()
+        self.assertEqual(variant.stock_quantity, 98)
+        self.assertEqual(StockReservation.objects.get().status, 'reserved')
+
+    def test_checkout_queues_payment_intent_instead_of_calling_gateway(self):
+        self.fill_cart(1)
+        with mock.patch('orders.tasks.process_outbox_message.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.create_order()
+        order = Order.objects.get()
+        message = OutboxMessage.objects.get()
+        delay.assert_called_once_with(message.pk)
+        self.assertEqual(message.idempotency_key, f'payment-intent-{order.id}')
+        self.assertEqual(response.json()['payment_url'], reverse('orders:payment_intent', args=[order.id]))
+        self.assertEqual(self.client.get(response.json()['payment_url']).json()['status'], 'pending')
+
+    def test_unreachable_broker_leaves_message_for_drain(self):
+        self.fill_cart(1)
+        with mock.patch('orders.tasks.process_outbox_message.delay', side_effect=ConnectionError):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.create_order()
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(OutboxMessage.objects.get().status, 'pending')
+
+    def test_invalid_payment_method_creates_nothing(self):
+        self.fill_cart(1)
+        response = self.client.post(reverse('orders:create'), {
+            'billing_address': self.address.id, 'shipping_address': self.address.id, 'payment_method': 'barter',
+        })
+        self.assertFalse(response.json()['success'])
+        self.assertFalse(Order.objects.exists())
+
+    def test_checkout_rejects_out_of_stock_cart(self):
+        self.fill_cart(2)
+        ProductVariant.objects.filter(sku='BK-2-1-H').update(stock_quantity=1)
+        response = self.create_order()
+        self.assertFalse(response.json()['success'])
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(ProductVariant.objects.get(sku='BK-2-0-H').stock_quantity, 100)
+
+
+class StockReservationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user(
+            username='stock', email='stock@example.com', password='secret',
+            first_name='Stock', last_name='Example',
+        )
+        category = Category.objects.create(name='Toys')
+        cls.product = Product.objects.create(
+            name='Robot', description='Toy robot', category=category, price='20.00', sku='RB-1', stock_quantity=5,
+        )
+        cls.order = Order.objects.create(user=user, subtotal=0, total_amount=0)
+
+    def test_reserve_and_release(self):
+        reserve_stock(self.order, [OrderItem(product=self.product, quantity=3)])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 2)
+
+        with self.assertRaises(InsufficientStock):
+            reserve_stock(self.order, [OrderItem(product=self.product, quantity=3)])
+
+        self.assertEqual(release_reservations(self.order.stock_reservations.all()), 1)
+        self.assertEqual(release_reservations(self.order.stock_reservations.all()), 0)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 5)
+
+    def test_expired_reservations_are_released_unless_paid(self):
+        reserve_stock(self.order, [OrderItem(product=self.product, quantity=2)], ttl=0)
+        self.assertEqual(expire_reservations(), (0, 1))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 5)
+
+        reserve_stock(self.order, [OrderItem(product=self.product, quantity=2)], ttl=0)
+        Order.objects.filter(pk=self.order.pk).update(payment_status='paid')
+        self.assertEqual(expire_reservations(), (1, 0))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 3)
+
+    def test_stock_facet_follows_reservations(self):
+        in_stock = ProductFacet.objects.filter(product=self.product, facet='stock', value='in_stock')
+        self.assertTrue(in_stock.exists())
+        reserve_stock(self.order, [OrderItem(product=self.product, quantity=5)])
+        self.assertFalse(in_stock.exists())
+        release_reservations(self.order.stock_reservations.all())
+        self.assertTrue(in_stock.exists())
+        self.assertEqual(
+            settings.CELERY_BEAT_SCHEDULE['refresh-facets']['task'], 'products.tasks.refresh_facets',
+        )
+
+    @override_settings(PRODUCT_INDEX_REFRESH=1)
+    def test_sales_reach_the_filter_index_of_every_process(self):
+        # Built like another worker's, which no signal of this process updates
+        index = ProductFilterIndex().load()
+        reserve_stock(self.order, [OrderItem(product=self.product, quantity=5)])
+        index.checked_at = 0
+        index.refresh()
+        self.assertEqual(index.page({'stock': ['in_stock']}, 'name', 5), [])
+
+    def test_beat_task_releases_expired_stock(self):
+        self.assertEqual(
+            settings.CELERY_BEAT_SCHEDULE['release-expired-stock']['task'], 'orders.tasks.release_expired_stock',
+        )
+        reserve_stock(self.order, [OrderItem(product=self.product, quantity=2)], ttl=0)
+        self.assertEqual(tuple(tasks.release_expired_stock.apply().get()), (0, 1))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 5)
+        self.assertEqual(self.order.stock_reservations.get().status, 'released')
+
+
+class StockContentionTests(TransactionTestCase):
+    def test_concurrent_reservations_never_oversell(self):
+        out = StringIO()
+        call_command('stress_stock', threads=4, attempts=60, stock=40, stdout=out)
+        self.assertIn('No oversell', out.getvalue())
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class PaymentOutboxTests(TestCase):
+    """Payment intents created from the outbox against a local fake Stripe server"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='payer', email='payer@example.com', password='secret',
+            first_name='Payer', last_name='Example',
+        )
+        cls.address = Address.objects.create(
+            user=cls.user, title='Home', first_name='Payer', last_name='Example',
+            address_line_1='1 Main St', city='Springfield', state='IL',
+            postal_code='62701', country='US',
+        )
+        category = Category.objects.create(name='Games')
+        cls.product = Product.objects.create(
+            name='Chess set', description='Wooden', category=category, price='25.00', sku='CH-1', stock_quantity=10,
+        )
+
+    def setUp(self):
+        self.server = FakeStripeServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        gateway_settings = override_settings(
+            STRIPE_SECRET_KEY='sk_test_fake', STRIPE_API_BASE=self.server.url, STRIPE_MAX_NETWORK_RETRIES=0,
+        )
+        gateway_settings.enable()
+        self.addCleanup(gateway_settings.disable)
+        # gateway.configure() sets these globals; put the library back as it was afterwards
+        for name in ('api_base', 'api_key', 'max_network_retries', 'default_http_client'):
+            patcher = mock.patch.object(stripe, name, getattr(stripe, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        gateway.reset()
+
+        self.client.force_login(self.user)
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+        response = self.client.post(reverse('orders:create'), {
+            'billing_address': self.address.id, 'shipping_address': self.address.id, 'payment_method': 'stripe',
+        })
+        self.payment_url = response.json()['payment_url']
+        self.order = Order.objects.get()
+        self.message = OutboxMessage.objects.get()
+
+    def test_intent_is_created_with_idempotency_key(self):
+        self.assertEqual(process_message(self.message.pk), 'done')
+        path, key, body = self.server.requests[0]
+        self.assertEqual((path, key, body['amount']), ('/v1/payment_intents', self.message.idempotency_key, ['5000']))
+
+        state = self.client.get(self.payment_url).json()
+        self.assertEqual(state['status'], 'ready')
+        self.assertEqual(state['client_secret'], 'pi_fake_1_secret_x')
+        self.assertEqual(Payment.objects.get().transaction_id, 'pi_fake_1')
+
+    def test_processing_twice_creates_one_intent(self):
+        process_message(self.message.pk)
+        # As if the worker died before recording the result
+        OutboxMessage.objects.update(status='pending', available_at=timezone.now())
+        self.assertEqual(process_message(self.message.pk), 'done')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(self.server.responses), 1)
+        self.assertEqual(Payment.objects.get().transaction_id, 'pi_fake_1')
+
+    def test_gateway_errors_are_retried_with_backoff(self):
+        self.server.errors = [(500, 'api_error')]
+        self.assertEqual(process_message(self.message.pk), 'pending')
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.attempts, 1)
+        self.assertGreater(message.available_at, timezone.now())
+        # Not due yet
+        self.assertIsNone(process_message(self.message.pk))
+
+        OutboxMessage.objects.update(available_at=timezone.now())
+        self.assertEqual(drain(), 1)
+        self.assertEqual(OutboxMessage.objects.get().status, 'done')
+        self.assertEqual(self.client.get(self.payment_url).json()['status'], 'ready')
+
+    def test_exhausted_retries_cancel_the_order(self):
+        self.server.errors = [(500, 'api_error')] * MAX_ATTEMPTS
+        for attempt in range(MAX_ATTEMPTS):
+            OutboxMessage.objects.update(available_at=timezone.now())
+            process_message(self.message.pk)
+        self.assertEqual(OutboxMessage.objects.get().status, 'failed')
+        self.assertCancelled()
+
+    def test_rejected_request_cancels_the_order_at_once(self):
+        self.server.errors = [(400, 'invalid_request_error')]
+        self.assertEqual(process_message(self.message.pk), 'failed')
+        self.assertCancelled()
+
+    def test_cancelled_order_goes_back_into_the_cart(self):
+        self.server.errors = [(400, 'invalid_request_error')]
+        process_message(self.message.pk)
+        cart = get_cart_storage().load(f'user:{self.user.pk}')
+        self.assertEqual(
+            [(item.product_id, item.variant_id, item.quantity) for item in cart.items.all()],
+            [(self.product.pk, None, 2)],
+        )
+
+    def test_expired_order_is_cancelled_with_its_payment_intent(self):
+        process_message(self.message.pk)
+        StockReservation.objects.update(expires_at=timezone.now())
+        self.assertEqual(expire_reservations(), (0, 1))
+        self.assertCancelled()
+        self.assertEqual(Payment.objects.get().status, 'cancelled')
+
+        cancel = OutboxMessage.objects.get(topic=CANCEL_PAYMENT_INTENT)
+        self.assertEqual(process_message(cancel.pk), 'done')
+        path, key, body = self.server.requests[-1]
+        self.assertEqual(
+            (path, key, body['cancellation_reason']),
+            ('/v1/payment_intents/pi_fake_1/cancel', cancel.idempotency_key, ['abandoned']),
+        )
+
+    def test_order_expired_before_its_intent_never_gets_one(self):
+        StockReservation.objects.update(expires_at=timezone.now())
+        expire_reservations()
+        cancel = OutboxMessage.objects.get(topic=CANCEL_PAYMENT_INTENT)
+        # Waits for the intent to be created, which then finds the order cancelled
+        self.assertEqual(process_message(cancel.pk), 'pending')
+        self.assertEqual(process_message(self.message.pk), 'done')
+        OutboxMessage.objects.update(available_at=timezone.now())
+        self.assertEqual(process_message(cancel.pk), 'done')
+        self.assertEqual(self.server.requests, [])
+        self.assertCancelled()
+
+    def test_refund_is_requested_with_idempotency_key(self):
+        process_message(self.message.pk)
+        refund = request_refund(self.order, Payment.objects.get())
+        self.assertEqual(process_message(refund.pk), 'done')
+        path, key, body = self.server.requests[-1]
+        self.assertEqual((path, key, body['payment_intent']), ('/v1/refunds', refund.idempotency_key, ['pi_fake_1']))
+
+    def test_drain_recovers_abandoned_messages(self):
+        OutboxMessage.objects.update(status='processing', available_at=timezone.now() - timedelta(seconds=1))
+        call_command('drain_outbox', stdout=StringIO())
+        self.assertEqual(OutboxMessage.objects.get().status, 'done')
+
+    @override_settings(QUERY_METRICS_REDIS_URL='')
+    def test_gateway_connections_are_reused(self):
+        for order in range(3):
+            process_message(self.message.pk)
+            OutboxMessage.objects.update(status='pending', available_at=timezone.now())
+        stats = gateway.pool_stats()
+        self.assertEqual((stats['requests'], stats['new_connections'], stats['reused_connections']), (3, 1, 2))
+        self.assertIs(stripe.default_http_client, gateway.get_http_client())
+
+        exported = render_metrics()
+        self.assertIn('shopstreet_payment_gateway_requests_total 3\n', exported)
+        self.assertIn('shopstreet_payment_gateway_new_connections_total 1\n', exported)
+        self.assertIn('shopstreet_payment_gateway_connection_reuse_ratio 0.666667\n', exported)
+
+    def test_gateway_client_uses_configured_timeouts(self):
+        with override_settings(STRIPE_CONNECT_TIMEOUT=1.5, STRIPE_READ_TIMEOUT=7):
+            gateway.reset()
+            self.assertEqual(gateway.get_http_client()._timeout, (1.5, 7))
+
+    def assertCancelled(self):
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.status, self.order.payment_status), ('cancelled', 'failed'))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 10)
+        self.assertEqual(self.client.get(self.payment_url).json()['status'], 'failed')
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, STRIPE_WEBHOOK_SECRET='whsec_test')
+class StripeWebhookTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='hooked', password='secret')
+        cls.product = Product.objects.create(
+            name='Kite', description='Red', category=Category.objects.create(name='Toys'),
+            price='30.00', sku='KT-1', stock_quantity=100,
+        )
+
+    def setUp(self):
+        self.order, self.payment = self.make_order('pi_1')
+        self.events = 0
+
+    def make_order(self, intent):
+        order = Order.objects.create(user=self.user, subtotal=30, total_amount=30)
+        item = OrderItem.objects.create(
+            order=order, product=self.product, product_name='Kite', product_sku='KT-1', quantity=1, unit_price=30,
+        )
+        reserve_stock(order, [item])
+        payment = Payment.objects.create(order=order, payment_method='stripe', amount=30, transaction_id=intent)
+        return order, payment
+
+    def event(self, event_type, intent='pi_1', event_id=None, created=None, **fields):
+        self.events += 1
+        obj = {'id': intent, 'object': 'payment_intent'}
+        if event_type.startswith('charge.'):
+            obj = {'id': f'ch_{self.events}', 'object': 'charge', 'payment_intent': intent, 'refunded': True}
+        obj.update(fields)
+        return {
+            'id': event_id or f'evt_{self.events}', 'type': event_type,
+            'created': created or self.events, 'data': {'object': obj},
+        }
+
+    def deliver(self, event, secret='whsec_test'):
+        body = json.dumps(event)
+        timestamp = int(time.time())
+        signature = hmac.new(secret.encode(), f'{timestamp}.{body}'.encode(), hashlib.sha256).hexdigest()
+        return self.client.post(
+            reverse('orders:stripe_webhook'), body, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}',
+        )
+
+    def assertState(self, payment_status, order_status, order_payment_status, reservation_status):
+        self.payment.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(
+            (self.payment.status, self.order.status, self.order.payment_status,
+             self.order.stock_reservations.get().status),
+            (payment_status, order_status, order_payment_status, reservation_status),
+        )
+
+    def test_endpoint_only_queues_verified_events(self):
+        self.assertEqual(self.deliver(self.event('payment_intent.succeeded'), secret='whsec_wrong').status_code, 400)
+        response = self.client.post(reverse('orders:stripe_webhook'), '{}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.deliver(self.event('payment_intent.succeeded')).status_code, 200)
+        self.assertEqual(WebhookEvent.objects.get().status, 'pending')
+        self.assertState('pending', 'pending', 'pending', 'reserved')
+
+    def test_succeeded_marks_order_paid_and_commits_stock(self):
+        self.deliver(self.event('payment_intent.succeeded'))
+        self.assertEqual(process_events(), 1)
+        self.assertState('completed', 'confirmed', 'paid', 'committed')
+        self.assertEqual(WebhookEvent.objects.get().status, 'applied')
+
+    def test_canceled_cancels_order_and_releases_stock(self):
+        self.deliver(self.event('payment_intent.canceled'))
+        process_events()
+        self.assertState('cancelled', 'cancelled', 'failed', 'released')
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 100)
+
+    def pay_after_expiry(self, sold_meanwhile=False):
+        StockReservation.objects.update(expires_at=timezone.now())
+        self.assertEqual(expire_reservations(), (0, 1))
+        if sold_meanwhile:
+            Product.objects.filter(pk=self.product.pk).update(stock_quantity=0)
+        self.deliver(self.event('payment_intent.succeeded'))
+        process_events()
+        self.payment.refresh_from_db()
+        self.order.refresh_from_db()
+        self.product.refresh_from_db()
+
+    def test_payment_after_expiry_takes_the_stock_again(self):
+        self.pay_after_expiry()
+        self.assertEqual(
+            (self.payment.status, self.order.status, self.order.payment_status), ('completed', 'confirmed', 'paid'),
+        )
+        self.assertEqual(
+            sorted(self.order.stock_reservations.values_list('status', flat=True)), ['committed', 'released'],
+        )
+        self.assertEqual(self.product.stock_quantity, 99)
+        self.assertFalse(OutboxMessage.objects.filter(topic=CREATE_REFUND).exists())
+
+    def test_payment_after_expiry_is_refunded_when_the_stock_is_gone(self):
+        self.pay_after_expiry(sold_meanwhile=True)
+        self.assertEqual(
+            (self.payment.status, self.order.status, self.order.payment_status), ('completed', 'cancelled', 'paid'),
+        )
+        self.assertEqual(self.product.stock_quantity, 0)
+        refund = OutboxMessage.objects.get(topic=CREATE_REFUND)
+        self.assertEqual(refund.payload, {'order_id': str(self.order.id), 'payment_id': self.payment.pk})
+
+    def test_redelivered_events_are_applied_once(self):
+        succeeded = self.event('payment_intent.succeeded')
+        self.deliver(succeeded)
+        self.deliver(succeeded)
+        process_events()
+        self.deliver(succeeded)
+        process_events()
+        self.assertEqual(
+            list(WebhookEvent.objects.order_by('id').values_list('status', flat=True)),
+            ['applied', 'duplicate', 'duplicate'],
+        )
+        self.assertState('completed', 'confirmed', 'paid', 'committed')
+
+    def test_events_apply_in_creation_order_and_never_go_back(self):
+        # A failed attempt then a successful retry, delivered in reverse
+        self.deliver(self.event('payment_intent.succeeded', created=20))
+        self.deliver(self.event('payment_intent.payment_failed', created=10))
+        process_events()
+        self.assertState('completed', 'confirmed', 'paid', 'committed')
+
+        # A late failure does not undo the payment; a refund does
+        self.deliver(self.event('payment_intent.payment_failed', created=30))
+        self.deliver(self.event('charge.refunded', created=40))
+        process_events()
+        self.assertState('refunded', 'refunded', 'refunded', 'committed')
+        self.assertEqual(
+            list(WebhookEvent.objects.order_by('id').values_list('status', flat=True)),
+            ['applied', 'applied', 'ignored', 'applied'],
+        )
+
+    def test_unknown_and_partial_events_are_ignored(self):
+        self.deliver(self.event('customer.created'))
+        self.deliver(self.event('payment_intent.succeeded', intent='pi_unknown'))
+        self.deliver(self.event('charge.refunded', refunded=False))
+        process_events()
+        self.assertEqual(set(WebhookEvent.objects.values_list('status', flat=True)), {'ignored'})
+        self.assertState('pending', 'pending', 'pending', 'reserved')
+
+    def test_batches_take_constant_queries(self):
+        intents = [f'pi_burst_{number}' for number in range(40)]
+        for intent in intents:
+            self.make_order(intent)
+        events = [
+            WebhookEvent(event_id=event['id'], event_type=event['type'], payload=event)
+            for intent in intents
+            for event in (self.event('payment_intent.payment_failed', intent), self.event('payment_intent.succeeded', intent))
+        ]
+        WebhookEvent.objects.bulk_create(events + events[:10])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(drain_events(batch_size=1000), 90)
+        self.assertLess(len(queries), 25)
+        self.assertEqual(Payment.objects.filter(transaction_id__in=intents, status='completed').count(), 40)
+        self.assertEqual(Order.objects.filter(payment_status='paid').count(), 40)
+        self.assertEqual(WebhookEvent.objects.filter(status='duplicate').count(), 10)
+
+
+class OrderNumberTests(TestCase):
+    def test_numbers_carry_a_check_digit(self):
+        self.assertEqual(luhn_digit('7992739871'), '3')
+        self.assertEqual(format_order_number(101), 'SS0000001016')
+        self.assertTrue(is_valid_order_number('SS0000001016'))
+        self.assertFalse(is_valid_order_number('SS0000001017'))
+        self.assertFalse(is_valid_order_number('SS0000000116'))
+        self.assertFalse(is_valid_order_number('SS12345678'))
+
+    def test_blocks_are_kept_once_committed(self):
+        allocator = OrderNumberAllocator(block_size=10)
+        with self.captureOnCommitCallbacks(execute=True):
+            first = allocator.next()
+        with self.assertNumQueries(0):
+            numbers = [allocator.next() for i in range(9)]
+        self.assertEqual([first] + numbers, [format_order_number(value) for value in range(1, 11)])
+        self.assertEqual(allocator.next(), format_order_number(11))
+        self.assertEqual(OrderNumberSequence.objects.get().next_value, 21)
+
+    def test_uncommitted_blocks_are_not_reused(self):
+        allocator = OrderNumberAllocator(block_size=10)
+        # The allocating transaction never commits, so the rest of its block may be handed out again
+        with self.captureOnCommitCallbacks(execute=False):
+            self.assertEqual(allocator.next(), format_order_number(1))
+        OrderNumberSequence.objects.update(next_value=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(allocator.next(), format_order_number(1))
+        self.assertEqual(allocator.next(), format_order_number(2))
+
+    def test_allocators_never_share_numbers(self):
+        allocators = [OrderNumberAllocator(block_size=3) for i in range(3)]
+        numbers = []
+        for turn in range(5):
+            for allocator in allocators:
+                with self.captureOnCommitCallbacks(execute=True):
+                    numbers.append(allocator.next())
+        self.assertEqual(len(set(numbers)), 15)
+        self.assertTrue(all(is_valid_order_number(number) for number in numbers))
+
+    def test_orders_get_numbers_on_save(self):
+        user = User.objects.create_user(username='numbered', password='secret')
+        orders = [Order.objects.create(user=user, subtotal=1, total_amount=1) for i in range(3)]
+        numbers = [order.order_number for order in orders]
+        self.assertEqual(numbers, sorted(set(numbers)))
+        self.assertTrue(all(is_valid_order_number(number) for number in numbers))
+
+
+class OrderNumberCommitTests(TransactionTestCase):
+    def test_blocks_allocated_outside_transactions_are_kept_at_once(self):
+        allocator = OrderNumberAllocator(block_size=10)
+        first = allocator.next()
+        with self.assertNumQueries(0):
+            numbers = [allocator.next() for i in range(9)]
+        self.assertEqual([first] + numbers, [format_order_number(value) for value in range(1, 11)])
+        self.assertEqual(OrderNumberSequence.objects.get().next_value, 11)
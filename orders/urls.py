@@ -9,6 +9,8 @@ urlpatterns = [
     path('create/', views.OrderCreateView.as_view(), name='create'),
     path('<uuid:pk>/', views.OrderDetailView.as_view(), name='detail'),
     path('<uuid:pk>/invoice/', views.OrderInvoiceView.as_view(), name='invoice'),
+    path('<uuid:pk>/payment-intent/', views.PaymentIntentView.as_view(), name='payment_intent'),
     path('payment/success/', views.PaymentSuccessView.as_view(), name='payment_success'),
+    path('webhooks/stripe/', views.StripeWebhookView.as_view(), name='stripe_webhook'),
     path('payment/cancel/', views.PaymentCancelView.as_view(), name='payment_cancel'),
 ]
\ No newline at end of file
@@ -2,14 +2,20 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.views.generic import ListView, DetailView, TemplateView, View
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib import messages
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
+from django.db import transaction
+from django.urls import reverse
 from .models import Order, OrderItem, Payment
-from cart.models import Cart
+from .inventory import InsufficientStock, reserve_stock
+from .numbering import next_order_number
+from .payments import payment_intent_state, request_payment_intent
+from .webhooks import InvalidWebhook, record_event
+from cart.storage import get_cart_storage
+from cart.summary import update_cart_summary
 from accounts.models import Address
-import stripe
-
-stripe.api_key = settings.STRIPE_SECRET_KEY
 
 class OrderListView(LoginRequiredMixin, ListView):
     model = Order
@@ -18,7 +24,7 @@ class OrderListView(LoginRequiredMixin, ListView):
     paginate_by = 10
     
     def get_queryset(self):
-        return Order.objects.filter(user=self.request.user).order_by('-created_at')
+        return Order.objects.filter(user=self.request.user).with_total_items().order_by('-created_at')
 
 class OrderDetailView(LoginRequiredMixin, DetailView):
     model = Order
@@ -33,9 +39,9 @@ class CheckoutView(LoginRequiredMixin, TemplateView):
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        cart = Cart.objects.filter(user=self.request.user).first()
+        cart = get_cart_storage().load(f'user:{self.request.user.pk}')
         
-        if not cart or not cart.items.exists():
+        if not cart or not cart.total_items:
             messages.error(self.request, 'Your cart is empty')
             return redirect('cart:detail')
         
@@ -46,9 +52,10 @@ class CheckoutView(LoginRequiredMixin, TemplateView):
 
 class OrderCreateView(LoginRequiredMixin, View):
     def post(self, request):
-        cart = Cart.objects.filter(user=request.user).first()
+        owner = f'user:{request.user.pk}'
+        cart = get_cart_storage().load(owner, images=False)
         
-        if not cart or not cart.items.exists():
+        if not cart or not cart.total_items:
             return JsonResponse({'success': False, 'message': 'Cart is empty'})
         
         # Get form data
@@ -56,12 +63,40 @@ class OrderCreateView(LoginRequiredMixin, View):
         shipping_address_id = request.POST.get('shipping_address')
         payment_method = request.POST.get('payment_method')
         
+        if payment_method != 'stripe':
+            return JsonResponse({'success': False, 'message': 'Invalid payment method'})
+        
         billing_address = get_object_or_404(Address, id=billing_address_id, user=request.user)
         shipping_address = get_object_or_404(Address, id=shipping_address_id, user=request.user)
         
+        # Drawn before the checkout transaction, so a new block of numbers never keeps the counter locked
+        # while the order is created
+        order_number = next_order_number()
+        try:
+            order = self.create_order(request, cart, billing_address, shipping_address, payment_method, order_number)
+        except InsufficientStock as e:
+            return JsonResponse({'success': False, 'message': str(e)})
+        
+        # Clear cart
+        get_cart_storage().clear(owner)
+        update_cart_summary(request)
+        
+        # The payment intent is created by the outbox worker; the checkout page polls for it
+        return JsonResponse({
+            'success': True,
+            'order_id': str(order.id),
+            'payment_url': reverse('orders:payment_intent', args=[order.id]),
+        })
+    
+    @transaction.atomic
+    def create_order(self, request, cart, billing_address, shipping_address, payment_method, order_number):
+        """Create the order, its items and payment, reserve stock and queue the payment intent, all or nothing"""
+        cart_items = cart.items.all()
+        
         # Create order
         order = Order.objects.create(
             user=request.user,
+            order_number=order_number,
             billing_first_name=billing_address.first_name,
             billing_last_name=billing_address.last_name,
             billing_email=request.user.email,
@@ -84,52 +119,40 @@ class OrderCreateView(LoginRequiredMixin, View):
             total_amount=cart.total_price,
         )
         
-        # Create order items
-        for cart_item in cart.items.all():
-            OrderItem.objects.create(
-                order=order,
-                product=cart_item.product,
-                variant=cart_item.variant,
-                product_name=cart_item.product.name,
-                product_sku=cart_item.product.sku,
-                variant_name=cart_item.variant.name if cart_item.variant else '',
-                quantity=cart_item.quantity,
-                unit_price=cart_item.unit_price,
-                total_price=cart_item.total_price,
-            )
+        # Create order items in one round trip
+        order_items = OrderItem.objects.bulk_create([
+            OrderItem.from_cart_item(order, cart_item) for cart_item in cart_items
+        ])
         
-        # Process payment
-        if payment_method == 'stripe':
-            try:
-                # Create Stripe payment intent
-                intent = stripe.PaymentIntent.create(
-                    amount=int(order.total_amount * 100),  # Convert to cents
-                    currency='usd',
-                    metadata={'order_id': str(order.id)}
-                )
-                
-                # Create payment record
-                Payment.objects.create(
-                    order=order,
-                    payment_method='stripe',
-                    amount=order.total_amount,
-                    transaction_id=intent.id,
-                )
-                
-                # Clear cart
-                cart.clear()
-                
-                return JsonResponse({
-                    'success': True,
-                    'client_secret': intent.client_secret,
-                    'order_id': str(order.id)
-                })
-                
-            except stripe.error.StripeError as e:
-                order.delete()
-                return JsonResponse({'success': False, 'message': str(e)})
+        reserve_stock(order, order_items)
         
-        return JsonResponse({'success': False, 'message': 'Invalid payment method'})
+        payment = Payment.objects.create(
+            order=order,
+            payment_method=payment_method,
+            amount=order.total_amount,
+        )
+        request_payment_intent(order, payment)
+        return order
+
+class PaymentIntentView(LoginRequiredMixin, View):
+    """Polled by the checkout page until the order's payment intent has been created"""
+    
+    def get(self, request, pk):
+        payment = get_object_or_404(
+            Payment.objects.select_related('order'), order_id=pk, order__user=request.user
+        )
+        return JsonResponse(payment_intent_state(payment))
+
+@method_decorator(csrf_exempt, name='dispatch')
+class StripeWebhookView(View):
+    """Queues verified Stripe events for orders.webhooks.process_events and acknowledges at once"""
+    
+    def post(self, request):
+        try:
+            record_event(request.body, request.META.get('HTTP_STRIPE_SIGNATURE', ''))
+        except InvalidWebhook:
+            return HttpResponse(status=400)
+        return HttpResponse(status=200)
 
 class PaymentSuccessView(TemplateView):
     template_name = 'orders/payment_success.html'
@@ -0,0 +1,192 @@
+"""Stripe webhook ingestion.
+
+The endpoint only verifies the signature and appends the event to the
+WebhookEvent table, so bursts of deliveries cost one INSERT each and Stripe
+gets its 200 straight away. process_events() then works through the queue
+in batches: it skips event ids it has already seen, folds the events of a
+batch into the final status of each payment, and writes every payment,
+order and stock reservation change of the batch with a handful of UPDATEs
+in one transaction.
+"""
+import json
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+import stripe
+
+from .inventory import InsufficientStock, commit_reservations, release_reservations, reserve_stock
+from .models import Order, Payment, StockReservation, WebhookEvent
+from .payments import request_refund
+
+logger = logging.getLogger(__name__)
+
+# Payment status an event moves a payment to
+EVENT_PAYMENT_STATUS = {
+    'payment_intent.succeeded': 'completed',
+    'payment_intent.payment_failed': 'failed',
+    'payment_intent.canceled': 'cancelled',
+    'charge.refunded': 'refunded',
+}
+
+# Payment statuses each status may be reached from; anything else is a stale or out of order event
+ALLOWED_FROM = {
+    # A payment cancelled when its stock expired can still have gone through at the gateway
+    'completed': {'pending', 'failed', 'cancelled'},
+    'failed': {'pending'},
+    'cancelled': {'pending', 'failed'},
+    'refunded': {'completed'},
+}
+
+# (Order.payment_status, Order.status and the order statuses it may replace) for each payment status
+ORDER_UPDATES = {
+    'completed': ('paid', 'confirmed', {'pending'}),
+    'failed': ('failed', None, set()),
+    'cancelled': ('failed', 'cancelled', {'pending'}),
+    'refunded': ('refunded', 'refunded', {'pending', 'confirmed', 'processing', 'shipped', 'delivered'}),
+}
+
+
+class InvalidWebhook(Exception):
+    """Raised for a delivery that is not a correctly signed Stripe event"""
+
+
+def record_event(payload, signature):
+    """Verify a delivery and queue it; payload is the raw request body"""
+    if not settings.STRIPE_WEBHOOK_SECRET:
+        raise InvalidWebhook('Webhook secret is not configured')
+    try:
+        payload = payload.decode('utf-8')
+        stripe.WebhookSignature.verify_header(payload, signature, settings.STRIPE_WEBHOOK_SECRET)
+        event = json.loads(payload)
+        return WebhookEvent.objects.create(event_id=event['id'], event_type=event['type'], payload=event)
+    except (UnicodeDecodeError, ValueError, KeyError, TypeError, stripe.error.SignatureVerificationError) as e:
+        raise InvalidWebhook(str(e))
+
+
+def intent_id(event):
+    """Id of the payment intent an event is about"""
+    obj = event.get('data', {}).get('object', {})
+    if event.get('type') == 'charge.refunded':
+        # Partial refunds leave the payment completed
+        return obj.get('payment_intent') if obj.get('refunded') else None
+    return obj.get('id')
+
+
+def process_events(batch_size=1000):
+    """Apply the next batch of queued events; returns how many events were taken off the queue"""
+    with transaction.atomic():
+        events = list(
+            WebhookEvent.objects.select_for_update(skip_locked=True)
+            .filter(processed_at__isnull=True).order_by('id')[:batch_size]
+        )
+        if not events:
+            return 0
+
+        seen = set(WebhookEvent.objects.filter(
+            event_id__in={event.event_id for event in events}, processed_at__isnull=False,
+        ).values_list('event_id', flat=True))
+        outcome = {}
+        wanted = []
+        for event in events:
+            if event.event_id in seen:
+                outcome[event.pk] = 'duplicate'
+                continue
+            seen.add(event.event_id)
+            target = EVENT_PAYMENT_STATUS.get(event.event_type)
+            intent = intent_id(event.payload) if target else None
+            if intent:
+                wanted.append((event.payload.get('created', 0), event.pk, intent, target))
+            else:
+                outcome[event.pk] = 'ignored'
+
+        payments = {
+            payment['transaction_id']: payment
+            for payment in Payment.objects.select_for_update().filter(
+                transaction_id__in={intent for created, pk, intent, target in wanted}
+            ).values('pk', 'order_id', 'transaction_id', 'status')
+        }
+        # Fold each payment's events, oldest first, into the status it ends up in
+        final = {}
+        for created, pk, intent, target in sorted(wanted):
+            payment = payments.get(intent)
+            if payment is None:
+                outcome[pk] = 'ignored'
+                continue
+            current = final.get(intent, payment['status'])
+            if current in ALLOWED_FROM[target]:
+                final[intent] = target
+                outcome[pk] = 'applied'
+            else:
+                outcome[pk] = 'ignored'
+
+        apply_payment_statuses({
+            payments[intent]['pk']: (payments[intent]['order_id'], status)
+            for intent, status in final.items() if status != payments[intent]['status']
+        })
+
+        by_outcome = defaultdict(list)
+        for pk, status in outcome.items():
+            by_outcome[status].append(pk)
+        now = timezone.now()
+        for status, pks in by_outcome.items():
+            WebhookEvent.objects.filter(pk__in=pks).update(status=status, processed_at=now)
+    return len(events)
+
+
+def apply_payment_statuses(changes):
+    """Write {payment pk: (order id, new status)} with one UPDATE per status and table"""
+    grouped = defaultdict(list)
+    for payment_pk, (order_id, status) in changes.items():
+        grouped[status].append((payment_pk, order_id))
+    for status, rows in grouped.items():
+        payment_pks = [payment_pk for payment_pk, order_id in rows]
+        order_ids = [order_id for payment_pk, order_id in rows]
+        Payment.objects.filter(pk__in=payment_pks).update(status=status, updated_at=timezone.now())
+
+        payment_status, order_status, replaces = ORDER_UPDATES[status]
+        Order.objects.filter(pk__in=order_ids).update(payment_status=payment_status, updated_at=timezone.now())
+        if order_status:
+            Order.objects.filter(pk__in=order_ids, status__in=replaces).update(status=order_status)
+
+        reservations = StockReservation.objects.filter(order_id__in=order_ids)
+        if status == 'completed':
+            commit_reservations(reservations)
+            retake_released_stock(order_ids)
+        elif status == 'cancelled':
+            release_reservations(reservations)
+
+
+def retake_released_stock(order_ids):
+    """Take stock again for paid orders whose reservations were released before the payment arrived.
+
+    Orders that get it are confirmed. For the others the stock has gone to
+    someone else, so they stay cancelled and their payment is refunded.
+    """
+    held = StockReservation.objects.filter(order_id__in=order_ids, status__in=('reserved', 'committed'))
+    lapsed = Order.objects.filter(
+        pk__in=order_ids, stock_reservations__status='released',
+    ).exclude(pk__in=held.values('order_id')).distinct().select_related('payment').prefetch_related('items')
+    for order in lapsed:
+        try:
+            reserve_stock(order, order.items.all())
+        except InsufficientStock:
+            logger.warning('Order %s was paid after its stock was released and sold; refunding', order.order_number)
+            Order.objects.filter(pk=order.pk).update(status='cancelled', updated_at=timezone.now())
+            request_refund(order, order.payment)
+            continue
+        commit_reservations(order.stock_reservations.all())
+        Order.objects.filter(pk=order.pk).update(status='confirmed', updated_at=timezone.now())
+
+
+def drain_events(batch_size=1000):
+    """Process batches until the queue is empty; returns the number of events taken off it"""
+    total = 0
+    while True:
+        processed = process_events(batch_size)
+        total += processed
+        if processed < batch_size:
+            return total
@@ -18,11 +18,12 @@ class CategoryAdmin(admin.ModelAdmin):
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name', 'category', 'price', 'stock_quantity', 'is_active', 'is_featured', 'created_at')
+    list_display = ('name', 'category', 'price', 'stock_quantity', 'rating_avg', 'rating_count', 'is_active', 'is_featured', 'created_at')
     list_filter = ('category', 'is_active', 'is_featured', 'created_at')
     search_fields = ('name', 'description', 'sku')
     prepopulated_fields = {'slug': ('name',)}
     inlines = [ProductImageInline, ProductVariantInline]
+    readonly_fields = ('rating_avg', 'rating_count')
     
     fieldsets = (
         ('Basic Information', {
@@ -38,6 +39,10 @@ class ProductAdmin(admin.ModelAdmin):
         ('Status', {
             'fields': ('is_active', 'is_featured')
         }),
+        ('Reviews', {
+            'fields': ('rating_avg', 'rating_count'),
+            'classes': ('collapse',)
+        }),
         ('SEO', {
             'fields': ('meta_title', 'meta_description'),
             'classes': ('collapse',)
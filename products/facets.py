@@ -0,0 +1,199 @@
+"""Facet filters and counts for the product listings.
+
+The facet values of every active product (category, price band, stock, sale
+and variant attributes) are denormalised into ProductFacet rows. Counts for
+all facets come from one GROUP BY over that table, plus one more for each
+facet with a selection so its other values still show what they would add.
+Counts are cached until the catalog changes.
+
+Rows are refreshed when products, variants or categories are saved. Checkout
+changes stock with queryset updates instead (see orders.inventory), so it
+refreshes the stock facet of the products it touches itself; beat runs
+refresh_facets every hour to catch any other change made that way.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+
+from core.cache import PRODUCTS, cache_version, invalidate_tags
+from .models import Product, ProductFacet
+
+# (value, label, lower bound, upper bound) of each price band
+PRICE_BANDS = (
+    ('0-25', 'Under $25', 0, 25),
+    ('25-50', '$25 to $50', 25, 50),
+    ('50-100', '$50 to $100', 50, 100),
+    ('100-250', '$100 to $250', 100, 250),
+    ('250+', '$250 and above', 250, None),
+)
+ATTRIBUTE_PREFIX = 'attr:'
+FLAG_FACETS = {
+    'stock': ('in_stock', 'Availability', 'In stock'),
+    'sale': ('on_sale', 'Deals', 'On sale'),
+}
+
+
+def price_band(price):
+    for value, label, lower, upper in PRICE_BANDS:
+        if upper is None or price < upper:
+            return value
+
+
+def facet_values(product):
+    """Set of (facet, value) pairs of a product with its category and variants loaded"""
+    if not product.is_active:
+        return set()
+    values = {('category', product.category.slug), ('price', price_band(product.price))}
+    if product.is_in_stock:
+        values.add(('stock', 'in_stock'))
+    if product.is_on_sale:
+        values.add(('sale', 'on_sale'))
+    for variant in product.variants.all():
+        values.add((ATTRIBUTE_PREFIX + variant.name, variant.value))
+    return values
+
+
+def refresh_facets(product_ids=None, batch_size=1000):
+    """Rebuild the facet rows of the given products, or of the whole catalog; returns rows written"""
+    queryset = Product.objects.all()
+    rows = ProductFacet.objects.all()
+    if product_ids is not None:
+        product_ids = list(product_ids)
+        queryset = queryset.filter(pk__in=product_ids)
+        rows = rows.filter(product_id__in=product_ids)
+    queryset = queryset.select_related('category').prefetch_related('variants').order_by('pk')
+
+    written = 0
+    batch = []
+    with transaction.atomic():
+        rows.delete()
+        for product in queryset.iterator(chunk_size=batch_size):
+            batch += [
+                ProductFacet(product=product, facet=facet, value=value)
+                for facet, value in facet_values(product)
+            ]
+            if len(batch) >= batch_size:
+                ProductFacet.objects.bulk_create(batch)
+                written += len(batch)
+                batch = []
+        if batch:
+            ProductFacet.objects.bulk_create(batch)
+            written += len(batch)
+    invalidate_tags(PRODUCTS)
+    return written
+
+
+def refresh_stock_facets(product_ids):
+    """Bring the stock facet rows of the given products in line with their stock; returns rows changed"""
+    product_ids = list(product_ids)
+    if not product_ids:
+        return 0
+    value = FLAG_FACETS['stock'][0]
+    in_stock = set(Product.objects.filter(
+        pk__in=product_ids, is_active=True, stock_quantity__gt=0,
+    ).values_list('pk', flat=True))
+    listed = set(ProductFacet.objects.filter(
+        product_id__in=product_ids, facet='stock', value=value,
+    ).values_list('product_id', flat=True))
+    gone, back = listed - in_stock, in_stock - listed
+    if gone:
+        ProductFacet.objects.filter(product_id__in=gone, facet='stock', value=value).delete()
+    if back:
+        ProductFacet.objects.bulk_create([
+            ProductFacet(product_id=product_id, facet='stock', value=value) for product_id in back
+        ])
+    if gone or back:
+        invalidate_tags(PRODUCTS)
+    return len(gone) + len(back)
+
+
+def selections_from_query(params, hidden=()):
+    """Facet selections of a request: {facet: [values]}, OR within a facet and AND across facets"""
+    selections = {}
+    for facet in ('category', 'price', 'stock', 'sale'):
+        values = [value for value in params.getlist(facet) if value]
+        if values and facet not in hidden:
+            selections[facet] = values
+    for item in params.getlist('attr'):
+        name, separator, value = item.partition(':')
+        if separator and name and value:
+            selections.setdefault(ATTRIBUTE_PREFIX + name, []).append(value)
+    return selections
+
+
+class FacetSearch:
+    """Facet selections applied to a base product queryset"""
+
+    def __init__(self, queryset, selections):
+        self.queryset = queryset
+        self.selections = selections
+
+    def filter(self, exclude=None):
+        """The base queryset narrowed by every selection except the exclude facet"""
+        queryset = self.queryset
+        for facet, values in self.selections.items():
+            if facet != exclude:
+                queryset = queryset.filter(pk__in=ProductFacet.objects.filter(
+                    facet=facet, value__in=values
+                ).values('product_id'))
+        return queryset
+
+    def count_rows(self, queryset, **filters):
+        return ProductFacet.objects.filter(
+            product__in=queryset.values('pk'), **filters
+        ).order_by().values_list('facet', 'value').annotate(count=Count('id'))
+
+    def compute_counts(self):
+        counts = {}
+        for facet, value, count in self.count_rows(self.filter()):
+            counts.setdefault(facet, {})[value] = count
+        for facet in self.selections:
+            counts[facet] = {
+                value: count for _, value, count in self.count_rows(self.filter(exclude=facet), facet=facet)
+            }
+        return counts
+
+    def counts(self):
+        """{facet: {value: number of products}}, cached until the catalog changes"""
+        selections = sorted((facet, sorted(values)) for facet, values in self.selections.items())
+        digest = hashlib.md5(
+            f'{self.queryset.query}|{selections}|{cache_version(PRODUCTS)}'.encode()
+        ).hexdigest()
+        key = f'facets:{digest}'
+        counts = cache.get(key)
+        if counts is None:
+            counts = self.compute_counts()
+            cache.set(key, counts, settings.CATALOG_CACHE_TIMEOUT)
+        return counts
+
+    def sidebar(self, categories=(), hidden=()):
+        """Facet groups for products/product_filter.html, skipping empty unselected options"""
+        counts = self.counts()
+
+        def group(facet, label, param, options):
+            selected = self.selections.get(facet, [])
+            items = []
+            for value, option_label, param_value in options:
+                count = counts.get(facet, {}).get(value, 0)
+                if count or value in selected:
+                    items.append({
+                        'param': param, 'value': param_value, 'label': option_label,
+                        'count': count, 'selected': value in selected,
+                    })
+            if items and facet not in hidden:
+                groups.append({'facet': facet, 'label': label, 'options': items})
+
+        groups = []
+        group('category', 'Categories', 'category',
+              [(category.slug, category.name, category.slug) for category in categories])
+        group('price', 'Price', 'price', [(value, label, value) for value, label, lower, upper in PRICE_BANDS])
+        for facet, (value, label, option_label) in FLAG_FACETS.items():
+            group(facet, label, facet, [(value, option_label, value)])
+        attributes = sorted(facet for facet in counts if facet.startswith(ATTRIBUTE_PREFIX))
+        for facet in attributes:
+            name = facet[len(ATTRIBUTE_PREFIX):]
+            group(facet, name, 'attr', [(value, value, f'{name}:{value}') for value in sorted(counts[facet])])
+        return groups
@@ -0,0 +1,361 @@
+"""In-memory bitmap index of the catalog for combinable listing filters.
+
+Every facet value of products.facets (category, price band, stock, sale,
+variant attributes) keeps a posting list of document numbers, turned on
+demand into an int bitset. A filter combination is answered by OR-ing the
+bitsets of the values selected within a facet and AND-ing across facets;
+pages are then read off presorted document orders, so a listing page never
+joins Product against ProductVariant.
+
+Like the autocomplete index (see search_index.py) each worker process keeps
+its own copy: it is built on first use, updated in place by the product
+signals of this process, and polls Product.updated_at every
+PRODUCT_INDEX_REFRESH seconds for changes made elsewhere.
+"""
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from django.conf import settings
+from django.utils import timezone
+
+from .facets import facet_values
+from .models import Product
+from .pagination import SORT_ORDERINGS, KeysetPaginator
+
+# Sorts the index can page by; a leading '-' in SORT_ORDERINGS walks them backwards
+SORTS = ('created_at', 'price', 'name', 'rating')
+
+
+def bitmap_from_docs(docs, size):
+    bits = bytearray(size // 8 + 1)
+    for doc in docs:
+        bits[doc >> 3] |= 1 << (doc & 7)
+    return int.from_bytes(bits, 'little')
+
+
+class FilterIndex:
+    """Bitmap index over products with presorted orders for paging.
+
+    Document numbers only ever grow: updating a product tombstones its old
+    document and appends a new one, and everything is renumbered once too
+    many tombstones pile up. Bitsets and sort orders are built lazily and
+    dropped or patched when the index changes.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.product_ids = array('Q')
+        self.created = array('d')
+        self.prices = array('d')
+        self.ratings = array('d')
+        self.rating_counts = array('I')
+        self.names = []
+        self.doc_by_product = {}
+        self.deleted = set()
+        self.lock = threading.RLock()
+        # Lazily built, see bitmap(), live() and order()
+        self.bitmaps = {}
+        self.live_bitmap = None
+        self.orders = {}
+
+    def __len__(self):
+        return len(self.doc_by_product)
+
+    def sort_key(self, sort):
+        if sort == 'created_at':
+            return lambda doc: (self.created[doc], self.product_ids[doc])
+        if sort == 'price':
+            return lambda doc: (self.prices[doc], self.product_ids[doc])
+        if sort == 'name':
+            return lambda doc: (self.names[doc], self.product_ids[doc])
+        return lambda doc: (self.ratings[doc], self.rating_counts[doc], self.product_ids[doc])
+
+    def add(self, product_id, values, price, created_at, name, rating_avg=0, rating_count=0):
+        """Index a product with its set of (facet, value) pairs, replacing any previous version"""
+        with self.lock:
+            self.remove(product_id)
+            doc = len(self.product_ids)
+            self.product_ids.append(product_id)
+            self.created.append(created_at.timestamp())
+            self.prices.append(float(price))
+            self.ratings.append(rating_avg)
+            self.rating_counts.append(rating_count)
+            self.names.append(name)
+            self.doc_by_product[product_id] = doc
+            self.live_bitmap = None
+            for pair in values:
+                self.postings.setdefault(pair, array('I')).append(doc)
+                self.bitmaps.pop(pair, None)
+            for sort, order in self.orders.items():
+                # Keep the built orders sorted instead of re-sorting the catalog
+                key = self.sort_key(sort)
+                order.insert(bisect_right(order, key(doc), key=key), doc)
+
+    def remove(self, product_id):
+        with self.lock:
+            doc = self.doc_by_product.pop(product_id, None)
+            if doc is None:
+                return
+            self.deleted.add(doc)
+            self.live_bitmap = None
+            if len(self.deleted) > max(1000, len(self.product_ids) // 4):
+                self.compact()
+
+    def compact(self):
+        """Renumber the live documents and drop tombstoned ones"""
+        with self.lock:
+            live = sorted(self.doc_by_product.values())
+            renumber = {old: new for new, old in enumerate(live)}
+            for name in ('product_ids', 'created', 'prices', 'ratings', 'rating_counts'):
+                column = getattr(self, name)
+                setattr(self, name, array(column.typecode, (column[old] for old in live)))
+            self.names = [self.names[old] for old in live]
+            self.doc_by_product = {product_id: renumber[doc] for product_id, doc in self.doc_by_product.items()}
+            for pair, docs in list(self.postings.items()):
+                kept = array('I', (renumber[doc] for doc in docs if doc in renumber))
+                if kept:
+                    self.postings[pair] = kept
+                else:
+                    del self.postings[pair]
+            self.deleted = set()
+            self.bitmaps = {}
+            self.live_bitmap = None
+            self.orders = {}
+
+    def bitmap(self, pair):
+        bits = self.bitmaps.get(pair)
+        if bits is None:
+            bits = self.bitmaps[pair] = bitmap_from_docs(self.postings.get(pair, ()), len(self.product_ids))
+        return bits
+
+    def live(self):
+        if self.live_bitmap is None:
+            bits = (1 << len(self.product_ids)) - 1
+            if self.deleted:
+                bits &= ~bitmap_from_docs(self.deleted, len(self.product_ids))
+            self.live_bitmap = bits
+        return self.live_bitmap
+
+    def order(self, sort):
+        """Every document, tombstoned ones included, in ascending order of sort"""
+        order = self.orders.get(sort)
+        if order is None:
+            order = self.orders[sort] = array('I', sorted(range(len(self.product_ids)), key=self.sort_key(sort)))
+        return order
+
+    def match(self, selections):
+        """Bitset of live documents matching {facet: [values]}: OR within a facet, AND across"""
+        with self.lock:
+            bits = self.live()
+            for facet, values in selections.items():
+                union = 0
+                for value in values:
+                    union |= self.bitmap((facet, value))
+                bits &= union
+            return bits
+
+    def count(self, selections):
+        return self.match(selections).bit_count()
+
+    def page(self, selections, sort, limit, after=None, backwards=False, min_price=None, max_price=None):
+        """Product ids of up to limit matches, in sort order, following product id after.
+
+        sort is one of SORTS, walked in descending order when it starts with
+        '-'. backwards reads the page preceding after instead, still returning
+        ids in the direction of travel. A product missing from the index
+        restarts from the beginning.
+        """
+        descending = sort.startswith('-')
+        sort = sort.lstrip('-')
+        if backwards:
+            descending = not descending
+        with self.lock:
+            size = len(self.product_ids)
+            bits = self.match(selections)
+            total = bits.bit_count()
+            if not total:
+                return []
+            order = self.order(sort)
+            key = self.sort_key(sort)
+
+            # Positions in the order still to be visited
+            start, stop, step = (len(order) - 1, -1, -1) if descending else (0, len(order), 1)
+            anchor = self.doc_by_product.get(after) if after is not None else None
+            if anchor is not None:
+                if descending:
+                    start = bisect_left(order, key(anchor), key=key) - 1
+                else:
+                    start = bisect_right(order, key(anchor), key=key)
+
+            def wanted(doc):
+                price = self.prices[doc]
+                return (min_price is None or price >= min_price) and (max_price is None or price <= max_price)
+
+            members = bits.to_bytes(size // 8 + 1, 'little')
+            if limit * size / total > size // 8:
+                # Few matches: pull them all out of the bitset rather than scanning the order
+                docs = [
+                    (index << 3) + bit
+                    for index, byte in enumerate(members) if byte
+                    for bit in range(8) if byte >> bit & 1
+                ]
+                docs.sort(key=key, reverse=descending)
+                if anchor is not None:
+                    anchor_key = key(anchor)
+                    docs = [doc for doc in docs if (key(doc) < anchor_key if descending else key(doc) > anchor_key)]
+                found = [doc for doc in docs if wanted(doc)][:limit]
+            else:
+                found = []
+                for position in range(start, stop, step):
+                    doc = order[position]
+                    if members[doc >> 3] >> (doc & 7) & 1 and wanted(doc):
+                        found.append(doc)
+                        if len(found) == limit:
+                            break
+            return [self.product_ids[doc] for doc in found]
+
+
+class ProductFilterIndex(FilterIndex):
+    """FilterIndex of active products that knows how to load itself from the database"""
+
+    def __init__(self):
+        super().__init__()
+        self.synced_at = None
+        self.checked_at = 0
+
+    def add_product(self, product):
+        """Index a product whose category and variants are loaded"""
+        values = facet_values(product)
+        if not values:
+            self.remove(product.pk)
+            return
+        self.add(
+            product.pk, values, product.price, product.created_at, product.name,
+            product.rating_avg, product.rating_count,
+        )
+
+    def load_products(self, queryset, batch_size=2000):
+        queryset = queryset.select_related('category').prefetch_related('variants')
+        for product in queryset.iterator(chunk_size=batch_size):
+            self.add_product(product)
+
+    def load(self, queryset=None, batch_size=2000):
+        if queryset is None:
+            queryset = Product.objects.all()
+        self.synced_at = timezone.now()
+        self.checked_at = time.monotonic()
+        self.load_products(queryset.order_by('pk'), batch_size)
+        return self
+
+    def refresh(self):
+        """Pick up products changed by other processes since the last sync"""
+        interval = settings.PRODUCT_INDEX_REFRESH
+        if not interval or time.monotonic() - self.checked_at < interval:
+            return
+        self.checked_at = time.monotonic()
+        since, self.synced_at = self.synced_at, timezone.now()
+        self.load_products(Product.objects.filter(updated_at__gte=since))
+
+
+class FilterIndexPaginator(KeysetPaginator):
+    """KeysetPaginator that reads page ids from a FilterIndex instead of seeking in SQL.
+
+    Cursors are the same signed tokens, so they stay valid if the index is
+    switched off; only the product id at the end of each is used here.
+    """
+
+    def __init__(self, index, selections, sort, queryset, ordering, per_page, min_price=None, max_price=None):
+        super().__init__(queryset, ordering, per_page)
+        self.index = index
+        self.selections = selections
+        self.sort = sort
+        self.min_price = min_price
+        self.max_price = max_price
+
+    def page(self, cursor=None):
+        after, direction = None, 'next'
+        if cursor:
+            values, direction = self.decode_cursor(cursor)
+            after = values[-1]
+        product_ids = self.index.page(
+            self.selections, self.sort, self.per_page + 1, after=after, backwards=direction == 'prev',
+            min_price=self.min_price, max_price=self.max_price,
+        )
+        products = self.queryset.in_bulk(product_ids)
+        rows = [products[product_id] for product_id in product_ids if product_id in products]
+        return self.make_page(rows, direction, bool(cursor))
+
+
+def _price_param(value):
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+class FilterIndexMixin:
+    """KeysetPaginationMixin add-on that pages with the filter index when CATALOG_FILTER_INDEX is on.
+
+    The view sets self.facet_search in get_queryset; the index answers the
+    same selections plus get_fixed_selections() and the min/max price range.
+    """
+
+    def get_fixed_selections(self):
+        return {}
+
+    def get_keyset_paginator(self, queryset, page_size):
+        if not settings.CATALOG_FILTER_INDEX:
+            return super().get_keyset_paginator(queryset, page_size)
+        sort = self.get_sort()
+        return FilterIndexPaginator(
+            get_filter_index(),
+            dict(self.facet_search.selections, **self.get_fixed_selections()),
+            sort,
+            Product.objects.with_main_image(),
+            SORT_ORDERINGS[sort],
+            page_size,
+            min_price=_price_param(self.request.GET.get('min_price')),
+            max_price=_price_param(self.request.GET.get('max_price')),
+        )
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_filter_index():
+    """Return this process's filter index, building it on first use"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = ProductFilterIndex().load()
+                return _index
+    _index.refresh()
+    return _index
+
+
+def loaded_filter_index():
+    """Return the filter index if this process has built one, without building it"""
+    return _index
+
+
+def update_loaded_filter_index(product_ids):
+    """Re-read the given products into this process's filter index, if it has one"""
+    index = loaded_filter_index()
+    if index is None:
+        return
+    product_ids = set(product_ids)
+    products = Product.objects.filter(pk__in=product_ids).select_related('category').prefetch_related('variants')
+    for product in products:
+        index.add_product(product)
+        product_ids.discard(product.pk)
+    for product_id in product_ids:
+        index.remove(product_id)
+
+
+def reset_filter_index():
+    global _index
+    _index = None
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from products.ratings import backfill_ratings
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored review rating aggregates of every product'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        total = backfill_ratings(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Updated ratings of {total} reviewed products'))
@@ -0,0 +1,75 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from products.search_index import InvertedIndex
+
+ADJECTIVES = [
+    'wireless', 'premium', 'organic', 'classic', 'portable', 'smart', 'vintage', 'compact', 'deluxe',
+    'ergonomic', 'waterproof', 'lightweight', 'stainless', 'bamboo', 'leather', 'cotton', 'ceramic',
+    'digital', 'rechargeable', 'foldable', 'adjustable', 'handmade', 'insulated', 'magnetic',
+]
+NOUNS = [
+    'headphones', 'speaker', 'kettle', 'backpack', 'jacket', 'lamp', 'watch', 'blender', 'mug', 'sneakers',
+    'keyboard', 'mouse', 'charger', 'tent', 'bottle', 'notebook', 'pillow', 'blanket', 'camera', 'drone',
+    'toaster', 'scarf', 'wallet', 'sunglasses', 'desk', 'chair', 'skillet', 'yoga', 'mat', 'helmet',
+]
+CATEGORIES = ['Electronics', 'Clothing', 'Home & Garden', 'Sports & Outdoors', 'Books', 'Health & Beauty']
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = 'Measure autocomplete latency of the in-memory index over synthetic products'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100_000)
+        parser.add_argument('--queries', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        names = []
+
+        index = InvertedIndex()
+        started = time.perf_counter()
+        for product_id in range(1, options['products'] + 1):
+            words = rng.sample(ADJECTIVES, 2) + [rng.choice(NOUNS)]
+            name = f"{' '.join(words).title()} {rng.randint(100, 999)}"
+            names.append(name)
+            index.add(
+                product_id,
+                name,
+                short_description=f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} for everyday use',
+                sku=f'SKU-{product_id:07d}',
+                category=rng.choice(CATEGORIES),
+                price=f'{rng.uniform(5, 500):.2f}',
+            )
+        build_time = time.perf_counter() - started
+
+        queries = []
+        for i in range(options['queries']):
+            words = rng.choice(names).lower().split()[:rng.randint(1, 3)]
+            words[-1] = words[-1][:rng.randint(1, len(words[-1]))]
+            queries.append(' '.join(words))
+
+        latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            index.search(query, limit=8)
+            latencies.append((time.perf_counter() - started) * 1000)
+        latencies.sort()
+
+        self.stdout.write(
+            f"products={len(index)} tokens={len(index.postings)} build={build_time:.1f}s "
+            f"queries={len(latencies)}"
+        )
+        self.stdout.write(
+            f"latency_ms p50={percentile(latencies, 0.50):.2f} p95={percentile(latencies, 0.95):.2f} "
+            f"p99={percentile(latencies, 0.99):.2f} mean={statistics.mean(latencies):.2f} "
+            f"max={latencies[-1]:.2f}"
+        )
@@ -0,0 +1,128 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from products.filter_index import ProductFilterIndex
+from products.models import Category, Product, ProductVariant
+from products.pagination import SORT_ORDERINGS
+
+from .benchmark_autocomplete import ADJECTIVES, CATEGORIES, NOUNS, percentile
+
+COLORS = ['Black', 'White', 'Red', 'Blue', 'Green', 'Grey', 'Navy', 'Beige']
+SIZES = ['XS', 'S', 'M', 'L', 'XL', 'XXL']
+PRICE_RANGES = [(None, None), (None, 50), (50, 200), (100, None)]
+
+
+class Command(BaseCommand):
+    help = 'Compare combined listing filters on the bitmap filter index against the ORM join path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=200_000)
+        parser.add_argument('--variants', type=int, default=5, help='Variants per product')
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        # Everything is generated inside a transaction that is rolled back at the end
+        with transaction.atomic():
+            started = time.perf_counter()
+            categories = self.create_catalog(rng, options['products'], options['variants'])
+            self.stdout.write(
+                f"products={options['products']} variants={options['products'] * options['variants']} "
+                f"generate={time.perf_counter() - started:.1f}s"
+            )
+
+            started = time.perf_counter()
+            index = ProductFilterIndex().load(Product.objects.filter(sku__startswith='BENCH-'))
+            build_time = time.perf_counter() - started
+            # Sort orders are built on first use; build them before timing queries
+            started = time.perf_counter()
+            for sort in SORT_ORDERINGS:
+                index.page({}, sort, 1)
+            self.stdout.write(f'index build={build_time:.1f}s sorts={time.perf_counter() - started:.1f}s')
+
+            queries = [self.random_query(rng, categories) for i in range(options['queries'])]
+            orm_times, index_times = [], []
+            for selections, sort, min_price, max_price in queries:
+                started = time.perf_counter()
+                expected = self.orm_page(selections, sort, min_price, max_price)
+                orm_times.append((time.perf_counter() - started) * 1000)
+
+                started = time.perf_counter()
+                ids = index.page(selections, sort, 13, min_price=min_price, max_price=max_price)
+                list(Product.objects.in_bulk(ids))
+                index_times.append((time.perf_counter() - started) * 1000)
+                if ids != expected:
+                    self.stderr.write(f'Mismatch for {selections} {sort}: {ids} != {expected}')
+
+            for label, latencies in (('orm', orm_times), ('index', index_times)):
+                latencies.sort()
+                self.stdout.write(
+                    f'{label:<6} latency_ms p50={percentile(latencies, 0.50):.2f} '
+                    f'p95={percentile(latencies, 0.95):.2f} p99={percentile(latencies, 0.99):.2f} '
+                    f'mean={statistics.mean(latencies):.2f} max={latencies[-1]:.2f}'
+                )
+            transaction.set_rollback(True)
+
+    def create_catalog(self, rng, count, variants_per_product, batch_size=5000):
+        categories = [Category.objects.get_or_create(name=name)[0] for name in CATEGORIES]
+        created = timezone.now()
+        products = []
+        for number in range(count):
+            price = round(rng.uniform(5, 400), 2)
+            products.append(Product(
+                name=f'{rng.choice(ADJECTIVES).title()} {rng.choice(NOUNS)} {number}',
+                slug=f'bench-{number}', description='Benchmark product', category=rng.choice(categories),
+                price=price, compare_price=price * 1.2 if rng.random() < 0.2 else None,
+                sku=f'BENCH-{number}', stock_quantity=rng.choice([0, 0, 3, 10, 50]),
+                created_at=created, updated_at=created,
+            ))
+        products = Product.objects.bulk_create(products, batch_size=batch_size)
+
+        variants = []
+        colors_per_product = (variants_per_product + 1) // 2
+        for product in products:
+            attributes = [('Color', color) for color in rng.sample(COLORS, colors_per_product)]
+            attributes += [('Size', size) for size in rng.sample(SIZES, variants_per_product - colors_per_product)]
+            for name, value in attributes:
+                variants.append(ProductVariant(
+                    product=product, name=name, value=value, sku=f'{product.sku}-{name}-{value}', stock_quantity=5,
+                ))
+            if len(variants) >= batch_size:
+                ProductVariant.objects.bulk_create(variants)
+                variants = []
+        ProductVariant.objects.bulk_create(variants)
+        return categories
+
+    def random_query(self, rng, categories):
+        selections = {'category': [rng.choice(categories).slug]}
+        if rng.random() < 0.8:
+            selections['attr:Color'] = rng.sample(COLORS, rng.randint(1, 2))
+        if rng.random() < 0.5:
+            selections['attr:Size'] = [rng.choice(SIZES)]
+        if rng.random() < 0.6:
+            selections['stock'] = ['in_stock']
+        min_price, max_price = rng.choice(PRICE_RANGES)
+        return selections, rng.choice(list(SORT_ORDERINGS)), min_price, max_price
+
+    def orm_page(self, selections, sort, min_price, max_price):
+        """The same page through the joins a listing would otherwise run"""
+        queryset = Product.objects.filter(is_active=True, sku__startswith='BENCH-')
+        queryset = queryset.filter(category__slug__in=selections['category'])
+        for facet in ('attr:Color', 'attr:Size'):
+            if facet in selections:
+                queryset = queryset.filter(
+                    variants__name=facet.split(':', 1)[1], variants__value__in=selections[facet]
+                )
+        if 'stock' in selections:
+            queryset = queryset.filter(stock_quantity__gt=0)
+        if min_price is not None:
+            queryset = queryset.filter(price__gte=min_price)
+        if max_price is not None:
+            queryset = queryset.filter(price__lte=max_price)
+        return list(queryset.distinct().order_by(*SORT_ORDERINGS[sort]).values_list('pk', flat=True)[:13])
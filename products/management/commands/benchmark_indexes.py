@@ -0,0 +1,159 @@
+import random
+import secrets
+import time
+from datetime import timedelta
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from cart.models import Cart
+from orders.models import Order
+from products.models import Category, Product
+
+from .benchmark_autocomplete import ADJECTIVES, CATEGORIES, NOUNS, percentile
+
+User = get_user_model()
+
+# The indexes added for the catalog, order history and guest cart lookups
+INDEXES = {
+    Product: [
+        'product_active_created_idx', 'product_active_price_idx', 'product_active_name_idx',
+        'product_category_created_idx', 'product_category_price_idx', 'product_featured_idx',
+    ],
+    Order: ['order_user_created_idx'],
+    Cart: ['cart_guest_token_idx'],
+}
+
+
+def generate_products(rng, count, categories):
+    """Products in the shape of create_sample_data.py, created over the last two years"""
+    now = timezone.now()
+    for number in range(count):
+        created = now - timedelta(seconds=rng.randrange(2 * 365 * 86400))
+        price = round(rng.uniform(5, 400), 2)
+        yield Product(
+            name=f'{rng.choice(ADJECTIVES).title()} {rng.choice(NOUNS)} {number}',
+            slug=f'bench-index-{number}', description='Benchmark product', category=rng.choice(categories),
+            price=price, compare_price=round(price * 1.2, 2) if rng.random() < 0.2 else None,
+            sku=f'BENCH-INDEX-{number}', stock_quantity=rng.choice([0, 3, 10, 50]),
+            is_active=rng.random() < 0.9, is_featured=rng.random() < 0.02,
+            created_at=created, updated_at=created,
+        )
+
+
+def generate_orders(rng, count, users):
+    now = timezone.now()
+    for number in range(count):
+        created = now - timedelta(seconds=rng.randrange(365 * 86400))
+        yield Order(
+            user=rng.choice(users), order_number=f'BENCH{number:010d}', billing_email='bench@example.com',
+            subtotal=10, total_amount=10, created_at=created, updated_at=created,
+        )
+
+
+def generate_guest_carts(count):
+    for number in range(count):
+        yield Cart(session_key=secrets.token_urlsafe(30))
+
+
+def bulk_insert(model, objects, batch_size):
+    while True:
+        batch = list(islice(objects, batch_size))
+        if not batch:
+            return
+        model.objects.bulk_create(batch)
+
+
+class Command(BaseCommand):
+    help = 'Seed a large catalog and compare query plans and latencies without and with the listing indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1_000_000)
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--orders', type=int, default=200_000)
+        parser.add_argument('--carts', type=int, default=200_000, help='Guest carts')
+        parser.add_argument('--repeat', type=int, default=50, help='Runs of each query per measurement')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+        # Everything is generated inside a transaction that is rolled back at the end
+        with transaction.atomic():
+            started = time.perf_counter()
+            categories = [Category.objects.get_or_create(name=name)[0] for name in CATEGORIES]
+            users = User.objects.bulk_create([
+                User(username=f'bench-index-{i}', email=f'bench-index-{i}@example.com')
+                for i in range(options['users'])
+            ])
+            bulk_insert(Product, generate_products(rng, options['products'], categories), batch_size)
+            bulk_insert(Order, generate_orders(rng, options['orders'], users), batch_size)
+            bulk_insert(Cart, generate_guest_carts(options['carts']), batch_size)
+            token = Cart.objects.filter(user__isnull=True).order_by('?').values_list('session_key', flat=True)[0]
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+            self.stdout.write(
+                f"products={options['products']} orders={options['orders']} guest_carts={options['carts']} "
+                f"generate={time.perf_counter() - started:.1f}s"
+            )
+
+            category = rng.choice(categories)
+            user = rng.choice(users)
+            queries = {
+                'catalog newest': Product.objects.filter(is_active=True).order_by('-created_at', '-id')[:13],
+                'catalog by price': Product.objects.filter(is_active=True).order_by('price', 'id')[:13],
+                'catalog by name': Product.objects.filter(is_active=True).order_by('name', 'id')[:13],
+                'category newest': Product.objects.filter(
+                    is_active=True, category=category,
+                ).order_by('-created_at', '-id')[:13],
+                'category price range': Product.objects.filter(
+                    is_active=True, category=category, price__gte=50, price__lte=200,
+                ).order_by('price', 'id')[:13],
+                'featured': Product.objects.filter(is_active=True, is_featured=True).order_by('-created_at')[:8],
+                'order history': Order.objects.filter(user=user).order_by('-created_at')[:10],
+                'guest cart': Cart.objects.filter(session_key=token, user__isnull=True),
+            }
+
+            after = self.measure('after', queries, options['repeat'])
+            with connection.cursor() as cursor:
+                for names in INDEXES.values():
+                    for name in names:
+                        cursor.execute(f'DROP INDEX {connection.ops.quote_name(name)}')
+            before = self.measure('before', queries, options['repeat'])
+
+            for label in queries:
+                (before_plan, before_times), (after_plan, after_times) = before[label], after[label]
+                self.stdout.write(self.style.MIGRATE_HEADING(label))
+                self.stdout.write(f'  before: {before_plan}')
+                self.stdout.write(f'  after:  {after_plan}')
+                self.stdout.write(
+                    f'  latency_ms p50 {percentile(before_times, 0.50):.3f} -> {percentile(after_times, 0.50):.3f} '
+                    f'p95 {percentile(before_times, 0.95):.3f} -> {percentile(after_times, 0.95):.3f}'
+                )
+            # Also puts the dropped indexes back
+            transaction.set_rollback(True)
+
+    def explain(self, phase, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            # A distinct statement per phase: SQLite keeps returning the plan it cached for the same text
+            cursor.execute(f'{connection.ops.explain_query_prefix()} {sql} -- {phase}', params)
+            return ' | '.join(str(row[-1]).strip() for row in cursor.fetchall())
+
+    def measure(self, phase, queries, repeat):
+        """{label: (query plan, sorted latencies in ms)}"""
+        results = {}
+        for label, queryset in queries.items():
+            plan = self.explain(phase, queryset)
+            latencies = []
+            for i in range(repeat):
+                started = time.perf_counter()
+                list(queryset.all())
+                latencies.append((time.perf_counter() - started) * 1000)
+            latencies.sort()
+            results[label] = (plan, latencies)
+        return results
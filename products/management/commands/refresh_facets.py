@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from products.facets import refresh_facets
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the product facet table used for listing filters and counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        total = refresh_facets(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Wrote {total} facet rows'))
@@ -0,0 +1,59 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE TABLE products_search_index ('
+            'product_id bigint PRIMARY KEY REFERENCES products_product (id) ON DELETE CASCADE, '
+            'document tsvector NOT NULL)'
+        )
+        schema_editor.execute(
+            'CREATE INDEX products_search_index_document ON products_search_index USING GIN (document)'
+        )
+    elif vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE products_search_index USING fts5('
+            'name, sku, category, short_description, description, '
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        )
+
+
+def build_search_index(apps, schema_editor):
+    """Index the existing catalog like rebuild_search_index, in one statement"""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        vector = ' || '.join(
+            f"setweight(to_tsvector('english'::regconfig, coalesce({column}, '')), '{weight}')"
+            for column, weight in (
+                ('p.name', 'A'), ('p.sku', 'A'), ('c.name', 'B'), ('p.short_description', 'C'), ('p.description', 'D'),
+            )
+        )
+        schema_editor.execute(
+            f'INSERT INTO products_search_index (product_id, document) SELECT p.id, {vector} '
+            'FROM products_product p JOIN products_category c ON c.id = p.category_id'
+        )
+    elif vendor == 'sqlite':
+        schema_editor.execute(
+            'INSERT INTO products_search_index (rowid, name, sku, category, short_description, description) '
+            'SELECT p.id, p.name, p.sku, c.name, p.short_description, p.description '
+            'FROM products_product p JOIN products_category c ON c.id = p.category_id'
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        schema_editor.execute('DROP TABLE IF EXISTS products_search_index')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.RunPython(build_search_index, migrations.RunPython.noop),
+    ]
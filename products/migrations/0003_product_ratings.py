@@ -0,0 +1,67 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:08
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def backfill_ratings(apps, schema_editor):
+    Product = apps.get_model('products', 'Product')
+    Review = apps.get_model('products', 'Review')
+    counts = {f'rating_{stars}_count': Count('id', filter=Q(rating=stars)) for stars in range(1, 6)}
+    rows = Review.objects.order_by().values('product').annotate(rating_count=Count('id'), **counts)
+    products = []
+    for row in rows:
+        product = Product(pk=row.pop('product'), **row)
+        product.rating_avg = sum(row[f'rating_{stars}_count'] * stars for stars in range(1, 6)) / row['rating_count']
+        products.append(product)
+    Product.objects.bulk_update(products, ['rating_avg', 'rating_count'] + list(counts), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_1_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_avg',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-rating_avg', '-rating_count', '-id'], name='product_rating_idx'),
+        ),
+        migrations.RunPython(backfill_ratings, migrations.RunPython.noop),
+    ]
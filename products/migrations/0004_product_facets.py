@@ -0,0 +1,56 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Upper bounds of the price bands in products.facets at the time of this migration
+PRICE_BANDS = (('0-25', 25), ('25-50', 50), ('50-100', 100), ('100-250', 250), ('250+', None))
+
+
+def build_facets(apps, schema_editor):
+    """Same rows as products.facets.refresh_facets, which cannot be used with historical models"""
+    Product = apps.get_model('products', 'Product')
+    ProductFacet = apps.get_model('products', 'ProductFacet')
+    queryset = Product.objects.filter(is_active=True).select_related('category').prefetch_related('variants')
+    batch = []
+    for product in queryset.order_by('pk').iterator(chunk_size=1000):
+        values = {
+            ('category', product.category.slug),
+            ('price', next(band for band, upper in PRICE_BANDS if upper is None or product.price < upper)),
+        }
+        if product.stock_quantity > 0:
+            values.add(('stock', 'in_stock'))
+        if product.compare_price and product.compare_price > product.price:
+            values.add(('sale', 'on_sale'))
+        for variant in product.variants.all():
+            values.add(('attr:' + variant.name, variant.value))
+        batch += [ProductFacet(product=product, facet=facet, value=value) for facet, value in values]
+        if len(batch) >= 1000:
+            ProductFacet.objects.bulk_create(batch)
+            batch = []
+    ProductFacet.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0003_product_ratings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductFacet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(max_length=110)),
+                ('value', models.CharField(max_length=100)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='facets', to='products.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['facet', 'value', 'product'], name='product_facet_lookup_idx')],
+                'unique_together': {('product', 'facet', 'value')},
+            },
+        ),
+        migrations.RunPython(build_facets, migrations.RunPython.noop),
+    ]
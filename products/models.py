@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Prefetch, Q
 from django.urls import reverse
 from django.utils.text import slugify
 
@@ -25,6 +26,14 @@ class Category(models.Model):
     def get_absolute_url(self):
         return reverse('products:category', kwargs={'slug': self.slug})
 
+def main_image_prefetch(lookup='images'):
+    """Prefetch only the main image of each product into product.main_images"""
+    return Prefetch(lookup, queryset=ProductImage.objects.filter(is_main=True), to_attr='main_images')
+
+class ProductQuerySet(models.QuerySet):
+    def with_main_image(self):
+        return self.prefetch_related(main_image_prefetch())
+
 class Product(models.Model):
     name = models.CharField(max_length=200)
     slug = models.SlugField(max_length=200, unique=True, blank=True)
@@ -44,8 +53,36 @@ class Product(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Review aggregates, maintained by products.ratings
+    rating_avg = models.FloatField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_1_count = models.PositiveIntegerField(default=0)
+    rating_2_count = models.PositiveIntegerField(default=0)
+    rating_3_count = models.PositiveIntegerField(default=0)
+    rating_4_count = models.PositiveIntegerField(default=0)
+    rating_5_count = models.PositiveIntegerField(default=0)
+
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-rating_avg', '-rating_count', '-id'], name='product_rating_idx'),
+            # Catalog listings only ever show active products, in the keyset orders of products.pagination
+            models.Index(fields=['-created_at', '-id'], name='product_active_created_idx', condition=Q(is_active=True)),
+            models.Index(fields=['price', 'id'], name='product_active_price_idx', condition=Q(is_active=True)),
+            models.Index(fields=['name', 'id'], name='product_active_name_idx', condition=Q(is_active=True)),
+            models.Index(
+                fields=['category', '-created_at', '-id'], name='product_category_created_idx',
+                condition=Q(is_active=True),
+            ),
+            models.Index(
+                fields=['category', 'price', 'id'], name='product_category_price_idx', condition=Q(is_active=True),
+            ),
+            models.Index(
+                fields=['-created_at'], name='product_featured_idx', condition=Q(is_active=True, is_featured=True),
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -72,8 +109,20 @@ class Product(models.Model):
     def is_in_stock(self):
         return self.stock_quantity > 0
 
+    @property
+    def rating_histogram(self):
+        """(stars, count, percentage) for 5 down to 1 stars"""
+        histogram = []
+        for stars in range(5, 0, -1):
+            count = getattr(self, f'rating_{stars}_count')
+            percentage = round(count * 100 / self.rating_count) if self.rating_count else 0
+            histogram.append((stars, count, percentage))
+        return histogram
+
     @property
     def main_image(self):
+        if hasattr(self, 'main_images'):
+            return self.main_images[0] if self.main_images else None
         return self.images.filter(is_main=True).first()
 
 class ProductImage(models.Model):
@@ -130,4 +179,23 @@ class Review(models.Model):
         ordering = ['-created_at']
 
     def __str__(self):
-        return f"{self.product.name} - {self.rating} stars by {self.user.email}"
\ No newline at end of file
+        return f"{self.product.name} - {self.rating} stars by {self.user.email}"
+
+class ProductFacet(models.Model):
+    """One facet value of an active product, e.g. ('price', '25-50') or ('attr:Color', 'Red').
+
+    Rebuilt by products.facets so facet counts are a single GROUP BY over
+    this table instead of joins against products and variants.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='facets')
+    facet = models.CharField(max_length=110)
+    value = models.CharField(max_length=100)
+
+    class Meta:
+        unique_together = ['product', 'facet', 'value']
+        indexes = [
+            models.Index(fields=['facet', 'value', 'product'], name='product_facet_lookup_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} {self.facet}={self.value}"
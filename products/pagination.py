@@ -0,0 +1,156 @@
+from django.core import signing
+from django.db.models import Q
+
+CURSOR_SALT = 'products.pagination.cursor'
+
+# Sort options offered by the catalog and the keyset each one pages by
+SORT_ORDERINGS = {
+    '-created_at': ('-created_at', '-id'),
+    'created_at': ('created_at', 'id'),
+    'price': ('price', 'id'),
+    '-price': ('-price', '-id'),
+    'name': ('name', 'id'),
+    '-name': ('-name', '-id'),
+    '-rating': ('-rating_avg', '-rating_count', '-id'),
+}
+DEFAULT_SORT = '-created_at'
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def _serialize(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, int):
+        return value
+    return str(value)
+
+
+class KeysetPage:
+    """One page of a keyset-paginated queryset, with opaque cursors for its neighbours"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """Paginate by seeking past the last row seen instead of using OFFSET.
+
+    The ordering must end in a unique field (the primary key) so that every
+    row has a distinct position. No COUNT(*) is issued, so there are no page
+    numbers: pages link to their neighbours with signed cursor tokens.
+    """
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.per_page = per_page
+
+    def encode_cursor(self, obj, direction):
+        values = [_serialize(getattr(obj, field.lstrip('-'))) for field in self.ordering]
+        return signing.dumps({'v': values, 'd': direction, 'o': self.ordering}, salt=CURSOR_SALT, compress=True)
+
+    def decode_cursor(self, token):
+        try:
+            payload = signing.loads(token, salt=CURSOR_SALT)
+        except signing.BadSignature:
+            raise InvalidCursor('Invalid cursor')
+        if tuple(payload.get('o', ())) != self.ordering or payload.get('d') not in ('next', 'prev'):
+            raise InvalidCursor('Cursor does not match the current sort')
+        return payload['v'], payload['d']
+
+    def seek(self, ordering, values):
+        """Rows strictly after values in the given ordering"""
+        condition = Q()
+        equal = {}
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        return condition
+
+    def page(self, cursor=None):
+        ordering = self.ordering
+        direction = 'next'
+        queryset = self.queryset
+        if cursor:
+            values, direction = self.decode_cursor(cursor)
+            if direction == 'prev':
+                ordering = tuple(field[1:] if field.startswith('-') else f'-{field}' for field in ordering)
+            queryset = queryset.filter(self.seek(ordering, values))
+
+        rows = list(queryset.order_by(*ordering)[:self.per_page + 1])
+        return self.make_page(rows, direction, bool(cursor))
+
+    def make_page(self, rows, direction, from_cursor):
+        """Build the page from up to per_page + 1 rows fetched in the direction of travel"""
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+
+        if direction == 'prev':
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, from_cursor
+
+        next_cursor = previous_cursor = None
+        if rows and has_next:
+            next_cursor = self.encode_cursor(rows[-1], 'next')
+        if rows and has_previous:
+            previous_cursor = self.encode_cursor(rows[0], 'prev')
+        return KeysetPage(rows, next_cursor, previous_cursor)
+
+
+class KeysetPaginationMixin:
+    """ListView mixin that pages with KeysetPaginator, keyed on the ?sort= option"""
+
+    cursor_kwarg = 'cursor'
+
+    def get_sort(self):
+        sort = self.request.GET.get('sort', DEFAULT_SORT)
+        return sort if sort in SORT_ORDERINGS else DEFAULT_SORT
+
+    def get_keyset_paginator(self, queryset, page_size):
+        return KeysetPaginator(queryset, SORT_ORDERINGS[self.get_sort()], page_size)
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = self.get_keyset_paginator(queryset, page_size)
+        try:
+            page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        except InvalidCursor:
+            page = paginator.page()
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def page_url(self, cursor):
+        params = self.request.GET.copy()
+        params[self.cursor_kwarg] = cursor
+        params.pop('page', None)
+        return f'?{params.urlencode()}'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        page = context.get('page_obj')
+        if page is not None:
+            context['next_page_url'] = self.page_url(page.next_cursor) if page.has_next() else None
+            context['previous_page_url'] = self.page_url(page.previous_cursor) if page.has_previous() else None
+        return context
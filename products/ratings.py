@@ -0,0 +1,61 @@
+from django.db import transaction
+from django.db.models import Case, Count, F, FloatField, Q, Value, When
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+from .models import Product, Review
+
+STARS = range(1, 6)
+
+
+def _weighted_sum():
+    total = Value(0)
+    for stars in STARS:
+        total = total + F(f'rating_{stars}_count') * stars
+    return total
+
+
+def apply_rating(product_id, rating, delta):
+    """Add (delta=1) or remove (delta=-1) one rating from a product's aggregates.
+
+    Counts are adjusted with F() expressions so concurrent reviews never lose
+    updates; the average is then recomputed from the histogram. updated_at
+    is touched so in-memory indexes sorting by rating pick up the change.
+    """
+    products = Product.objects.filter(pk=product_id)
+    with transaction.atomic():
+        products.update(**{
+            'rating_count': F('rating_count') + delta,
+            f'rating_{rating}_count': F(f'rating_{rating}_count') + delta,
+            'updated_at': timezone.now(),
+        })
+        products.update(rating_avg=Case(
+            When(rating_count=0, then=Value(0.0)),
+            default=Cast(_weighted_sum(), FloatField()) / F('rating_count'),
+            output_field=FloatField(),
+        ))
+
+
+def backfill_ratings(batch_size=1000):
+    """Recompute the aggregates of every product from its reviews; returns products updated"""
+    counts = {
+        f'rating_{stars}_count': Count('id', filter=Q(rating=stars)) for stars in STARS
+    }
+    rows = Review.objects.order_by().values('product').annotate(rating_count=Count('id'), **counts)
+
+    fields = ['rating_avg', 'rating_count'] + list(counts)
+    updated = []
+    with transaction.atomic():
+        Product.objects.update(**{field: 0 for field in fields})
+        for row in rows.iterator(chunk_size=batch_size):
+            product = Product(pk=row['product'], rating_count=row['rating_count'])
+            for field in counts:
+                setattr(product, field, row[field])
+            product.rating_avg = sum(row[f'rating_{stars}_count'] * stars for stars in STARS) / row['rating_count']
+            updated.append(product)
+            if len(updated) >= batch_size:
+                Product.objects.bulk_update(updated, fields)
+                updated = []
+        if updated:
+            Product.objects.bulk_update(updated, fields)
+    return rows.count()
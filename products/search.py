@@ -0,0 +1,195 @@
+import re
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .models import Product
+
+SEARCH_TABLE = 'products_search_index'
+
+DEFAULT_BACKENDS = {
+    'postgresql': 'products.search.PostgresSearchBackend',
+    'sqlite': 'products.search.SQLiteSearchBackend',
+}
+
+_backend = None
+
+
+def get_search_backend():
+    """Return the configured search backend, defaulting to the one matching the database"""
+    global _backend
+    if _backend is None:
+        path = settings.SEARCH_BACKEND or DEFAULT_BACKENDS.get(
+            connection.vendor, 'products.search.DatabaseSearchBackend'
+        )
+        _backend = import_string(path)()
+    return _backend
+
+
+@receiver(setting_changed)
+def reset_search_backend(setting, **kwargs):
+    global _backend
+    if setting == 'SEARCH_BACKEND':
+        _backend = None
+
+
+def document_fields(product):
+    """Text of a product that search matches against, most important first"""
+    return {
+        'name': product.name,
+        'sku': product.sku,
+        'category': product.category.name,
+        'short_description': product.short_description,
+        'description': product.description,
+    }
+
+
+class SearchBackend:
+    """Base class for product search backends"""
+
+    def search(self, query, queryset=None):
+        """Return products matching query, best matches first"""
+        raise NotImplementedError
+
+    def index_products(self, products):
+        """Add or refresh the index entries of the given products"""
+
+    def remove_products(self, product_ids):
+        """Drop the index entries of the given product ids"""
+
+    def clear(self):
+        """Drop every index entry"""
+
+    def rebuild(self, batch_size=1000):
+        """Reindex the whole catalog in batches; returns the number of products indexed"""
+        self.clear()
+        total = 0
+        batch = []
+        for product in Product.objects.select_related('category').order_by('pk').iterator(chunk_size=batch_size):
+            batch.append(product)
+            if len(batch) >= batch_size:
+                self.index_products(batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            self.index_products(batch)
+            total += len(batch)
+        return total
+
+    def get_queryset(self, queryset):
+        if queryset is None:
+            queryset = Product.objects.filter(is_active=True)
+        return queryset
+
+
+class DatabaseSearchBackend(SearchBackend):
+    """Substring match over the product table, for databases without full-text search"""
+
+    def search(self, query, queryset=None):
+        return self.get_queryset(queryset).filter(
+            Q(name__icontains=query) |
+            Q(description__icontains=query) |
+            Q(category__name__icontains=query)
+        ).distinct()
+
+
+class PostgresSearchBackend(SearchBackend):
+    """Weighted tsvector documents in a GIN-indexed table, ranked with ts_rank"""
+
+    config = 'english'
+
+    def search(self, query, queryset=None):
+        tsquery = 'websearch_to_tsquery(%s::regconfig, %s)'
+        params = [self.config, query]
+        return self.get_queryset(queryset).filter(
+            id__in=RawSQL(f'SELECT product_id FROM {SEARCH_TABLE} WHERE document @@ {tsquery}', params)
+        ).annotate(
+            search_rank=RawSQL(
+                f'SELECT ts_rank(document, {tsquery}) FROM {SEARCH_TABLE} '
+                f'WHERE product_id = {Product._meta.db_table}.id',
+                params,
+            )
+        ).order_by('-search_rank', '-created_at')
+
+    def index_products(self, products):
+        vector = ' || '.join(
+            f"setweight(to_tsvector(%s::regconfig, %s), '{weight}')" for weight in 'AABCD'
+        )
+        rows = []
+        for product in products:
+            row = []
+            for text in document_fields(product).values():
+                row += [self.config, text or '']
+            rows.append([product.pk] + row)
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {SEARCH_TABLE} (product_id, document) VALUES (%s, {vector}) '
+                f'ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document',
+                rows,
+            )
+
+    def remove_products(self, product_ids):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE product_id = ANY(%s)', [list(product_ids)])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'TRUNCATE {SEARCH_TABLE}')
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """FTS5 virtual table keyed by product id, ranked with bm25"""
+
+    # bm25 column weights, in the order of document_fields()
+    weights = (10.0, 10.0, 5.0, 3.0, 1.0)
+
+    def match_expression(self, query):
+        """Turn free text into an FTS5 query that ANDs prefix matches of every word"""
+        words = re.findall(r'\w+', query)
+        return ' '.join(f'"{word}"*' for word in words)
+
+    def search(self, query, queryset=None):
+        queryset = self.get_queryset(queryset)
+        match = self.match_expression(query)
+        if not match:
+            return queryset.none()
+        weights = ', '.join(str(weight) for weight in self.weights)
+        return queryset.filter(
+            id__in=RawSQL(f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s', [match])
+        ).annotate(
+            search_rank=RawSQL(
+                f'SELECT bm25({SEARCH_TABLE}, {weights}) FROM {SEARCH_TABLE} '
+                f'WHERE {SEARCH_TABLE} MATCH %s AND rowid = {Product._meta.db_table}.id',
+                [match],
+            )
+        ).order_by('search_rank', '-created_at')
+
+    def index_products(self, products):
+        rows = [[product.pk] + list(document_fields(product).values()) for product in products]
+        if not rows:
+            return
+        self.remove_products([row[0] for row in rows])
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {SEARCH_TABLE} (rowid, name, sku, category, short_description, description) '
+                f'VALUES (%s, %s, %s, %s, %s, %s)',
+                rows,
+            )
+
+    def remove_products(self, product_ids):
+        product_ids = list(product_ids)
+        with connection.cursor() as cursor:
+            for start in range(0, len(product_ids), 500):
+                chunk = product_ids[start:start + 500]
+                cursor.execute(
+                    f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({', '.join(['%s'] * len(chunk))})", chunk
+                )
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
@@ -0,0 +1,346 @@
+"""In-memory inverted index over the catalog for typeahead.
+
+Each worker process keeps its own index. It is built on first use (or at
+worker start, see shop_street/wsgi.py), updated in place by the product
+signals of this process, and catches up with changes made by other
+processes by polling Product.updated_at every PRODUCT_INDEX_REFRESH seconds.
+Products deleted or deactivated elsewhere leave no updated_at behind, so
+each poll also drops indexed products that are no longer active.
+"""
+import heapq
+import math
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Product
+
+TOKEN_RE = re.compile(r'\w+')
+
+# How much more a token counts when it appears in the product name
+NAME_WEIGHT = 3
+
+
+def tokenize(text):
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return TOKEN_RE.findall(text.lower())
+
+
+class PrefixTrie:
+    """Character trie of index tokens, used to expand the word being typed"""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, token):
+        node = self.root
+        for char in token:
+            node = node.setdefault(char, {})
+        node[''] = token
+
+    def expand(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+        tokens = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for char, child in node.items():
+                if char == '':
+                    tokens.append(child)
+                else:
+                    stack.append(child)
+        return tokens
+
+
+class InvertedIndex:
+    """Token to posting list index with BM25 scoring.
+
+    Postings are parallel arrays of document numbers and term frequencies.
+    Document numbers only ever grow, so postings stay sorted; updating a
+    product tombstones its old document and appends a new one, and the arrays
+    are compacted once too many tombstones pile up.
+    """
+
+    k1 = 1.2
+    b = 0.75
+    max_expansions = 50
+    # Best documents kept per token for single-term queries
+    top_k = 32
+
+    def __init__(self):
+        self.postings = {}
+        self.trie = PrefixTrie()
+        self.lengths = array('I')
+        self.documents = []
+        self.doc_by_product = {}
+        self.deleted = set()
+        self.total_length = 0
+        self.lock = threading.RLock()
+        # Query-time caches, dropped whenever the index changes
+        self.expansions = {}
+        self.top_docs = {}
+        self.norms = None
+
+    def __len__(self):
+        return len(self.doc_by_product)
+
+    def add(self, product_id, name, short_description='', sku='', category='', **stored):
+        """Index a product, replacing any previous version of it"""
+        counts = {}
+        for token in tokenize(name):
+            counts[token] = counts.get(token, 0) + NAME_WEIGHT
+        for text in (short_description, sku, category):
+            for token in tokenize(text):
+                counts[token] = counts.get(token, 0) + 1
+        length = sum(counts.values())
+
+        with self.lock:
+            self.remove(product_id)
+            self.top_docs = {}
+            self.norms = None
+            doc = len(self.documents)
+            self.documents.append(dict(stored, id=product_id, name=name))
+            self.lengths.append(length)
+            self.doc_by_product[product_id] = doc
+            self.total_length += length
+            for token, count in counts.items():
+                entry = self.postings.get(token)
+                if entry is None:
+                    entry = self.postings[token] = (array('I'), array('H'))
+                    self.trie.add(token)
+                    self.expansions = {}
+                entry[0].append(doc)
+                entry[1].append(min(count, 0xFFFF))
+
+    def remove(self, product_id):
+        with self.lock:
+            doc = self.doc_by_product.pop(product_id, None)
+            if doc is None:
+                return
+            self.deleted.add(doc)
+            self.total_length -= self.lengths[doc]
+            self.top_docs = {}
+            self.norms = None
+            if len(self.deleted) > max(1000, len(self.documents) // 4):
+                self.compact()
+
+    def compact(self):
+        """Rewrite every posting list without tombstoned documents"""
+        with self.lock:
+            live = sorted(self.doc_by_product.values())
+            renumber = {old: new for new, old in enumerate(live)}
+            self.documents = [self.documents[old] for old in live]
+            self.lengths = array('I', (self.lengths[old] for old in live))
+            self.doc_by_product = {
+                product_id: renumber[doc] for product_id, doc in self.doc_by_product.items()
+            }
+            for token, (docs, tfs) in list(self.postings.items()):
+                kept = [(renumber[doc], tf) for doc, tf in zip(docs, tfs) if doc in renumber]
+                if kept:
+                    self.postings[token] = (array('I', (doc for doc, tf in kept)), array('H', (tf for doc, tf in kept)))
+                else:
+                    del self.postings[token]
+            self.trie = PrefixTrie()
+            for token in self.postings:
+                self.trie.add(token)
+            self.deleted = set()
+            self.expansions = {}
+            self.norms = None
+
+    def length_norms(self):
+        """BM25 document length normalisation per document, cached until the index changes"""
+        if self.norms is None:
+            k1, b = self.k1, self.b
+            average_length = self.total_length / max(len(self.doc_by_product), 1)
+            self.norms = array('d', (k1 * (1 - b + b * length / average_length) for length in self.lengths))
+        return self.norms
+
+    def deleted_in(self, docs):
+        """How many documents of a sorted posting list are tombstoned"""
+        if len(self.deleted) >= len(docs):
+            return sum(1 for doc in docs if doc in self.deleted)
+        count = 0
+        for doc in self.deleted:
+            position = bisect_left(docs, doc)
+            if position < len(docs) and docs[position] == doc:
+                count += 1
+        return count
+
+    def term_scores(self, tokens, candidates=None):
+        """BM25 score per document for the best-scoring of the given tokens.
+
+        With candidates, only those documents are scored; small candidate sets
+        are looked up in the sorted postings by bisection instead of scanning.
+        """
+        total_docs = len(self.doc_by_product)
+        k1 = self.k1
+        norms, deleted = self.length_norms(), self.deleted
+        scores = {}
+        for token in tokens:
+            docs, tfs = self.postings[token]
+            frequency = len(docs)
+            # Tombstones count towards the postings but not towards total_docs; left in, they can make idf negative
+            live = frequency - self.deleted_in(docs)
+            idf = math.log(1 + (total_docs - live + 0.5) / (live + 0.5))
+            if candidates is not None and len(candidates) * math.log2(frequency + 1) < frequency:
+                matches = []
+                for doc in candidates:
+                    position = bisect_left(docs, doc)
+                    if position < frequency and docs[position] == doc:
+                        matches.append((doc, tfs[position]))
+            else:
+                matches = zip(docs, tfs)
+            for doc, tf in matches:
+                if deleted and doc in deleted or candidates is not None and doc not in candidates:
+                    continue
+                score = idf * tf * (k1 + 1) / (tf + norms[doc])
+                if score > scores.get(doc, 0):
+                    scores[doc] = score
+        return scores
+
+    def expand(self, prefix):
+        """The most common tokens starting with prefix"""
+        tokens = self.expansions.get(prefix)
+        if tokens is None:
+            tokens = self.trie.expand(prefix)
+            tokens.sort(key=lambda token: (-len(self.postings[token][0]), token))
+            tokens = self.expansions[prefix] = tokens[:self.max_expansions]
+        return tokens
+
+    def best_documents(self, token):
+        """(score, doc) pairs of the top_k documents for a single token"""
+        best = self.top_docs.get(token)
+        if best is None:
+            scores = self.term_scores([token])
+            best = self.top_docs[token] = heapq.nlargest(
+                self.top_k, ((score, doc) for doc, score in scores.items())
+            )
+        return best
+
+    def search(self, query, limit=10, prefix=True):
+        """Return stored fields of the best matches for query, all words required.
+
+        With prefix=True the last word is treated as incomplete and expanded
+        through the trie to the most common tokens starting with it.
+        """
+        words = tokenize(query)
+        if not words:
+            return []
+        with self.lock:
+            if not self.doc_by_product:
+                return []
+            term_tokens = [[word] if word in self.postings else [] for word in words]
+            if prefix:
+                term_tokens[-1] = self.expand(words[-1])
+            if not all(term_tokens):
+                return []
+
+            if len(term_tokens) == 1 and limit <= self.top_k:
+                # Single term: merge the cached best documents of each token
+                totals = {}
+                for token in term_tokens[0]:
+                    for score, doc in self.best_documents(token):
+                        if score > totals.get(doc, 0):
+                            totals[doc] = score
+            else:
+                # Start from the rarest term so the candidate set shrinks quickly
+                term_tokens.sort(key=lambda tokens: sum(len(self.postings[token][0]) for token in tokens))
+                totals = self.term_scores(term_tokens[0])
+                for tokens in term_tokens[1:]:
+                    if not totals:
+                        break
+                    scores = self.term_scores(tokens, candidates=totals)
+                    totals = {doc: score + scores[doc] for doc, score in totals.items() if doc in scores}
+
+            best = heapq.nlargest(limit, totals.items(), key=lambda item: item[1])
+            return [dict(self.documents[doc], score=round(score, 4)) for doc, score in best]
+
+    def suggest(self, prefix, limit=10):
+        """Most common index tokens starting with the last word of prefix"""
+        words = tokenize(prefix)
+        if not words:
+            return []
+        with self.lock:
+            return self.expand(words[-1])[:limit]
+
+
+class ProductIndex(InvertedIndex):
+    """InvertedIndex of active products that knows how to load itself from the database"""
+
+    def __init__(self):
+        super().__init__()
+        self.synced_at = None
+        self.checked_at = 0
+
+    def add_product(self, product):
+        if not product.is_active:
+            self.remove(product.pk)
+            return
+        self.add(
+            product.pk,
+            product.name,
+            short_description=product.short_description,
+            sku=product.sku,
+            category=product.category.name,
+            url=product.get_absolute_url(),
+            price=str(product.price),
+        )
+
+    def load(self, queryset=None, batch_size=2000):
+        if queryset is None:
+            queryset = Product.objects.all()
+        self.synced_at = timezone.now()
+        self.checked_at = time.monotonic()
+        for product in queryset.select_related('category').iterator(chunk_size=batch_size):
+            self.add_product(product)
+        return self
+
+    def refresh(self):
+        """Pick up products changed by other processes since the last sync"""
+        interval = settings.PRODUCT_INDEX_REFRESH
+        if not interval or time.monotonic() - self.checked_at < interval:
+            return
+        self.checked_at = time.monotonic()
+        since, self.synced_at = self.synced_at, timezone.now()
+        for product in Product.objects.filter(updated_at__gte=since).select_related('category'):
+            self.add_product(product)
+        active = set(Product.objects.filter(is_active=True).values_list('pk', flat=True))
+        for product_id in set(self.doc_by_product) - active:
+            self.remove(product_id)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_product_index():
+    """Return this process's product index, building it on first use"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = ProductIndex().load()
+                return _index
+    _index.refresh()
+    return _index
+
+
+def loaded_product_index():
+    """Return the product index if this process has built one, without building it"""
+    return _index
+
+
+def reset_product_index():
+    global _index
+    _index = None
@@ -0,0 +1,118 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from core.cache import CATEGORIES, PRODUCTS, invalidate_tags
+from .facets import refresh_facets
+from .filter_index import update_loaded_filter_index
+from .models import Category, Product, ProductImage, ProductVariant, Review
+from .ratings import apply_rating
+from .search import get_search_backend
+from .search_index import loaded_product_index
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, raw=False, **kwargs):
+    if not raw:
+        get_search_backend().index_products([instance])
+        index = loaded_product_index()
+        if index is not None:
+            index.add_product(instance)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    get_search_backend().remove_products([instance.pk])
+    index = loaded_product_index()
+    if index is not None:
+        index.remove(instance.pk)
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_products(sender, instance, created=False, raw=False, **kwargs):
+    # The category name is part of every product document in it
+    if not raw and not created:
+        products = list(instance.products.select_related('category'))
+        get_search_backend().index_products(products)
+        index = loaded_product_index()
+        if index is not None:
+            for product in products:
+                index.add_product(product)
+        # Let the indexes of other processes see the new name when they poll
+        instance.products.update(updated_at=timezone.now())
+
+
+@receiver(pre_save, sender=Review)
+def remember_review_rating(sender, instance, raw=False, **kwargs):
+    # Keep the stored rating so post_save can move it between histogram buckets
+    instance._previous_rating = None
+    if not raw and instance.pk:
+        instance._previous_rating = Review.objects.filter(pk=instance.pk).values_list(
+            'product_id', 'rating'
+        ).first()
+
+
+@receiver(post_save, sender=Review)
+def add_review_rating(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_previous_rating', None)
+    if previous == (instance.product_id, instance.rating):
+        return
+    if previous is not None:
+        apply_rating(*previous, -1)
+    apply_rating(instance.product_id, instance.rating, 1)
+    invalidate_tags(PRODUCTS)
+
+
+@receiver(post_delete, sender=Review)
+def remove_review_rating(sender, instance, **kwargs):
+    apply_rating(instance.product_id, instance.rating, -1)
+    invalidate_tags(PRODUCTS)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def invalidate_product_pages(sender, **kwargs):
+    invalidate_tags(PRODUCTS)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_pages(sender, **kwargs):
+    # Product cards show their category, so both tags go
+    invalidate_tags(PRODUCTS, CATEGORIES)
+
+
+@receiver(post_save, sender=Product)
+def refresh_product_facets(sender, instance, raw=False, **kwargs):
+    if not raw:
+        refresh_facets([instance.pk])
+        update_loaded_filter_index([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product_filters(sender, instance, **kwargs):
+    update_loaded_filter_index([instance.pk])
+
+
+@receiver(post_save, sender=ProductVariant)
+@receiver(post_delete, sender=ProductVariant)
+def refresh_variant_facets(sender, instance, raw=False, origin=None, **kwargs):
+    # Variants deleted along with their product take its facet rows with them
+    if not raw and not isinstance(origin, Product):
+        refresh_facets([instance.product_id])
+        update_loaded_filter_index([instance.product_id])
+        # Let the filter indexes of other processes see the change when they poll
+        Product.objects.filter(pk=instance.product_id).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Category)
+def refresh_category_facets(sender, instance, created=False, raw=False, **kwargs):
+    # Category facets are keyed by slug
+    if not raw and not created:
+        product_ids = list(instance.products.values_list('pk', flat=True))
+        refresh_facets(product_ids)
+        update_loaded_filter_index(product_ids)
@@ -0,0 +1,9 @@
+from celery import shared_task
+
+from . import facets
+
+
+@shared_task
+def refresh_facets():
+    """Rebuild the whole facet table; scheduled every hour by beat"""
+    return facets.refresh_facets()
@@ -1,3 +1,620 @@
-from django.test import TestCase
+from importlib import import_module
+from io import StringIO
+from unittest import skipUnless
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.http import QueryDict
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .facets import FacetSearch, selections_from_query
+from .filter_index import FilterIndex, get_filter_index, reset_filter_index
+from .models import Category, Product, ProductFacet, ProductImage, ProductVariant, Review
+from .pagination import SORT_ORDERINGS, KeysetPaginator
+from .search import SQLiteSearchBackend, get_search_backend
+from .search_index import InvertedIndex, ProductIndex, get_product_index, reset_product_index
+
+
+class SearchBackendTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.audio = Category.objects.create(name='Audio')
+        cls.kitchen = Category.objects.create(name='Kitchen')
+        cls.headphones = Product.objects.create(
+            name='Wireless Headphones', description='Noise cancelling over-ear headphones',
+            category=cls.audio, price='99.00', sku='AUD-001',
+        )
+        cls.speaker = Product.objects.create(
+            name='Bluetooth Speaker', description='Pairs with wireless headphones too',
+            category=cls.audio, price='49.00', sku='AUD-002',
+        )
+        cls.kettle = Product.objects.create(
+            name='Electric Kettle', description='1.7 litre stainless steel',
+            category=cls.kitchen, price='29.00', sku='KIT-001',
+        )
+
+    def search(self, query):
+        return list(get_search_backend().search(query))
+
+    def test_default_backend_matches_database(self):
+        if connection.vendor == 'sqlite':
+            self.assertIsInstance(get_search_backend(), SQLiteSearchBackend)
+
+    def test_name_matches_rank_above_description_matches(self):
+        self.assertEqual(self.search('headphones'), [self.headphones, self.speaker])
+
+    def test_prefix_and_category_matches(self):
+        self.assertEqual(self.search('kett'), [self.kettle])
+        self.assertEqual(set(self.search('audio')), {self.headphones, self.speaker})
+
+    def test_index_follows_saves_and_deletes(self):
+        self.kettle.name = 'Gooseneck Kettle'
+        self.kettle.save()
+        self.assertEqual(self.search('gooseneck'), [self.kettle])
+
+        self.kitchen.name = 'Cookware'
+        self.kitchen.save()
+        self.assertEqual(self.search('cookware'), [self.kettle])
+
+        self.kettle.delete()
+        self.assertEqual(self.search('kettle'), [])
+
+    def test_inactive_products_are_hidden(self):
+        self.speaker.is_active = False
+        self.speaker.save()
+        self.assertEqual(self.search('bluetooth'), [])
+
+    def test_rebuild_command(self):
+        get_search_backend().clear()
+        self.assertEqual(self.search('kettle'), [])
+        out = StringIO()
+        call_command('rebuild_search_index', batch_size=2, stdout=out)
+        self.assertIn('Indexed 3 products', out.getvalue())
+        self.assertEqual(self.search('kettle'), [self.kettle])
+
+    def test_migration_indexes_the_existing_catalog(self):
+        get_search_backend().clear()
+        import_module('products.migrations.0002_search_index').build_search_index(apps, connection.schema_editor())
+        self.assertEqual(self.search('headphones'), [self.headphones, self.speaker])
+        self.assertEqual(set(self.search('audio')), {self.headphones, self.speaker})
+
+    @override_settings(SEARCH_BACKEND='products.search.DatabaseSearchBackend')
+    def test_database_backend(self):
+        self.assertEqual(set(self.search('wireless')), {self.headphones, self.speaker})
+
+    @override_settings(
+        SECURE_SSL_REDIRECT=False,
+        STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    )
+    def test_search_view(self):
+        response = self.client.get(reverse('core:search'), {'q': 'wireless headphones'})
+        self.assertEqual(response.context['total_results'], 2)
+        self.assertEqual(response.context['products'][0], self.headphones)
+
+
+class InvertedIndexTests(TestCase):
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.add(1, 'Wireless Headphones', short_description='Over-ear', sku='AUD-1', category='Audio')
+        self.index.add(2, 'Wired Earbuds', short_description='In-ear', sku='AUD-2', category='Audio')
+        self.index.add(3, 'Café Table', short_description='Solid oak', sku='HOM-1', category='Home')
+
+    def ids(self, query, **kwargs):
+        return [result['id'] for result in self.index.search(query, **kwargs)]
+
+    def test_prefix_expansion_of_last_word(self):
+        self.assertEqual(self.ids('wire'), [2, 1])
+        self.assertEqual(self.ids('wireless h'), [1])
+        self.assertEqual(self.ids('wire', prefix=False), [])
+        self.assertEqual(self.index.suggest('wi'), ['wired', 'wireless'])
+
+    def test_all_words_required(self):
+        self.assertEqual(self.ids('audio in'), [2])
+        self.assertEqual(self.ids('audio table'), [])
+
+    def test_diacritics_and_sku(self):
+        self.assertEqual(self.ids('cafe'), [3])
+        self.assertEqual(self.ids('hom 1'), [3])
+
+    def test_updates_and_compaction(self):
+        self.index.add(1, 'Noise Cancelling Headphones', category='Audio')
+        self.assertEqual(self.ids('wireless'), [])
+        self.assertEqual(self.ids('noise'), [1])
+        self.index.remove(2)
+        self.index.compact()
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.ids('audio'), [1])
+        self.assertEqual(self.ids('table'), [3])
+
+    def test_tombstones_do_not_hide_live_documents(self):
+        self.index.remove(1)
+        self.index.remove(3)
+        self.assertEqual(self.ids('audio'), [2])
+
+
+class AutocompleteViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Audio')
+        cls.headphones = Product.objects.create(
+            name='Wireless Headphones', description='Over-ear', category=cls.category,
+            price='99.00', sku='AUD-001',
+        )
+
+    def setUp(self):
+        reset_product_index()
+        self.addCleanup(reset_product_index)
+
+    @override_settings(SECURE_SSL_REDIRECT=False)
+    def test_autocomplete_follows_product_changes(self):
+        response = self.client.get(reverse('core:autocomplete'), {'q': 'wirel'})
+        results = response.json()['results']
+        self.assertEqual([result['id'] for result in results], [self.headphones.id])
+        self.assertEqual(results[0]['url'], self.headphones.get_absolute_url())
+
+        speaker = Product.objects.create(
+            name='Wireless Speaker', description='Portable', category=self.category,
+            price='49.00', sku='AUD-002',
+        )
+        self.assertEqual(len(get_product_index().search('wireless')), 2)
+
+        speaker.is_active = False
+        speaker.save()
+        self.headphones.delete()
+        self.assertEqual(get_product_index().search('wireless'), [])
+
+    @override_settings(PRODUCT_INDEX_REFRESH=1)
+    def test_refresh_picks_up_deletes_and_renames_of_other_processes(self):
+        # Signals only update the index of the process making the change
+        index = ProductIndex().load()
+        speaker = Product.objects.create(
+            name='Wireless Speaker', description='Portable', category=self.category,
+            price='49.00', sku='AUD-002',
+        )
+        self.category.name = 'Sound'
+        self.category.save()
+        self.headphones.delete()
+
+        index.checked_at = 0
+        index.refresh()
+        self.assertEqual([result['id'] for result in index.search('wireless')], [speaker.id])
+        self.assertEqual([result['id'] for result in index.search('sound')], [speaker.id])
+        self.assertEqual(index.search('audio'), [])
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Garden')
+        for i in range(30):
+            # Prices repeat so the id tiebreaker matters
+            Product.objects.create(
+                name=f'Plant {i:02d}', description='Green', category=cls.category,
+                price=f'{10 + i % 4}.00', sku=f'PL-{i:02d}',
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def walk(self, paginator):
+        pages, cursor = [], None
+        while True:
+            page = paginator.page(cursor)
+            pages.append(page)
+            if not page.has_next():
+                return pages
+            cursor = page.next_cursor
+
+    def test_pages_cover_every_row_once_in_order(self):
+        queryset = Product.objects.all()
+        for ordering in (('price', 'id'), ('-price', '-id'), ('name', 'id')):
+            pages = self.walk(KeysetPaginator(queryset, ordering, 7))
+            rows = [product for page in pages for product in page]
+            self.assertEqual(rows, list(queryset.order_by(*ordering)))
+            self.assertEqual(len(pages), 5)
+
+    def test_previous_cursor_returns_previous_page(self):
+        paginator = KeysetPaginator(Product.objects.all(), ('price', 'id'), 7)
+        first = paginator.page()
+        second = paginator.page(first.next_cursor)
+        back = paginator.page(second.previous_cursor)
+        self.assertEqual(back.object_list, first.object_list)
+        self.assertFalse(back.has_previous())
+        self.assertTrue(back.has_next())
+
+    def test_list_view_pages_without_counting(self):
+        url = reverse('products:list')
+        response = self.client.get(url, {'sort': 'price'})
+        self.assertEqual(len(response.context['products']), 12)
+        self.assertIsNone(response.context['previous_page_url'])
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url + response.context['next_page_url'])
+        self.assertFalse(any('COUNT(' in query['sql'] for query in ctx.captured_queries))
+        self.assertEqual(response.context['products'][0].price, 11)
+        self.assertIn('sort=price', response.context['previous_page_url'])
+
+    def test_tampered_cursor_falls_back_to_first_page(self):
+        response = self.client.get(reverse('products:list'), {'cursor': 'bogus'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['page_obj'].has_previous())
+
+    @skipUnless(connection.vendor == 'sqlite', 'Query plans are SQLite specific')
+    def test_listing_orders_are_served_by_indexes(self):
+        active = Product.objects.filter(is_active=True)
+        for queryset, index in (
+            (active.order_by(*SORT_ORDERINGS['-created_at']), 'product_active_created_idx'),
+            (active.order_by(*SORT_ORDERINGS['price']), 'product_active_price_idx'),
+            (active.order_by(*SORT_ORDERINGS['name']), 'product_active_name_idx'),
+            (active.filter(category=self.category).order_by(*SORT_ORDERINGS['-created_at']),
+             'product_category_created_idx'),
+            (active.filter(category=self.category, price__gte=11).order_by(*SORT_ORDERINGS['price']),
+             'product_category_price_idx'),
+        ):
+            plan = queryset[:13].explain()
+            self.assertIn(index, plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_category_view(self):
+        response = self.client.get(reverse('products:category', args=[self.category.slug]), {'sort': '-name'})
+        self.assertEqual(response.context['products'][0].name, 'Plant 29')
+        self.assertIsNotNone(response.context['next_page_url'])
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class ListingQueryCountTests(TestCase):
+    """Main images are prefetched, so query counts do not grow with the number of products"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Lighting')
+        cls.add_products(4)
+
+    @classmethod
+    def add_products(cls, count):
+        start = Product.objects.count()
+        for i in range(start, start + count):
+            product = Product.objects.create(
+                name=f'Lamp {i}', description='Desk lamp', category=cls.category,
+                price='25.00', sku=f'LMP-{i}', is_featured=True,
+            )
+            ProductImage.objects.create(product=product, image=f'products/lamp-{i}.jpg', is_main=True)
+            ProductImage.objects.create(product=product, image=f'products/lamp-{i}-side.jpg', order=1)
+
+    def setUp(self):
+        cache.clear()
+
+    def assertQueriesStable(self, url, expected, expected_after=None):
+        with self.assertNumQueries(expected):
+            response = self.client.get(url)
+        self.assertContains(response, 'lamp-0.jpg')
+        self.add_products(6)
+        with self.assertNumQueries(expected if expected_after is None else expected_after):
+            self.client.get(url)
+
+    def test_home(self):
+        # featured, categories and latest, plus one image prefetch per product grid;
+        # the categories fragment is still cached the second time
+        self.assertQueriesStable(reverse('core:home'), 5, 4)
+
+    def test_product_list(self):
+        # page, image prefetch, facet counts, categories
+        self.assertQueriesStable(reverse('products:list') + '?sort=name', 4)
+
+    def test_category(self):
+        # category, page, image prefetch, facet counts, categories
+        self.assertQueriesStable(reverse('products:category', args=[self.category.slug]) + '?sort=name', 5)
+
+    def test_search(self):
+        # ranked results with category joined, image prefetch
+        self.assertQueriesStable(reverse('core:search') + '?q=lamp', 2)
+
+    def test_main_image_is_prefetched(self):
+        product = Product.objects.with_main_image().get(sku='LMP-0')
+        with self.assertNumQueries(0):
+            self.assertEqual(product.main_image.image.name, 'products/lamp-0.jpg')
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class RatingAggregateTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Kitchen')
+        cls.product = Product.objects.create(
+            name='Kettle', description='Boils water', category=cls.category, price='30.00', sku='KTL-1',
+        )
+        cls.users = [
+            get_user_model().objects.create_user(
+                username=f'reviewer{i}', email=f'reviewer{i}@example.com', password='password',
+            )
+            for i in range(3)
+        ]
+
+    def setUp(self):
+        cache.clear()
+
+    def review(self, user, rating, product=None):
+        return Review.objects.create(
+            product=product or self.product, user=user, rating=rating, title='Review', comment='Text',
+        )
+
+    def test_aggregates_follow_reviews(self):
+        first = self.review(self.users[0], 5)
+        self.review(self.users[1], 2)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_avg), (2, 3.5))
+        self.assertEqual((self.product.rating_5_count, self.product.rating_2_count), (1, 1))
+
+        first.rating = 3
+        first.save()
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_5_count, self.product.rating_3_count), (0, 1))
+        self.assertEqual(self.product.rating_avg, 2.5)
+
+        first.delete()
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_avg), (1, 2.0))
+        self.assertEqual(self.product.rating_histogram[3], (2, 1, 100))
+
+    def test_backfill_matches_incremental_updates(self):
+        for user, rating in zip(self.users, (4, 4, 1)):
+            self.review(user, rating)
+        Product.objects.update(rating_avg=0, rating_count=0, rating_4_count=0)
+        call_command('backfill_ratings', stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_4_count), (3, 2))
+        self.assertEqual(self.product.rating_avg, 3.0)
+
+    def test_detail_view_reads_stored_aggregates(self):
+        for user, rating in zip(self.users, (5, 4, 3)):
+            self.review(user, rating)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.product.get_absolute_url())
+        self.assertFalse(any('AVG(' in query['sql'] for query in ctx.captured_queries))
+        self.assertEqual(response.context['average_rating'], 4.0)
+        self.assertEqual(response.context['total_reviews'], 3)
+
+    def test_top_rated_sort(self):
+        other = Product.objects.create(
+            name='Toaster', description='Toasts', category=self.category, price='20.00', sku='TST-1',
+        )
+        self.review(self.users[0], 3)
+        self.review(self.users[0], 5, product=other)
+        response = self.client.get(reverse('products:list'), {'sort': '-rating'})
+        self.assertEqual(list(response.context['products']), [other, self.product])
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class FacetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.shoes = Category.objects.create(name='Shoes')
+        cls.hats = Category.objects.create(name='Hats')
+        cls.runner = Product.objects.create(
+            name='Runner', description='Shoe', category=cls.shoes, price='80.00', sku='SH-1', stock_quantity=5,
+        )
+        cls.boot = Product.objects.create(
+            name='Boot', description='Shoe', category=cls.shoes, price='120.00', compare_price='150.00',
+            sku='SH-2', stock_quantity=0,
+        )
+        cls.cap = Product.objects.create(
+            name='Cap', description='Hat', category=cls.hats, price='20.00', sku='HT-1', stock_quantity=3,
+        )
+        for product, colour in ((cls.runner, 'Red'), (cls.runner, 'Blue'), (cls.boot, 'Red'), (cls.cap, 'Blue')):
+            ProductVariant.objects.create(
+                product=product, name='Color', value=colour, sku=f'{product.sku}-{colour}', stock_quantity=1,
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self, query=''):
+        return FacetSearch(Product.objects.filter(is_active=True), selections_from_query(QueryDict(query)))
+
+    def test_rows_follow_products_and_variants(self):
+        self.assertEqual(
+            set(ProductFacet.objects.filter(product=self.boot).values_list('facet', 'value')),
+            {('category', 'shoes'), ('price', '100-250'), ('sale', 'on_sale'), ('attr:Color', 'Red')},
+        )
+        self.boot.variants.get().delete()
+        self.boot.stock_quantity = 2
+        self.boot.save()
+        self.assertEqual(
+            set(ProductFacet.objects.filter(product=self.boot).values_list('facet', 'value')),
+            {('category', 'shoes'), ('price', '100-250'), ('sale', 'on_sale'), ('stock', 'in_stock')},
+        )
+
+    def test_counts(self):
+        counts = self.search().counts()
+        self.assertEqual(counts['category'], {'shoes': 2, 'hats': 1})
+        self.assertEqual(counts['attr:Color'], {'Red': 2, 'Blue': 2})
+        self.assertEqual(counts['stock'], {'in_stock': 2})
+
+    def test_selected_facet_keeps_counts_of_its_other_values(self):
+        search = self.search('category=shoes&attr=Color:Blue')
+        self.assertEqual(list(search.filter()), [self.runner])
+        counts = search.counts()
+        # Other categories still count products matching the colour selection
+        self.assertEqual(counts['category'], {'shoes': 1, 'hats': 1})
+        self.assertEqual(counts['attr:Color'], {'Red': 2, 'Blue': 1})
+        self.assertEqual(counts['price'], {'50-100': 1})
+
+    def test_counts_are_cached_until_catalog_changes(self):
+        self.search().counts()
+        with self.assertNumQueries(0):
+            self.search().counts()
+        self.cap.delete()
+        self.assertEqual(self.search().counts()['category'], {'shoes': 2})
+
+    def test_refresh_command_rebuilds_rows(self):
+        ProductFacet.objects.all().delete()
+        call_command('refresh_facets', stdout=StringIO())
+        self.assertEqual(ProductFacet.objects.count(), 13)
+
+    def test_migration_builds_the_same_rows(self):
+        rows = set(ProductFacet.objects.values_list('product', 'facet', 'value'))
+        ProductFacet.objects.all().delete()
+        import_module('products.migrations.0004_product_facets').build_facets(apps, None)
+        self.assertEqual(set(ProductFacet.objects.values_list('product', 'facet', 'value')), rows)
+
+    def test_list_view_filters_and_renders_sidebar(self):
+        response = self.client.get(reverse('products:list'), {'stock': 'in_stock', 'attr': 'Color:Red'})
+        self.assertEqual(list(response.context['products']), [self.runner])
+        groups = {group['facet']: group for group in response.context['facets']}
+        self.assertEqual(
+            [(option['label'], option['count'], option['selected']) for option in groups['stock']['options']],
+            [('In stock', 1, True)],
+        )
+        self.assertContains(response, 'value="Color:Red"')
+
+    def test_category_view_hides_category_facet(self):
+        response = self.client.get(reverse('products:category', args=[self.shoes.slug]), {'price': '50-100'})
+        self.assertEqual(list(response.context['products']), [self.runner])
+        self.assertNotIn('category', [group['facet'] for group in response.context['facets']])
+
+
+class FilterIndexTests(TestCase):
+    def setUp(self):
+        self.index = FilterIndex()
+        self.rows = {}
+        created = timezone.now()
+        for product_id in range(1, 61):
+            values = {
+                ('category', 'even' if product_id % 2 else 'odd'),
+                ('attr:Color', ['Red', 'Blue', 'Green'][product_id % 3]),
+            }
+            if product_id % 5:
+                values.add(('stock', 'in_stock'))
+            row = dict(values=values, price=product_id % 7 + 1, created_at=created, name=f'Item {product_id % 11}')
+            self.rows[product_id] = row
+            self.index.add(product_id, **row)
+
+    def expected(self, selections, key, reverse=False, min_price=None):
+        ids = [
+            product_id for product_id, row in self.rows.items()
+            if all(any((facet, value) in row['values'] for value in values) for facet, values in selections.items())
+            and (min_price is None or row['price'] >= min_price)
+        ]
+        return sorted(ids, key=lambda product_id: (key(self.rows[product_id]), product_id), reverse=reverse)
+
+    def walk(self, selections, sort, limit, **kwargs):
+        ids, after = [], None
+        while True:
+            page = self.index.page(selections, sort, limit, after=after, **kwargs)
+            ids += page
+            if len(page) < limit:
+                return ids
+            after = page[-1]
+
+    def test_pages_match_brute_force(self):
+        selections = {'attr:Color': ['Red', 'Blue'], 'stock': ['in_stock']}
+        self.assertEqual(self.walk(selections, 'price', 4), self.expected(selections, lambda row: row['price']))
+        self.assertEqual(
+            self.walk(selections, '-name', 5),
+            self.expected(selections, lambda row: row['name'], reverse=True),
+        )
+        self.assertEqual(
+            self.walk({'category': ['odd']}, 'price', 3, min_price=5),
+            self.expected({'category': ['odd']}, lambda row: row['price'], min_price=5),
+        )
+        self.assertEqual(self.index.count(selections), len(self.expected(selections, lambda row: 0)))
+
+    def test_backwards_returns_preceding_rows(self):
+        ordered = self.expected({}, lambda row: row['price'])
+        page = self.index.page({}, 'price', 5, after=ordered[20], backwards=True)
+        self.assertEqual(page, list(reversed(ordered[15:20])))
+
+    def test_updates_keep_orders_sorted(self):
+        self.index.page({}, 'price', 5)
+        row = dict(self.rows[1], price=100, values={('category', 'even'), ('attr:Color', 'Purple')})
+        self.rows[1] = row
+        self.index.add(1, **row)
+        self.index.remove(2)
+        del self.rows[2]
+        self.assertEqual(self.walk({}, '-price', 7), self.expected({}, lambda row: row['price'], reverse=True))
+        self.assertEqual(self.index.page({'attr:Color': ['Purple']}, 'price', 5), [1])
+
+    def test_compaction_preserves_results(self):
+        self.index.page({}, 'name', 5)
+        self.index.compact()
+        self.assertEqual(len(self.index), 60)
+        self.assertEqual(self.walk({}, 'name', 9), self.expected({}, lambda row: row['name']))
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    CATALOG_FILTER_INDEX=True,
+    PRODUCT_INDEX_REFRESH=0,
+)
+class FilterIndexViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Bags')
+        for i in range(30):
+            product = Product.objects.create(
+                name=f'Bag {i:02d}', description='Bag', category=cls.category, price=f'{20 + i % 6 * 10}.00',
+                sku=f'BG-{i:02d}', stock_quantity=i % 4,
+            )
+            ProductVariant.objects.create(
+                product=product, name='Color', value='Black' if i % 2 else 'Tan', sku=f'BG-{i:02d}-V',
+            )
+
+    def setUp(self):
+        cache.clear()
+        reset_filter_index()
+        self.addCleanup(reset_filter_index)
+
+    def collect(self, url, params):
+        names, response = [], self.client.get(url, params)
+        while True:
+            names += [product.name for product in response.context['products']]
+            if not response.context['next_page_url']:
+                return names
+            response = self.client.get(url + response.context['next_page_url'])
+
+    def test_pages_match_the_orm_path(self):
+        params = {'sort': '-price', 'attr': 'Color:Black', 'stock': 'in_stock', 'min_price': '30'}
+        url = reverse('products:list')
+        with_index = self.collect(url, params)
+        cache.clear()
+        with self.settings(CATALOG_FILTER_INDEX=False):
+            without_index = self.collect(url, params)
+        self.assertEqual(with_index, without_index)
+        self.assertEqual(len(with_index), 15)
+
+    def test_category_view_and_previous_page(self):
+        url = reverse('products:category', args=[self.category.slug])
+        first = self.client.get(url, {'sort': 'name'})
+        second = self.client.get(url + first.context['next_page_url'])
+        back = self.client.get(url + second.context['previous_page_url'])
+        self.assertEqual(list(back.context['products']), list(first.context['products']))
+        self.assertEqual(second.context['products'][0].name, 'Bag 12')
+
+    def test_signals_update_loaded_index(self):
+        index = get_filter_index()
+        product = Product.objects.get(sku='BG-00')
+        product.variants.update(value='Olive')
+        ProductVariant.objects.get(product=product).save()
+        self.assertEqual(index.page({'attr:Color': ['Olive']}, 'name', 5), [product.pk])
+        product.delete()
+        self.assertEqual(index.page({'attr:Color': ['Olive']}, 'name', 5), [])
@@ -1,21 +1,20 @@
 from django.shortcuts import render, get_object_or_404
 from django.views.generic import ListView, DetailView
-from django.db.models import Q, Avg
+from django.db.models import Q
 from .models import Product, Category
+from .facets import FacetSearch, selections_from_query
+from .filter_index import FilterIndexMixin
+from .pagination import KeysetPaginationMixin
+from core.cache import CachedPageMixin
 
-class ProductListView(ListView):
+class ProductListView(CachedPageMixin, FilterIndexMixin, KeysetPaginationMixin, ListView):
     model = Product
     template_name = 'products/list.html'
     context_object_name = 'products'
     paginate_by = 12
     
     def get_queryset(self):
-        queryset = Product.objects.filter(is_active=True)
-        
-        # Filter by category
-        category_slug = self.request.GET.get('category')
-        if category_slug:
-            queryset = queryset.filter(category__slug=category_slug)
+        queryset = Product.objects.filter(is_active=True).with_main_image()
         
         # Filter by price range
         min_price = self.request.GET.get('min_price')
@@ -25,33 +24,42 @@ class ProductListView(ListView):
         if max_price:
             queryset = queryset.filter(price__lte=max_price)
         
-        # Sort by
-        sort_by = self.request.GET.get('sort', '-created_at')
-        if sort_by in ['price', '-price', 'name', '-name', 'created_at', '-created_at']:
-            queryset = queryset.order_by(sort_by)
+        # Category, price band, stock, sale and variant attribute facets
+        self.facet_search = FacetSearch(queryset, selections_from_query(self.request.GET))
         
-        return queryset
+        # Sorting is applied by the keyset paginator, see get_sort()
+        return self.facet_search.filter()
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['categories'] = Category.objects.filter(is_active=True)
         context['current_category'] = self.request.GET.get('category', '')
-        context['current_sort'] = self.request.GET.get('sort', '-created_at')
+        context['current_sort'] = self.get_sort()
+        context['facets'] = self.facet_search.sidebar(context['categories'])
         return context
 
-class CategoryView(ListView):
+class CategoryView(CachedPageMixin, FilterIndexMixin, KeysetPaginationMixin, ListView):
     model = Product
-    template_name = 'products/category.html'
+    template_name = 'products/list.html'
     context_object_name = 'products'
     paginate_by = 12
     
     def get_queryset(self):
         self.category = get_object_or_404(Category, slug=self.kwargs['slug'], is_active=True)
-        return Product.objects.filter(category=self.category, is_active=True)
+        queryset = Product.objects.filter(category=self.category, is_active=True).with_main_image()
+        self.facet_search = FacetSearch(queryset, selections_from_query(self.request.GET, hidden=['category']))
+        return self.facet_search.filter()
+    
+    def get_fixed_selections(self):
+        return {'category': [self.category.slug]}
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['category'] = self.category
+        context['categories'] = Category.objects.filter(is_active=True)
+        context['current_category'] = self.category.slug
+        context['current_sort'] = self.get_sort()
+        context['facets'] = self.facet_search.sidebar(hidden=['category'])
         return context
 
 class ProductDetailView(DetailView):
@@ -60,22 +68,22 @@ class ProductDetailView(DetailView):
     context_object_name = 'product'
     
     def get_queryset(self):
-        return Product.objects.filter(is_active=True)
+        return Product.objects.filter(is_active=True).with_main_image()
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        product = self.get_object()
+        product = self.object
         
         # Related products
         context['related_products'] = Product.objects.filter(
             category=product.category, 
             is_active=True
-        ).exclude(id=product.id)[:4]
+        ).exclude(id=product.id).with_main_image()[:4]
         
         # Product reviews
-        reviews = product.reviews.all()
-        context['reviews'] = reviews
-        context['average_rating'] = reviews.aggregate(Avg('rating'))['rating__avg'] or 0
-        context['total_reviews'] = reviews.count()
+        context['reviews'] = product.reviews.select_related('user')
+        context['average_rating'] = product.rating_avg
+        context['total_reviews'] = product.rating_count
+        context['rating_histogram'] = product.rating_histogram
         
         return context
\ No newline at end of file
@@ -54,12 +54,15 @@ MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'core.middleware.QueryMetricsMiddleware',
+    'core.middleware.ReplicaPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'allauth.account.middleware.AccountMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'cart.middleware.CartCookieMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
@@ -92,6 +95,42 @@ DATABASES = {
     }
 }
 
+# Read replicas (core/db_router.py): DATABASE_REPLICA_URLS=postgres://...,postgres://... become replica_1, replica_2, ...
+# Tests run them as mirrors of the test database.
+DATABASE_REPLICAS = []
+for number, url in enumerate(env.list('DATABASE_REPLICA_URLS', default=[]), 1):
+    DATABASES[f'replica_{number}'] = {**env.db_url_config(url), 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(f'replica_{number}')
+DATABASE_ROUTERS = ['core.db_router.ReplicaRouter']
+# Apps whose reads may go to a replica, seconds a browser reads from the primary after writing, how often a
+# replica's health is checked and how far (PostgreSQL) it may lag behind
+READ_REPLICA_APPS = ['products', 'vendors', 'accounts']
+READ_REPLICA_PIN_COOKIE = 'primary_pin'
+READ_REPLICA_PIN_SECONDS = env.int('READ_REPLICA_PIN_SECONDS', default=5)
+READ_REPLICA_HEALTH_INTERVAL = env.float('READ_REPLICA_HEALTH_INTERVAL', default=5.0)
+READ_REPLICA_MAX_LAG = env.float('READ_REPLICA_MAX_LAG', default=10.0)
+
+# Cache
+# Redis when REDIS_URL is set, otherwise a per-process in-memory cache
+REDIS_URL = env('REDIS_URL', default='')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': 'shop_street',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+# Seconds that anonymous catalog pages and home page fragments stay cached;
+# product and category changes invalidate them sooner (see core/cache.py)
+CATALOG_CACHE_TIMEOUT = env.int('CATALOG_CACHE_TIMEOUT', default=300)
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -162,6 +201,43 @@ EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD', default='')
 STRIPE_PUBLISHABLE_KEY = env('STRIPE_PUBLISHABLE_KEY', default='')
 STRIPE_SECRET_KEY = env('STRIPE_SECRET_KEY', default='')
 STRIPE_WEBHOOK_SECRET = env('STRIPE_WEBHOOK_SECRET', default='')
+# Point the Stripe client at another server, e.g. a local fake in development
+STRIPE_API_BASE = env('STRIPE_API_BASE', default='')
+# Pooled gateway client (orders/gateway.py): keep-alive connections per process,
+# connect/read timeouts in seconds, retries of failed connects and of failed requests
+STRIPE_POOL_SIZE = env.int('STRIPE_POOL_SIZE', default=10)
+STRIPE_CONNECT_TIMEOUT = env.float('STRIPE_CONNECT_TIMEOUT', default=3.0)
+STRIPE_READ_TIMEOUT = env.float('STRIPE_READ_TIMEOUT', default=20.0)
+STRIPE_CONNECT_RETRIES = env.int('STRIPE_CONNECT_RETRIES', default=2)
+STRIPE_MAX_NETWORK_RETRIES = env.int('STRIPE_MAX_NETWORK_RETRIES', default=2)
+
+# Celery
+# Runs the outbox (orders/outbox.py) and applies queued webhooks (orders/webhooks.py); without
+# a broker, run manage.py drain_outbox --loop and process_webhooks --loop instead
+CELERY_BROKER_URL = env('CELERY_BROKER_URL', default=REDIS_URL or 'memory://')
+CELERY_TASK_ALWAYS_EAGER = env.bool('CELERY_TASK_ALWAYS_EAGER', default=False)
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_BEAT_SCHEDULE = {
+    'drain-outbox': {'task': 'orders.tasks.drain_outbox', 'schedule': 60.0},
+    'process-webhook-events': {'task': 'orders.tasks.process_webhook_events', 'schedule': 2.0},
+    'release-expired-stock': {'task': 'orders.tasks.release_expired_stock', 'schedule': 60.0},
+    'refresh-facets': {'task': 'products.tasks.refresh_facets', 'schedule': 3600.0},
+}
+
+# Search
+# Dotted path to a products.search backend; empty picks one matching the database
+SEARCH_BACKEND = env('SEARCH_BACKEND', default='')
+# In-memory autocomplete index: build it when a worker starts, and how often
+# (seconds) to pick up product changes made by other workers
+PRODUCT_INDEX_WARMUP = env.bool('PRODUCT_INDEX_WARMUP', default=False)
+PRODUCT_INDEX_REFRESH = env.int('PRODUCT_INDEX_REFRESH', default=60)
+# Page product listings from the in-memory bitmap filter index instead of SQL
+# (products/filter_index.py); it follows the warmup and refresh settings above
+CATALOG_FILTER_INDEX = env.bool('CATALOG_FILTER_INDEX', default=False)
+
+# Inventory
+# Seconds that stock stays reserved for an order awaiting payment
+STOCK_RESERVATION_TTL = env.int('STOCK_RESERVATION_TTL', default=15 * 60)
 
 # Security Settings for Production
 if not DEBUG:
@@ -185,4 +261,21 @@ CORS_ALLOWED_ORIGINS = [
 
 # Session Configuration
 SESSION_COOKIE_AGE = 86400  # 24 hours
-SESSION_SAVE_EVERY_REQUEST = True
\ No newline at end of file
+SESSION_SAVE_EVERY_REQUEST = True
+
+# Guest carts: signed cookie holding the cart token and badge summary (cart/summary.py)
+CART_COOKIE_NAME = 'cart'
+CART_COOKIE_AGE = env.int('CART_COOKIE_AGE', default=14 * 86400)
+
+# Where cart lines are kept (cart/storage.py): cart.storage.DatabaseCartStorage or cart.storage.RedisCartStorage
+CART_STORAGE = env('CART_STORAGE', default='cart.storage.DatabaseCartStorage')
+CART_REDIS_URL = env('CART_REDIS_URL', default=REDIS_URL or 'redis://localhost:6379/0')
+
+# Per-request query metrics (core/metrics.py): share of requests recorded, Redis hash shared by all processes
+# (in-process only when empty), seconds between flushes to it, and repeats of one query that log a warning
+QUERY_METRICS_SAMPLE_RATE = env.float('QUERY_METRICS_SAMPLE_RATE', default=1.0 if DEBUG else 0.05)
+QUERY_METRICS_REDIS_URL = env('QUERY_METRICS_REDIS_URL', default=REDIS_URL)
+QUERY_METRICS_FLUSH_INTERVAL = env.float('QUERY_METRICS_FLUSH_INTERVAL', default=10.0)
+QUERY_METRICS_DUPLICATE_WARNING = env.int('QUERY_METRICS_DUPLICATE_WARNING', default=10)
+# Bearer token the Prometheus scraper sends to /metrics/; the endpoint is off when empty
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
@@ -9,8 +9,19 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'shop_street.settings')
 
 application = get_wsgi_application()
+
+
+if settings.PRODUCT_INDEX_WARMUP:
+    # Build the autocomplete index when the worker boots rather than on its first request
+    from products.search_index import get_product_index
+    get_product_index()
+
+    if settings.CATALOG_FILTER_INDEX:
+        from products.filter_index import get_filter_index
+        get_filter_index()